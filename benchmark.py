@@ -0,0 +1,251 @@
+"""
+This is the code for the end-to-end benchmark of the queries from tests.make_tests.
+
+Run `python benchmark.py [--scale N] [--repeats R] [--output FILE]`.
+Every test case runs cold (query caches cleared before each run) and warm
+(caches filled by a previous run). The report has p50/p95/p99 latency per
+stage, the startup time, peak RSS, and is written as JSON for comparing runs.
+
+With --scale N the benchmark runs on a synthetic corpus with N copies of every
+playlist of database/, generated once into bench/xN, and indexes it with
+indexer.build_indexes. The copies reuse the cached embeddings and lemmas of the
+originals and the manifest lists them, so nothing has to be encoded.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import platform
+import numpy as np
+
+from tests import make_tests
+
+BENCH_DIR = "bench"
+STAGES = ["tag_filter", "spellcheck", "lemmatize", "encode", "lexical", "score", "rank", "total"]
+PERCENTILES = (50, 95, 99)
+
+
+def make_synthetic_corpus(scale, target_dir, database_dir="database", cache_dir="cache"):
+    """
+    Generates a corpus with scale copies of every playlist. Copies get new
+    playlist and video ids; their embedding and lemma caches are links to the
+    originals, and the cache manifest lists them under the new ids.
+
+    Args:
+        scale (int): Number of copies.
+        target_dir (str): Directory to create database/ and cache/ in.
+        database_dir (str): Original database.
+        cache_dir (str): Original embedding cache.
+    """
+    from indexer import MANIFEST_FILE
+
+    target_database = os.path.join(target_dir, "database")
+    target_cache = os.path.join(target_dir, "cache")
+    os.makedirs(target_database)
+    os.makedirs(target_cache)
+    cache_files = os.listdir(cache_dir)
+    manifest_file = os.path.join(cache_dir, MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, "r") as file:
+            manifest = json.load(file)
+    copy_manifest = {}
+
+    for folder in sorted(os.listdir(database_dir)):
+        if not os.path.exists(os.path.join(database_dir, folder, "desc.json")):
+            continue
+        videos = {}
+        for video_file in sorted(os.listdir(os.path.join(database_dir, folder))):
+            with open(os.path.join(database_dir, folder, video_file), "r") as file:
+                videos[video_file] = json.load(file)
+        playlist = videos.pop("desc.json")
+
+        for copy in range(scale):
+            suffix = f"_{copy}" if copy else ""
+            copy_folder = os.path.join(target_database, f"{folder}{suffix}")
+            os.makedirs(copy_folder)
+            with open(os.path.join(copy_folder, "desc.json"), "w") as file:
+                json.dump(dict(playlist, id=f"{playlist['id']}{suffix}"), file)
+            for video in videos.values():
+                video_id = video["contentDetails"]["videoId"]
+                video["contentDetails"]["videoId"] = f"{video_id}{suffix}"
+                with open(os.path.join(copy_folder, f"{video_id}{suffix}.json"), "w") as file:
+                    json.dump(video, file)
+                video["contentDetails"]["videoId"] = video_id
+                if video_id in manifest:
+                    copy_manifest[f"{video_id}{suffix}"] = manifest[video_id]
+                for filename in cache_files:
+                    if filename.startswith(f"{video_id}_"):
+                        os.symlink(
+                            os.path.abspath(os.path.join(cache_dir, filename)),
+                            os.path.join(target_cache, f"{video_id}{suffix}{filename[len(video_id):]}"),
+                        )
+
+    with open(os.path.join(target_cache, MANIFEST_FILE), "w") as file:
+        json.dump(copy_manifest, file)
+
+
+def percentiles(values):
+    """
+    Computes latency percentiles.
+
+    Args:
+        values (list[float]): Latencies in seconds.
+
+    Returns:
+        dict: "p50", "p95", "p99" and "mean" in milliseconds.
+    """
+    values = np.asarray(values) * 1000
+    report = {f"p{q}": round(float(np.percentile(values, q)), 3) for q in PERCENTILES}
+    report["mean"] = round(float(values.mean()), 3)
+    return report
+
+
+def run_case(playlist_tags, query):
+    """
+    Runs one test case the way the bot does and measures its stages.
+
+    Args:
+        playlist_tags (dict): Playlist tags.
+        query (str): User search query.
+
+    Returns:
+        dict: Stage name to elapsed seconds; missing stages took no time.
+    """
+    from instrumentation import collect_timings
+    from text_processor import timestamp_search, transcript_search
+    from video_searcher import global_search
+
+    start_time = time.perf_counter()
+    with collect_timings() as timings:
+        videos = global_search(playlist_tags)
+        if len(videos) != 0:
+            timestamp_search(query, videos, 0.75, verbose=False)
+            transcript_search(query, videos, 0.75, verbose=False)
+    timings["total"] = time.perf_counter() - start_time
+    return {name: timings.get(name, 0.0) for name in STAGES}
+
+
+def summarize(runs):
+    """
+    Summarizes measured runs.
+
+    Args:
+        runs (list[dict]): Stage timings of every run.
+
+    Returns:
+        dict: Stage name to its percentiles.
+    """
+    return {name: percentiles([run[name] for run in runs]) for name in STAGES}
+
+
+def run_benchmark(repeats):
+    """
+    Runs every test case cold and warm.
+
+    Args:
+        repeats (int): Number of runs of every test case in every mode.
+
+    Returns:
+        dict: Benchmark report.
+    """
+    from corpus_index import get_index
+    from embedding_index import get_embedding_index
+    from query_cache import cache_stats, clear_caches
+    from text_processor import warmup
+
+    start_time = time.perf_counter()
+    corpus = get_index()
+    embedding_index = get_embedding_index()
+    index_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    warmup()
+    models_time = time.perf_counter() - start_time
+
+    tests = make_tests()
+    cold = {i: [] for i in range(len(tests))}
+    warm = {i: [] for i in range(len(tests))}
+    for _ in range(repeats):
+        for i, (playlist_tags, query) in enumerate(tests):
+            clear_caches()
+            cold[i].append(run_case(playlist_tags, query))
+            warm[i].append(run_case(playlist_tags, query))
+
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "corpus": {
+            "playlists": len(corpus["playlists"]),
+            "videos": len(corpus["videos"]),
+            "passages": int(len(embedding_index.matrix)),
+        },
+        "repeats": repeats,
+        "startup_s": {"index": round(index_time, 3), "models": round(models_time, 3)},
+        "cold": summarize([run for runs in cold.values() for run in runs]),
+        "warm": summarize([run for runs in warm.values() for run in runs]),
+        "cases": [
+            {
+                "playlist_tags": playlist_tags,
+                "query": query,
+                "cold_total": percentiles([run["total"] for run in cold[i]]),
+                "warm_total": percentiles([run["total"] for run in warm[i]]),
+            }
+            for i, (playlist_tags, query) in enumerate(tests)
+        ],
+        "cache_stats": cache_stats(),
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10), 1),
+    }
+
+
+def print_report(report):
+    """
+    Prints the report as tables.
+
+    Args:
+        report (dict): Benchmark report.
+    """
+    corpus = report["corpus"]
+    print(f"Corpus: {corpus['playlists']} playlists, {corpus['videos']} videos, {corpus['passages']} passages")
+    print(f"Startup: index {report['startup_s']['index']} s, models {report['startup_s']['models']} s")
+    for mode in ("cold", "warm"):
+        print(f"\n{mode} (ms)      " + "".join(f"{name:>10}" for name in ("p50", "p95", "p99", "mean")))
+        for name in STAGES:
+            line = report[mode][name]
+            print(f"{name:<16}" + "".join(f"{line[key]:>10.3f}" for key in ("p50", "p95", "p99", "mean")))
+    print(f"\nPeak RSS: {report['peak_rss_mb']} MB")
+
+
+def main():
+    """Runs the benchmark and writes the JSON report."""
+    from indexer import build_indexes
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scale", type=int, default=1, help="number of copies of database/")
+    parser.add_argument("--repeats", type=int, default=5, help="runs of every test case in every mode")
+    parser.add_argument("--output", default="benchmark.json", help="path of the JSON report")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    if args.scale > 1:
+        target_dir = os.path.join(BENCH_DIR, f"x{args.scale}")
+        if not os.path.exists(target_dir):
+            print(f"Generating a corpus {args.scale} times larger in {target_dir}")
+            make_synthetic_corpus(args.scale, target_dir)
+        # All data paths are relative, so the synthetic corpus replaces database/, index/ and cache/.
+        os.chdir(target_dir)
+        build_indexes()
+
+    report = run_benchmark(args.repeats)
+    report["scale"] = args.scale
+    print_report(report)
+    with open(output, "w") as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"Report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
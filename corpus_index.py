@@ -0,0 +1,449 @@
+"""
+This is the code for the compiled corpus index built from the database.
+
+The index keeps playlist and video tags in one compact JSON table and moves
+transcripts into columnar store files, one per playlist (see transcript_store),
+so filtering by tags never reads transcripts.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from media import Transcript, Video, make_playlist_tags, make_video_tags
+
+DATABASE_DIR = "database"
+INDEX_DIR = "index"
+
+INDEX_FILE = "corpus.json"
+# Indexes written in another format are rebuilt from scratch.
+INDEX_FORMAT = 2
+
+# Parsed tags keyed by a hash of the parsed text, so an unchanged description is never parsed again.
+TAGS_CACHE_FILE = "tags_cache.json"
+# Version of the tag and timestamp parsers of media. Bump it when they change:
+# indexes and tag caches of another version are parsed again from scratch.
+TAGS_PARSER_VERSION = 1
+
+_loaded = {"mtime_ns": None, "index": None}
+_lock = threading.Lock()
+
+
+def index_path(filename):
+    """
+    Builds a path to a file inside the index directory.
+
+    Args:
+        filename (str): File name.
+
+    Returns:
+        str: Path to the file.
+    """
+    return os.path.join(INDEX_DIR, filename)
+
+
+def file_stamp(path):
+    """
+    Gets the modification stamp of a file.
+
+    Args:
+        path (str): Path to the file.
+
+    Returns:
+        list: [mtime_ns, size] of the file.
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def empty_index():
+    """
+    Creates an empty index.
+
+    Returns:
+        dict: Index with no playlists and videos.
+    """
+    return {"format": INDEX_FORMAT, "tags_parser": TAGS_PARSER_VERSION, "version": 0, "playlists": {}, "videos": {}}
+
+
+def read_index():
+    """
+    Reads the index from disk.
+
+    Returns:
+        dict: Stored index or an empty index if there is none or it has another
+            format or tags parser version.
+    """
+    path = index_path(INDEX_FILE)
+    if not os.path.exists(path):
+        return empty_index()
+    with open(path, "r") as file:
+        index = json.load(file)
+    if index.get("format") != INDEX_FORMAT or index.get("tags_parser") != TAGS_PARSER_VERSION:
+        return dict(empty_index(), version=index.get("version", 0))
+    return index
+
+
+def write_json_atomic(path, data):
+    """
+    Writes JSON data so that readers never see a partially written file.
+
+    Args:
+        path (str): Path to the file.
+        data: JSON serializable data.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def store_filename(folder, version):
+    """
+    Names the store file of a playlist. Every rewrite gets a new name, so
+    readers of an older index keep reading the file they know.
+
+    Args:
+        folder (str): Playlist folder name.
+        version (int): Index version the file is written for.
+
+    Returns:
+        str: File name inside the index directory.
+    """
+    return f"transcripts.{folder}.{version}.bin"
+
+
+def read_transcript(location):
+    """
+    Reads one transcript from its playlist store.
+
+    Args:
+        location (list): [store file name, first chunk, end chunk] of the transcript.
+
+    Returns:
+        list: Transcript chunks.
+    """
+    from transcript_store import open_store
+
+    filename, first, end = location
+    return open_store(index_path(filename)).transcript(first, end)
+
+
+def load_transcript(location):
+    """
+    Loads one transcript from its playlist store without building chunk dicts.
+
+    Args:
+        location (list): [store file name, first chunk, end chunk] of the transcript.
+
+    Returns:
+        Transcript: Transcript object.
+    """
+    from transcript_store import open_store
+
+    filename, first, end = location
+    return Transcript.from_columns(*open_store(index_path(filename)).slices(first, end))
+
+
+def read_tags_cache():
+    """
+    Reads the cache of parsed tags. A cache of another parser version is discarded.
+
+    Returns:
+        dict: {"playlists": {title hash: tags}, "videos": {description hash: [tags, timestamps]}}
+    """
+    path = index_path(TAGS_CACHE_FILE)
+    if not os.path.exists(path):
+        return {"playlists": {}, "videos": {}}
+    with open(path, "r") as file:
+        tags_cache = json.load(file)
+    if tags_cache.get("parser_version") != TAGS_PARSER_VERSION:
+        return {"playlists": {}, "videos": {}}
+    return {"playlists": tags_cache["playlists"], "videos": tags_cache["videos"]}
+
+
+def text_hash(text):
+    """
+    Hashes a title or a description.
+
+    Args:
+        text (str): Text.
+
+    Returns:
+        str: Hex digest.
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def cached_tags(kind, text, parse, tags_cache):
+    """
+    Parses a title or a description unless its result is cached.
+
+    Args:
+        kind (str): "playlists" or "videos".
+        text (str): Text to parse.
+        parse (callable): Parser of the text.
+        tags_cache (dict): Cache of parsed tags, see read_tags_cache; updated in place.
+
+    Returns:
+        Parsed tags.
+    """
+    key = text_hash(text)
+    if key not in tags_cache[kind]:
+        tags_cache[kind][key] = parse(text)
+    return tags_cache[kind][key]
+
+
+def write_tags_cache(tags_cache, index):
+    """
+    Writes the cache of parsed tags, keeping only entries of the index.
+
+    Args:
+        tags_cache (dict): Cache of parsed tags, see read_tags_cache.
+        index (dict): Current index.
+    """
+    playlists = {text_hash(playlist["title"]) for playlist in index["playlists"].values()}
+    videos = {text_hash(video["desc"]) for video in index["videos"].values()}
+    write_json_atomic(index_path(TAGS_CACHE_FILE), {
+        "parser_version": TAGS_PARSER_VERSION,
+        "playlists": {key: tags for key, tags in tags_cache["playlists"].items() if key in playlists},
+        "videos": {key: tags for key, tags in tags_cache["videos"].items() if key in videos},
+    })
+
+
+def index_playlist(folder, stamp, tags_cache):
+    """
+    Makes an index entry for a playlist.
+
+    Args:
+        folder (str): Playlist folder name.
+        stamp (list): Modification stamp of the desc.json file.
+        tags_cache (dict): Cache of parsed tags, see cached_tags.
+
+    Returns:
+        dict: Playlist entry.
+    """
+    with open(os.path.join(DATABASE_DIR, folder, "desc.json"), "r") as file:
+        json_data = json.load(file)
+    return {
+        "stamp": stamp,
+        "id": json_data["id"],
+        "title": json_data["snippet"]["title"],
+        "desc": json_data["snippet"]["description"],
+        "upload_date": json_data["snippet"]["publishedAt"],
+        "tags": cached_tags("playlists", json_data["snippet"]["title"], make_playlist_tags, tags_cache),
+        "store": None,
+        "videos": [],
+    }
+
+
+def index_video(folder, video_file, stamp, tags_cache):
+    """
+    Makes an index entry for a video. The transcript is returned separately
+    to be written into the playlist store.
+
+    Args:
+        folder (str): Playlist folder name.
+        video_file (str): Video file name.
+        stamp (list): Modification stamp of the video file.
+        tags_cache (dict): Cache of parsed tags, see cached_tags.
+
+    Returns:
+        tuple: (video entry (dict), transcript chunks (list) or None)
+    """
+    with open(os.path.join(DATABASE_DIR, folder, video_file), "r") as file:
+        json_data = json.load(file)
+    desc = json_data["snippet"]["description"]
+    tags, timestamps = cached_tags("videos", desc, make_video_tags, tags_cache)
+    entry = {
+        "stamp": stamp,
+        "id": json_data["contentDetails"]["videoId"],
+        "title": json_data["snippet"]["title"],
+        "desc": desc,
+        "upload_date": json_data["contentDetails"]["videoPublishedAt"],
+        "tags": tags,
+        "timestamps": timestamps,
+        "transcript": None,
+    }
+    return entry, json_data["snippet"]["transcript"]
+
+
+def write_playlist_store(folder, playlist, videos, transcripts, version):
+    """
+    Writes the store file of a playlist and points its videos to it.
+
+    Args:
+        folder (str): Playlist folder name.
+        playlist (dict): Playlist entry, updated in place.
+        videos (dict): Video entries, updated in place.
+        transcripts (dict): Video key to new transcript chunks; other videos
+            are copied from their current store.
+        version (int): Index version the file is written for.
+    """
+    from transcript_store import write_store
+
+    keys = []
+    chunks = []
+    for key in playlist["videos"]:
+        transcript = transcripts[key] if key in transcripts else None
+        if key not in transcripts and videos[key]["transcript"] is not None:
+            transcript = read_transcript(videos[key]["transcript"])
+        if transcript is not None:
+            keys.append(key)
+            chunks.append(transcript)
+
+    filename = store_filename(folder, version)
+    ranges = write_store(index_path(filename), chunks)
+    for key in playlist["videos"]:
+        videos[key]["transcript"] = None
+    for key, (first, end) in zip(keys, ranges):
+        videos[key]["transcript"] = [filename, first, end]
+    playlist["store"] = filename
+
+
+def remove_unused_stores(index):
+    """
+    Removes store files that the index does not refer to.
+    Older files may still be mapped by readers; on POSIX they stay valid after removal.
+
+    Args:
+        index (dict): Current index.
+    """
+    used = {playlist["store"] for playlist in index["playlists"].values()}
+    for filename in os.listdir(INDEX_DIR):
+        if filename.startswith("transcripts.") and filename not in used:
+            os.remove(index_path(filename))
+
+
+def update_index():
+    """
+    Brings the index in line with the database, reparsing only changed files.
+    The store of a playlist is rewritten only when its videos have changed,
+    and the spellchecker vocabulary only when the index has.
+
+    Returns:
+        dict: Updated index.
+    """
+    from spellcheck import build_vocabulary
+
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    index = read_index()
+    tags_cache = read_tags_cache()
+    version = index["version"] + 1
+    changed = False
+    old_playlists = index["playlists"]
+    old_videos = index["videos"]
+    playlists = {}
+    videos = {}
+
+    for folder in sorted(os.listdir(DATABASE_DIR)):
+        desc_dir = os.path.join(DATABASE_DIR, folder, "desc.json")
+        if not os.path.exists(desc_dir):
+            continue
+        old_playlist = old_playlists.get(folder)
+        if old_playlist is not None and old_playlist["store"] is not None and \
+                not os.path.exists(index_path(old_playlist["store"])):
+            # The store is lost, so every video of the playlist is parsed again.
+            old_playlist = None
+
+        stamp = file_stamp(desc_dir)
+        if old_playlist is not None and old_playlist["stamp"] == stamp:
+            playlist = dict(old_playlist, videos=[])
+        else:
+            playlist = index_playlist(folder, stamp, tags_cache)
+            if old_playlist is not None:
+                playlist["store"] = old_playlist["store"]
+            changed = True
+        playlists[folder] = playlist
+
+        transcripts = {}
+        video_files = sorted(os.listdir(os.path.join(DATABASE_DIR, folder)))
+        video_files.remove("desc.json")
+        for video_file in video_files:
+            key = f"{folder}/{video_file}"
+            stamp = file_stamp(os.path.join(DATABASE_DIR, folder, video_file))
+            if old_playlist is not None and key in old_videos and old_videos[key]["stamp"] == stamp:
+                videos[key] = old_videos[key]
+            else:
+                videos[key], transcripts[key] = index_video(folder, video_file, stamp, tags_cache)
+            playlist["videos"].append(key)
+
+        if transcripts or old_playlist is None or playlist["videos"] != old_playlist["videos"]:
+            write_playlist_store(folder, playlist, videos, transcripts, version)
+            changed = True
+
+    if set(old_playlists) != set(playlists):
+        changed = True
+
+    index["playlists"] = playlists
+    index["videos"] = videos
+    if changed:
+        index["version"] = version
+        write_json_atomic(index_path(INDEX_FILE), index)
+        write_tags_cache(tags_cache, index)
+        remove_unused_stores(index)
+        build_vocabulary(index)
+    return index
+
+
+def get_index():
+    """
+    Gets the index, reloading it only when the file on disk has changed.
+    Builds the index first if it does not exist yet.
+
+    Returns:
+        dict: Current index.
+    """
+    path = index_path(INDEX_FILE)
+    with _lock:
+        if not os.path.exists(path):
+            update_index()
+        mtime_ns = os.stat(path).st_mtime_ns
+        if _loaded["mtime_ns"] != mtime_ns:
+            _loaded["index"] = read_index()
+            _loaded["mtime_ns"] = mtime_ns
+        return _loaded["index"]
+
+
+def tags_match(entry_tags, tags):
+    """
+    Checks that entry tags contain all given keys with matching values.
+
+    Args:
+        entry_tags (dict): Tags of a playlist or a video.
+        tags (dict): Expected tag values.
+
+    Returns:
+        bool: True if all tags match.
+    """
+    return all(key in entry_tags and tags[key] == entry_tags[key] for key in tags)
+
+
+def make_video(entry, playlist):
+    """
+    Creates a Video object from an index entry. The transcript is read from
+    the store on first access.
+
+    Args:
+        entry (dict): Video entry.
+        playlist (Playlist): Parent playlist instance.
+
+    Returns:
+        Video: Video object.
+    """
+    location = entry["transcript"]
+    loader = None
+    if location is not None:
+        loader = lambda: load_transcript(location)
+    return Video.from_index(entry, playlist, loader)
+
+
+def main():
+    """Updates the index from the database."""
+    index = update_index()
+    print(f"Index version {index['version']}: {len(index['playlists'])} playlists, {len(index['videos'])} videos")
+
+
+if __name__ == "__main__":
+    main()
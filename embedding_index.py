@@ -0,0 +1,558 @@
+"""
+This is the code for the consolidated transcript and timestamp embedding indexes.
+
+Embeddings of all transcript passages (see passages), and separately of all
+valid timestamps, are stored pre-normalized in one float32 file that is opened
+with np.memmap, next to a parallel array of row metadata. Both are built once
+from the per-video embedding caches, so queries never merge embeddings.
+
+Rows are laid out in shards: playlists with the same subject, course, season
+and year are contiguous, and rows of one video are contiguous inside them. A
+tag filter selects whole shards or videos of a few shards, so it turns into a
+few row spans of the memory-mapped matrix.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+
+from corpus_index import INDEX_DIR, get_index, index_path, make_video, write_json_atomic
+from media import Playlist
+from passages import PASSAGE_STRIDE, PASSAGE_WINDOW, make_passages
+from vector_index import QUANTIZED_DTYPES, ExactBackend, load_ivf, load_quantized, save_ivf, save_quantized, train_ivf
+from video_cache import cache_path, convert_time, load_cache, timestamps_cache_path, valid_timestamps
+
+META_FILE = "transcript_embeddings.json"
+TIMESTAMP_META_FILE = "timestamp_embeddings.json"
+
+# Playlist tags that make up the shard key, in the order shards are sorted by.
+SHARD_TAGS = ("subject", "course", "season", "year")
+
+# "exact" scores every filtered row, "ivf" only rows of the clusters closest to the query,
+# "float16" and "int8" score a quantized copy and re-score the best rows exactly.
+VECTOR_BACKEND = "exact"
+
+# "chunk" is the first chunk of a passage and "end" the chunk after its last one.
+CHUNK_DTYPE = np.dtype([
+    ("video", np.int32),
+    ("chunk", np.int32),
+    ("end", np.int32),
+    ("start", np.float64),
+    ("year", np.int16),
+])
+
+# "position" is the number of the timestamp among the valid timestamps of its video.
+TIMESTAMP_DTYPE = np.dtype([
+    ("video", np.int32),
+    ("position", np.int32),
+    ("start", np.float64),
+    ("year", np.int16),
+])
+
+# Loaded index and modification time of its metadata file by kind.
+_loaded = {"transcripts": (None, None), "timestamps": (None, None)}
+_lock = threading.Lock()
+
+
+def video_year(tags):
+    """
+    Gets the year of a video as a number.
+
+    Args:
+        tags (dict): Video tags.
+
+    Returns:
+        int: Year or 0 if it is unknown.
+    """
+    return int(tags["year"]) if tags["year"] else 0
+
+
+def shard_key(tags):
+    """
+    Gets the shard of a playlist.
+
+    Args:
+        tags (dict): Playlist tags.
+
+    Returns:
+        tuple: Values of SHARD_TAGS.
+    """
+    return tuple(tags.get(name, "") for name in SHARD_TAGS)
+
+
+def corpus_shards(corpus):
+    """
+    Groups playlists of the corpus index by shard.
+
+    Args:
+        corpus (dict): Corpus index.
+
+    Returns:
+        list: (shard key, playlist entries) pairs sorted by shard key.
+    """
+    shards = {}
+    for playlist_entry in corpus["playlists"].values():
+        shards.setdefault(shard_key(playlist_entry["tags"]), []).append(playlist_entry)
+    return sorted(shards.items())
+
+
+class EmbeddingIndex:
+    """
+    Memory-mapped embeddings of the whole corpus.
+
+    Attrs:
+        kind (str): "transcripts" or "timestamps"
+        version (int): Corpus index version the embeddings were built from
+        build (int): Number of the build, part of the file names
+        matrix (numpy.memmap): Normalized embeddings, one row per passage or timestamp
+        chunks (numpy.ndarray): Row metadata with CHUNK_DTYPE or TIMESTAMP_DTYPE
+        video_ids (list): Video ids, indexed by chunks["video"]
+        video_rows (dict): Video id to [first row, end row]
+        shards (list): Shards with their "key" (values of SHARD_TAGS) and [first row, end row] "rows"
+        backend: Vector search backend, see vector_index
+    """
+
+    def __init__(self, meta):
+        """
+        Opens the index files described by the metadata.
+
+        Args:
+            meta (dict): Contents of META_FILE or TIMESTAMP_META_FILE.
+        """
+        self.kind = meta["kind"]
+        self.version = meta["corpus_version"]
+        self.build = meta["build"]
+        self.shards = meta["shards"]
+        self.video_ids = meta["video_ids"]
+        self.video_rows = dict(zip(meta["video_ids"], meta["video_rows"]))
+        rows, dim = meta["rows"], meta["dim"]
+        if rows == 0:
+            self.matrix = np.zeros((0, dim), dtype=np.float32)
+        else:
+            self.matrix = np.memmap(index_path(meta["matrix_file"]), dtype=np.float32, mode="r", shape=(rows, dim))
+        self.chunks = np.load(index_path(meta["chunks_file"]), mmap_mode="r")
+        self.backend = ExactBackend(self.matrix)
+
+    def row_spans(self, video_ids):
+        """
+        Merges row ranges of videos into as few contiguous spans as possible.
+
+        Args:
+            video_ids (list): Video ids.
+
+        Returns:
+            list: Sorted [first row, end row] spans.
+        """
+        ranges = sorted(self.video_rows[video_id] for video_id in video_ids if video_id in self.video_rows)
+        spans = []
+        for first, end in ranges:
+            if spans and spans[-1][1] == first:
+                spans[-1][1] = end
+            elif first != end:
+                spans.append([first, end])
+        return spans
+
+    def scores(self, query_emb, spans, score_offset=None):
+        """
+        Scores rows of the given spans against a normalized query embedding
+        with the vector search backend.
+
+        Args:
+            query_emb (numpy.ndarray): Normalized query embedding.
+            spans (list): Row spans, see row_spans.
+            score_offset (float, optional): Offset the matches will be selected with;
+                approximate backends re-score every row that may be selected.
+
+        Returns:
+            tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) of the scored rows.
+        """
+        return self.backend.search(query_emb, spans, score_offset)
+
+    def scores_many(self, query_embs, spans, score_offset=None):
+        """
+        Scores rows of the given spans against several normalized query embeddings.
+
+        Args:
+            query_embs (numpy.ndarray): Normalized query embeddings, one row per query.
+            spans (list): Row spans, see row_spans.
+            score_offset (float, optional): Offset the matches will be selected with, see scores.
+
+        Returns:
+            list: (scores, rows) of every query, see scores.
+        """
+        return self.backend.search_many(query_embs, spans, score_offset)
+
+
+def write_embedding_index(kind, meta_file, dtype, blocks, build_backend=None, **extra_meta):
+    """
+    Writes a consolidated index for the current corpus version. Files of every
+    build get new names and the metadata file is replaced last, so readers never
+    see a partially written index.
+
+    Args:
+        kind (str): "transcripts" or "timestamps", also the prefix of the file names.
+        meta_file (str): Name of the metadata file.
+        dtype (numpy.dtype): Row metadata type.
+        blocks (iterable): (video id, shard key, embeddings, row metadata) of every video,
+            in row order, with all videos of a shard together.
+        build_backend (callable): Writes vector backend files of the new EmbeddingIndex
+            before it is published and returns their names.
+        **extra_meta: Additional metadata.
+
+    Returns:
+        dict: Metadata of the written index.
+    """
+    version = get_index()["version"]
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    previous = read_meta(meta_file)
+    build = previous.get("build", 0) + 1 if previous else 1
+    prefix = kind[:-1]
+    matrix_file = f"{prefix}_embeddings.{version}.{build}.f32"
+    chunks_file = f"{prefix}_chunks.{version}.{build}.npy"
+
+    video_ids = []
+    video_rows = []
+    shards = []
+    chunks = []
+    dim = 0
+    rows = 0
+    with open(index_path(f"{matrix_file}.tmp"), "wb") as matrix:
+        for video_id, key, embeddings, video_chunks in blocks:
+            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings.astype(np.float32).tofile(matrix)
+            dim = embeddings.shape[1]
+            video_chunks["video"] = len(video_ids)
+            chunks.append(video_chunks)
+            if not shards or shards[-1]["key"] != list(key):
+                shards.append({"key": list(key), "rows": [rows, rows]})
+            video_ids.append(video_id)
+            video_rows.append([rows, rows + len(embeddings)])
+            rows += len(embeddings)
+            shards[-1]["rows"][1] = rows
+    os.replace(index_path(f"{matrix_file}.tmp"), index_path(matrix_file))
+
+    chunks = np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+    with open(index_path(f"{chunks_file}.tmp"), "wb") as file:
+        np.save(file, chunks)
+    os.replace(index_path(f"{chunks_file}.tmp"), index_path(chunks_file))
+    meta = {
+        "kind": kind,
+        "corpus_version": version,
+        "build": build,
+        **extra_meta,
+        "rows": rows,
+        "dim": dim,
+        "matrix_file": matrix_file,
+        "chunks_file": chunks_file,
+        "video_ids": video_ids,
+        "video_rows": video_rows,
+        "shards": shards,
+    }
+    files = [matrix_file, chunks_file, meta_file]
+    if build_backend is not None and rows != 0:
+        files.extend(build_backend(EmbeddingIndex(meta)))
+    write_json_atomic(index_path(meta_file), meta)
+
+    # Older files may still be mapped by readers; on POSIX they stay valid after removal.
+    for filename in os.listdir(INDEX_DIR):
+        if filename.startswith((f"{prefix}_embeddings.", f"{prefix}_chunks.", f"{prefix}_ivf.",
+                                f"{prefix}_quantized.")) and filename not in files:
+            os.remove(index_path(filename))
+    return meta
+
+
+def transcript_blocks(corpus):
+    """
+    Reads cached passage embeddings of every video in shard order.
+    Videos without an up-to-date cache are skipped until the indexer encodes them.
+
+    Args:
+        corpus (dict): Corpus index.
+
+    Yields:
+        tuple: (video id, shard key, embeddings, row metadata), see write_embedding_index.
+    """
+    for key, playlist_entries in corpus_shards(corpus):
+        for playlist_entry in playlist_entries:
+            playlist = Playlist.from_index(playlist_entry)
+            for video_key in playlist_entry["videos"]:
+                entry = corpus["videos"][video_key]
+                if entry["transcript"] is None:
+                    continue
+                video = make_video(entry, playlist)
+                if not os.path.exists(cache_path(f"{video.id}_embeddings.npy")):
+                    continue
+                embeddings = np.asarray(load_cache(video.id), dtype=np.float32)
+                first, end = make_passages(video.transcript)
+                if len(embeddings) != len(first):
+                    continue
+
+                video_chunks = np.zeros(len(embeddings), dtype=CHUNK_DTYPE)
+                video_chunks["chunk"] = first
+                video_chunks["end"] = end
+                video_chunks["start"] = np.asarray(video.transcript.starts)[first]
+                video_chunks["year"] = video_year(video.tags)
+                yield video.id, key, embeddings, video_chunks
+
+
+def timestamp_blocks(corpus):
+    """
+    Reads cached embeddings of the valid timestamps of every video in shard order.
+    Videos without an up-to-date cache are skipped until the indexer encodes them.
+
+    Args:
+        corpus (dict): Corpus index.
+
+    Yields:
+        tuple: (video id, shard key, embeddings, row metadata), see write_embedding_index.
+    """
+    for key, playlist_entries in corpus_shards(corpus):
+        for playlist_entry in playlist_entries:
+            playlist = Playlist.from_index(playlist_entry)
+            for video_key in playlist_entry["videos"]:
+                video = make_video(corpus["videos"][video_key], playlist)
+                timestamps = valid_timestamps(video.timestamps)
+                if not timestamps or not os.path.exists(timestamps_cache_path(video)):
+                    continue
+                embeddings = np.asarray(np.load(timestamps_cache_path(video)), dtype=np.float32)
+                if len(embeddings) != len(timestamps):
+                    continue
+
+                video_chunks = np.zeros(len(embeddings), dtype=TIMESTAMP_DTYPE)
+                video_chunks["position"] = np.arange(len(embeddings))
+                video_chunks["start"] = [convert_time(timestamp[0]) for timestamp in timestamps]
+                video_chunks["year"] = video_year(video.tags)
+                yield video.id, key, embeddings, video_chunks
+
+
+def build_embedding_index():
+    """
+    Builds the consolidated transcript index from the per-video embedding caches.
+    Nothing is encoded here.
+
+    Returns:
+        dict: Metadata of the built index.
+    """
+    return write_embedding_index(
+        "transcripts", META_FILE, CHUNK_DTYPE, transcript_blocks(get_index()), build_vector_backend,
+        passage_window=PASSAGE_WINDOW, passage_stride=PASSAGE_STRIDE,
+    )
+
+
+def build_timestamp_embedding_index():
+    """
+    Builds the consolidated timestamp index from the per-video embedding caches.
+    Nothing is encoded here.
+
+    Returns:
+        dict: Metadata of the built index.
+    """
+    return write_embedding_index("timestamps", TIMESTAMP_META_FILE, TIMESTAMP_DTYPE, timestamp_blocks(get_index()))
+
+
+def read_meta(meta_file):
+    """
+    Reads the metadata of an index.
+
+    Args:
+        meta_file (str): Name of the metadata file.
+
+    Returns:
+        dict or None: Metadata or None if the index has not been built.
+    """
+    path = index_path(meta_file)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def ivf_path(index):
+    """
+    Gets the path of the IVF index of an embedding index.
+
+    Args:
+        index (EmbeddingIndex): Embedding index.
+
+    Returns:
+        str: Path to the .npz file.
+    """
+    return index_path(f"transcript_ivf.{index.version}.{index.build}.npz")
+
+
+def quantized_path(index, dtype_name):
+    """
+    Gets the path of a quantized copy of an embedding index; the scale is saved next to it.
+
+    Args:
+        index (EmbeddingIndex): Embedding index.
+        dtype_name (str): "float16" or "int8".
+
+    Returns:
+        str: Path to the .npy file.
+    """
+    return index_path(f"transcript_quantized.{index.version}.{index.build}.{dtype_name}.npy")
+
+
+def get_ivf_backend(index):
+    """
+    Gets the IVF backend of an embedding index, training it if it has not been built.
+
+    Args:
+        index (EmbeddingIndex): Embedding index.
+
+    Returns:
+        IVFBackend: IVF backend over the index matrix.
+    """
+    path = ivf_path(index)
+    if not os.path.exists(path):
+        save_ivf(f"{path}.tmp", *train_ivf(index.matrix))
+        os.replace(f"{path}.tmp", path)
+    return load_ivf(path, index.matrix)
+
+
+def get_quantized_backend(index, dtype_name):
+    """
+    Gets a quantized backend of an embedding index, quantizing the matrix if it has not been built.
+
+    Args:
+        index (EmbeddingIndex): Embedding index.
+        dtype_name (str): "float16" or "int8".
+
+    Returns:
+        QuantizedBackend: Quantized backend over the index matrix.
+    """
+    path = quantized_path(index, dtype_name)
+    if not os.path.exists(path):
+        save_quantized(f"{path}.tmp", index.matrix, dtype_name)
+        os.replace(f"{path}.tmp.scale.npy", f"{path}.scale.npy")
+        os.replace(f"{path}.tmp", path)
+    return load_quantized(path, index.matrix)
+
+
+def build_vector_backend(index):
+    """
+    Builds the files of the VECTOR_BACKEND backend of a new transcript index.
+
+    Args:
+        index (EmbeddingIndex): Embedding index that has not been published yet.
+
+    Returns:
+        list: Names of the written files.
+    """
+    if VECTOR_BACKEND == "ivf":
+        get_ivf_backend(index)
+        return [os.path.basename(ivf_path(index))]
+    if VECTOR_BACKEND in QUANTIZED_DTYPES:
+        get_quantized_backend(index, VECTOR_BACKEND)
+        path = os.path.basename(quantized_path(index, VECTOR_BACKEND))
+        return [path, f"{path}.scale.npy"]
+    return []
+
+
+def load_vector_backend(index):
+    """
+    Opens the VECTOR_BACKEND backend of a published transcript index. Indexes
+    built with another backend are searched exactly until the indexer rebuilds them.
+
+    Args:
+        index (EmbeddingIndex): Embedding index.
+
+    Returns:
+        Vector search backend, see vector_index.
+    """
+    if VECTOR_BACKEND == "ivf" and os.path.exists(ivf_path(index)):
+        return load_ivf(ivf_path(index), index.matrix)
+    if VECTOR_BACKEND in QUANTIZED_DTYPES and os.path.exists(quantized_path(index, VECTOR_BACKEND)):
+        return load_quantized(quantized_path(index, VECTOR_BACKEND), index.matrix)
+    return index.backend
+
+
+def load_published(kind, meta_file, compatible):
+    """
+    Gets the last published index of a kind. The metadata file is read again
+    only when it has been replaced; an index that is missing or built with
+    other settings is not loaded, and the previous one is kept.
+
+    Args:
+        kind (str): "transcripts" or "timestamps".
+        meta_file (str): Name of the metadata file.
+        compatible (callable): Checks that metadata can be searched with the current settings.
+
+    Returns:
+        EmbeddingIndex: Current index.
+    """
+    path = index_path(meta_file)
+    with _lock:
+        index, mtime_ns = _loaded[kind]
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != mtime_ns:
+            mtime_ns = os.stat(path).st_mtime_ns
+            meta = read_meta(meta_file)
+            if meta is not None and "build" in meta and compatible(meta) and \
+                    (index is None or (meta["corpus_version"], meta["build"]) != (index.version, index.build)):
+                index = EmbeddingIndex(meta)
+                if kind == "transcripts" and meta["rows"] != 0:
+                    index.backend = load_vector_backend(index)
+            _loaded[kind] = (index, mtime_ns)
+        if index is None:
+            raise FileNotFoundError(f"{meta_file} has not been built, run indexer.py")
+        return index
+
+
+def get_embedding_index():
+    """
+    Gets the last published transcript embedding index.
+
+    Returns:
+        EmbeddingIndex: Current index.
+    """
+    return load_published("transcripts", META_FILE, lambda meta: "shards" in meta and (
+        meta["passage_window"], meta["passage_stride"]) == (PASSAGE_WINDOW, PASSAGE_STRIDE))
+
+
+def get_timestamp_index():
+    """
+    Gets the last published timestamp embedding index.
+    It is small, so it is always searched exactly.
+
+    Returns:
+        EmbeddingIndex: Current index.
+    """
+    return load_published("timestamps", TIMESTAMP_META_FILE, lambda meta: True)
+
+
+def shard_report():
+    """
+    Reports how the tag filters of tests.make_tests map to row spans.
+
+    Returns:
+        list[dict]: Filter, number of videos, spans and rows of both indexes.
+    """
+    from tests import make_tests
+    from video_searcher import global_search
+
+    report = []
+    for playlist_tags, _ in make_tests():
+        videos = global_search(playlist_tags)
+        line = {"playlist_tags": playlist_tags, "videos": len(videos)}
+        for index in (get_embedding_index(), get_timestamp_index()):
+            spans = index.row_spans(video.id for video in videos)
+            line[index.kind] = {"spans": len(spans), "rows": sum(end - first for first, end in spans)}
+        report.append(line)
+    return report
+
+
+def main():
+    """Builds the embedding indexes and prints how the test filters map to row spans."""
+    for meta in (build_embedding_index(), build_timestamp_embedding_index()):
+        print(f"Embedding index of {meta['kind']}: {meta['rows']} rows of {len(meta['video_ids'])} videos "
+              f"in {len(meta['shards'])} shards")
+    for line in shard_report():
+        print(f"{line['playlist_tags']}: {line['videos']} videos, " + ", ".join(
+            f"{kind} {line[kind]['spans']} spans of {line[kind]['rows']} rows" for kind in ("transcripts", "timestamps")
+        ))
+
+
+if __name__ == "__main__":
+    main()
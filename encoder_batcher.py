@@ -0,0 +1,278 @@
+"""
+This is the code for gathering concurrent query encodings into batches.
+
+The sentence model encodes a batch of short queries in about the time of a
+single one on CPU, so encoding queries one by one wastes most of its
+throughput when several users search at once. The batcher puts every query
+into a queue that one scheduler thread serves: it takes all queued queries, up
+to MAX_BATCH, runs one forward pass and hands every caller its own vector.
+
+The size of the previous batch tells how many callers are active: the
+scheduler waits up to MAX_WAIT seconds until the batch is that large, and
+then encodes it right away. So a single user is not delayed (only the first
+query after a burst may wait), and under load the batch grows with the number
+of concurrent callers without waiting out the full MAX_WAIT. Queries that
+arrive during a forward pass are batched either way.
+
+The batcher keeps a histogram of batch sizes and the time queries waited
+before their forward pass started. Run `python encoder_batcher.py` to compare
+batched and direct encoding with 1..32 concurrent clients.
+"""
+
+import sys
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+from instrumentation import METRIC_PREFIX, count
+
+MAX_BATCH = 32
+MAX_WAIT = 0.003
+# Upper bounds of the batch size histogram buckets.
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# Number of recent waits kept for the percentiles.
+WAIT_SAMPLES = 10000
+PERCENTILES = (50, 95, 99)
+
+
+class EncoderBatcher:
+    """
+    Scheduler that encodes concurrently requested texts in batches.
+
+    Attrs:
+        encode (callable): Encodes a list of texts into an array with one row per text
+        max_batch (int): Maximum number of texts in a forward pass
+        max_wait (float): Seconds to wait for a batch to fill under load
+    """
+
+    def __init__(self, encode, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._batch_sizes = [0] * (len(BATCH_BUCKETS) + 1)
+        self._batches = 0
+        self._texts = 0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+
+    def submit(self, text):
+        """
+        Queues a text for the next batch. The scheduler thread is started on first use,
+        so a process forked before any query was encoded gets its own.
+
+        Args:
+            text (str): Text to encode.
+
+        Returns:
+            concurrent.futures.Future: Future of the embedding.
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, daemon=True)
+                    self._thread.start()
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def encode_many(self, texts):
+        """
+        Encodes texts, sharing forward passes with concurrent callers.
+
+        Args:
+            texts (list[str]): Texts to encode.
+
+        Returns:
+            numpy.ndarray: Embeddings, one row per text.
+        """
+        futures = [self.submit(text) for text in texts]
+        return np.array([future.result() for future in futures])
+
+    def collect(self, expected):
+        """
+        Takes the next batch from the queue, waiting for the first text.
+
+        Args:
+            expected (int): Batch size to wait for up to max_wait; queued texts
+                are taken without waiting up to max_batch.
+
+        Returns:
+            list: (text, future, submit time) of every text of the batch.
+        """
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter() if len(batch) < expected else 0.0
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        """Encodes batches from the queue forever."""
+        expected = 1
+        while True:
+            batch = self.collect(expected)
+            start_time = time.perf_counter()
+            try:
+                embeddings = self.encode([text for text, _, _ in batch])
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future, _), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+            self.record(batch, start_time)
+            expected = len(batch)
+
+    def record(self, batch, start_time):
+        """
+        Adds a batch to the statistics.
+
+        Args:
+            batch (list): Encoded batch, see collect.
+            start_time (float): Start of its forward pass.
+        """
+        with self._lock:
+            self._batches += 1
+            self._texts += len(batch)
+            for i, bound in enumerate(BATCH_BUCKETS):
+                if len(batch) <= bound:
+                    self._batch_sizes[i] += 1
+                    break
+            else:
+                self._batch_sizes[-1] += 1
+            self._waits.extend(start_time - submitted for _, _, submitted in batch)
+        count("encoder_batches")
+
+    def stats(self):
+        """
+        Reports the batch sizes and the added latency.
+
+        Returns:
+            dict: Numbers of batches and texts, mean batch size, batch size histogram
+                by upper bound, and percentiles of the wait before the forward pass
+                in milliseconds over the last WAIT_SAMPLES texts.
+        """
+        with self._lock:
+            waits = np.array(self._waits) * 1000
+            sizes = dict(zip([str(bound) for bound in BATCH_BUCKETS] + ["+Inf"], self._batch_sizes))
+            stats = {
+                "batches": self._batches,
+                "texts": self._texts,
+                "mean_batch": round(self._texts / self._batches, 2) if self._batches else 0.0,
+                "batch_sizes": sizes,
+                "wait_ms": {f"p{q}": round(float(np.percentile(waits, q)), 3) if len(waits) else 0.0
+                            for q in PERCENTILES},
+            }
+        stats["wait_ms"]["mean"] = round(float(waits.mean()), 3) if len(waits) else 0.0
+        return stats
+
+
+def prometheus_text(stats):
+    """
+    Exports batcher statistics in the Prometheus text format.
+
+    Args:
+        stats (dict): Statistics, see EncoderBatcher.stats.
+
+    Returns:
+        str: Batch size histogram and wait quantiles.
+    """
+    metric = f"{METRIC_PREFIX}_encoder_batch_size"
+    lines = [
+        f"# HELP {metric} Queries encoded in one forward pass.",
+        f"# TYPE {metric} histogram",
+    ]
+    cumulative = 0
+    for bound, value in stats["batch_sizes"].items():
+        cumulative += value
+        lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f"{metric}_sum {stats['texts']}")
+    lines.append(f"{metric}_count {stats['batches']}")
+    metric = f"{METRIC_PREFIX}_encoder_wait_seconds"
+    lines.append(f"# HELP {metric} Time queries wait for their forward pass.")
+    lines.append(f"# TYPE {metric} summary")
+    for q in PERCENTILES:
+        lines.append(f'{metric}{{quantile="{q / 100}"}} {stats["wait_ms"][f"p{q}"] / 1000}')
+    return "\n".join(lines) + "\n"
+
+
+def load_report(clients_counts=(1, 2, 4, 8, 16, 32), per_client=50):
+    """
+    Encodes distinct queries from concurrent clients, once directly with a
+    forward pass per query and once through a batcher.
+
+    Args:
+        clients_counts (tuple): Numbers of concurrent clients.
+        per_client (int): Queries sent by every client.
+
+    Returns:
+        list[dict]: Clients, mode, queries per second, latency percentiles in
+            milliseconds and batcher statistics.
+    """
+    from tests import make_tests
+    from spellcheck import load_vocabulary
+    from text_processor import get_model
+
+    model = get_model()
+    vocabulary = load_vocabulary()
+    words = sorted(vocabulary, key=vocabulary.get, reverse=True)
+    queries = [query.lower() for _, query in make_tests()]
+    model.encode(queries, convert_to_tensor=False)
+
+    report = []
+    for clients in clients_counts:
+        texts = [f"{queries[i % len(queries)]} {words[i % len(words)]}" for i in range(clients * per_client)]
+        batcher = EncoderBatcher(lambda batch: model.encode(batch, convert_to_tensor=False))
+        encoders = {
+            "direct": lambda text: model.encode(text, convert_to_tensor=False),
+            "batched": lambda text: batcher.encode_many([text])[0],
+        }
+        for mode, encode in encoders.items():
+            latencies = []
+
+            def send(text):
+                start_time = time.perf_counter()
+                encode(text)
+                latencies.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                list(executor.map(send, texts))
+            elapsed = time.perf_counter() - start_time
+            latencies = np.asarray(latencies) * 1000
+            line = {
+                "clients": clients,
+                "mode": mode,
+                "qps": round(len(texts) / elapsed, 1),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+            }
+            if mode == "batched":
+                line["stats"] = batcher.stats()
+            report.append(line)
+    return report
+
+
+def main():
+    """Prints the comparison of direct and batched encoding under load."""
+    per_client = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    for line in load_report(per_client=per_client):
+        batches = ""
+        if "stats" in line:
+            stats = line["stats"]
+            batches = f", mean batch {stats['mean_batch']}, wait p50 {stats['wait_ms']['p50']} ms " \
+                      f"p99 {stats['wait_ms']['p99']} ms"
+        print(f"{line['clients']:>3} clients {line['mode']:<8} {line['qps']:>8.1f} queries/s, "
+              f"p50 {line['p50_ms']:.2f} ms, p99 {line['p99_ms']:.2f} ms{batches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+This is the code for a local fake of the YouTube Data API and the transcript service.
+
+It serves a generated channel with paginated playlists and playlist items,
+fails a share of the requests with 503 to exercise retries and counts the
+requests. Run `python fake_youtube.py [database dir]` to ingest the fake
+channel into a separate database with youtube_video_extractor.update.
+"""
+
+import sys
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from youtube_transcript_api import FetchedTranscript, FetchedTranscriptSnippet, TranscriptsDisabled
+
+CHANNEL_ID = "fake-channel"
+API_KEY = "fake-key"
+
+
+def make_channel(playlists=3, videos=120):
+    """
+    Generates playlists and videos of a fake channel.
+    Every seventh video has no transcript.
+
+    Args:
+        playlists (int): Number of playlists.
+        videos (int): Number of videos in every playlist.
+
+    Returns:
+        tuple: (playlists (list), items (dict): playlist id to items, transcripts (dict): video id to raw data)
+    """
+    playlist_list = []
+    items = {}
+    transcripts = {}
+    for p in range(playlists):
+        playlist_id = f"PLfake{p}"
+        playlist_list.append({
+            "kind": "youtube#playlist",
+            "id": playlist_id,
+            "snippet": {"title": f"Плейлист {p}", "description": f"Матанализ. 1 курс. Осень 2024. Плейлист {p}"},
+        })
+        items[playlist_id] = []
+        for v in range(videos):
+            video_id = f"vid{p}x{v}"
+            items[playlist_id].append({
+                "kind": "youtube#playlistItem",
+                "snippet": {
+                    "title": f"Лекция {v}",
+                    "description": "00:00 Введение\n05:00 Определения",
+                    "playlistId": playlist_id,
+                    "resourceId": {"videoId": video_id},
+                },
+                "contentDetails": {"videoId": video_id},
+            })
+            if v % 7 != 6:
+                transcripts[video_id] = [
+                    {"text": f"фрагмент {i} лекции {v}", "start": i * 5.0, "duration": 5.0} for i in range(10)
+                ]
+    return playlist_list, items, transcripts
+
+
+class FakeYouTubeHandler(BaseHTTPRequestHandler):
+    """
+    Serves /youtube/v3/playlists, /youtube/v3/playlistItems and /transcripts/<video id>.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def page(self, items, params):
+        """Returns one page of items and the token of the next page."""
+        size = min(int(params.get("maxResults", ["5"])[0]), 50)
+        first = int(params.get("pageToken", ["0"])[0])
+        response = {"items": items[first:first + size]}
+        if first + size < len(items):
+            response["nextPageToken"] = str(first + size)
+        return response
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        with server.lock:
+            server.requests += 1
+            fail = server.fail_every and server.requests % server.fail_every == 0
+        if fail:
+            self.send_json(503, {"error": {"code": 503, "message": "Backend Error"}})
+            return
+
+        if url.path.endswith("/playlists"):
+            self.send_json(200, self.page(server.playlists, params))
+        elif url.path.endswith("/playlistItems"):
+            self.send_json(200, self.page(server.items.get(params["playlistId"][0], []), params))
+        elif url.path.startswith("/transcripts/"):
+            video_id = url.path.rsplit("/", 1)[1]
+            if video_id in server.transcripts:
+                self.send_json(200, server.transcripts[video_id])
+            else:
+                self.send_json(404, {"error": "transcripts disabled"})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+
+class FakeYouTubeServer(ThreadingHTTPServer):
+    """
+    Fake YouTube server running in a background thread.
+
+    Attrs:
+        playlists, items, transcripts: Fake channel, see make_channel
+        fail_every (int): Every n-th request fails with 503, 0 disables failures
+        requests (int): Number of received requests
+    """
+    daemon_threads = True
+
+    def __init__(self, playlists=3, videos=120, fail_every=0):
+        super().__init__(("127.0.0.1", 0), FakeYouTubeHandler)
+        self.playlists, self.items, self.transcripts = make_channel(playlists, videos)
+        self.fail_every = fail_every
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeTranscriptApi:
+    """
+    Transcript client with the fetch interface of YouTubeTranscriptApi that talks to the fake server.
+
+    Attrs:
+        url (str): Fake server url
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def fetch(self, video_id, languages=("en",)):
+        try:
+            with urllib.request.urlopen(f"{self.url}/transcripts/{video_id}", timeout=10) as response:
+                data = json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                raise TranscriptsDisabled(video_id)
+            raise
+        snippets = [FetchedTranscriptSnippet(**snippet) for snippet in data]
+        return FetchedTranscript(snippets, video_id, "Russian", languages[0], True)
+
+
+def build_clients(url):
+    """
+    Builds the YouTube API client and the transcript client for the fake server.
+
+    Args:
+        url (str): Fake server url.
+
+    Returns:
+        tuple: (youtube, ytt_api), as returned by youtube_video_extractor.authentification.
+    """
+    import googleapiclient.discovery
+
+    youtube = googleapiclient.discovery.build(
+        "youtube", "v3", developerKey=API_KEY, client_options={"api_endpoint": url}, static_discovery=True,
+    )
+    return youtube, FakeTranscriptApi(url)
+
+
+def main():
+    """Ingests the fake channel into the given database directory."""
+    import os
+    import time
+    import youtube_video_extractor
+
+    database_dir = sys.argv[1] if len(sys.argv) > 1 else "fake_database"
+    os.makedirs(database_dir, exist_ok=True)
+    youtube_video_extractor.DATABASE_DIR = database_dir
+    youtube_video_extractor.BACKOFF_BASE = 0.01
+    youtube_video_extractor.rate_limiter.rates = {}
+
+    server = FakeYouTubeServer(fail_every=10).start()
+    youtube, ytt_api = build_clients(server.url)
+    start_time = time.perf_counter()
+    youtube_video_extractor.update(youtube, ytt_api, channel_id=CHANNEL_ID)
+    print(f"Ingested in {time.perf_counter() - start_time:.2f} seconds, {server.requests} requests")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+This is the code for checking that modules used on tag-only paths import quickly
+and do not load the language models.
+
+Run `python import_budget.py`; it exits with code 1 if a budget is exceeded.
+"""
+
+import sys
+import json
+import subprocess
+
+# Import time budgets in milliseconds, measured in a fresh interpreter.
+BUDGETS_MS = {
+    "media": 20,
+    "corpus_index": 30,
+    "video_searcher": 30,
+    "text_processor": 200,
+}
+
+HEAVY_MODULES = ["spacy", "sentence_transformers", "torch", "spellchecker", "requests"]
+
+MEASURE_CODE = """
+import sys, json, time
+start = time.perf_counter()
+import {module}
+elapsed = (time.perf_counter() - start) * 1000
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"ms": elapsed, "heavy": heavy}}))
+"""
+
+
+def measure_import(module, repeats=3):
+    """
+    Measures import time of a module in fresh interpreters.
+
+    Args:
+        module (str): Module name.
+        repeats (int): Number of measurements; the fastest one is kept.
+
+    Returns:
+        dict: {"ms": import time in milliseconds, "heavy": heavy modules loaded by the import}
+    """
+    best = None
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE_CODE.format(module=module, heavy=HEAVY_MODULES)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output)
+        if best is None or result["ms"] < best["ms"]:
+            best = result
+    return best
+
+
+def main():
+    """Measures every module from BUDGETS_MS and reports the ones over budget."""
+    failed = False
+    for module, budget in BUDGETS_MS.items():
+        result = measure_import(module)
+        ok = result["ms"] <= budget and not result["heavy"]
+        failed = failed or not ok
+        status = "ok" if ok else "OVER BUDGET"
+        print(f"{module}: {result['ms']:.1f} ms (budget {budget} ms) {status}")
+        if result["heavy"]:
+            print(f"  loads heavy modules: {', '.join(result['heavy'])}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+This is the code for the offline indexer that prepares everything queries need.
+
+Run `python indexer.py [workers]` after updating the database. It updates the
+corpus index, encodes only new or changed transcripts and timestamps (in large
+batches shared by all videos, optionally across several worker processes),
+lemmatizes only new or changed transcripts the same way, and rebuilds the
+consolidated embedding indexes, the lexical indexes and the spellchecker vocabulary.
+Queries never encode corpus text themselves.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import numpy as np
+
+from corpus_index import get_index, make_video, update_index
+from embedding_index import build_embedding_index, build_timestamp_embedding_index
+from lexical_index import build_timestamp_index, build_transcript_index, read_lemmas, write_lemmas
+from media import Playlist
+from passages import passage_texts
+from spellcheck import build_vocabulary
+from text_processor import clean_text, get_model, lemmatize_many
+from video_cache import CACHE_DIR, timestamps_cache_path, valid_timestamps
+
+MANIFEST_FILE = "manifest.json"
+BATCH_SIZE = 256
+
+
+def manifest_path():
+    """
+    Builds the path of the cache manifest.
+
+    Returns:
+        str: Path to the manifest.
+    """
+    return os.path.join(CACHE_DIR, MANIFEST_FILE)
+
+
+def read_manifest():
+    """
+    Reads the cache manifest.
+
+    Returns:
+        dict: Video id to content hash of its cached transcript embeddings.
+    """
+    if not os.path.exists(manifest_path()):
+        return {}
+    with open(manifest_path(), "r") as file:
+        return json.load(file)
+
+
+def write_manifest(manifest):
+    """
+    Writes the cache manifest atomically.
+
+    Args:
+        manifest (dict): Video id to content hash.
+    """
+    with open(f"{manifest_path()}.tmp", "w") as file:
+        json.dump(manifest, file)
+    os.replace(f"{manifest_path()}.tmp", manifest_path())
+
+
+def save_embeddings(path, embeddings):
+    """
+    Saves embeddings so that readers never see a partially written file.
+
+    Args:
+        path (str): Path to the .npy file.
+        embeddings (numpy.ndarray): Embeddings.
+    """
+    with open(f"{path}.tmp", "wb") as file:
+        np.save(file, embeddings)
+    os.replace(f"{path}.tmp", path)
+
+
+def content_hash(texts):
+    """
+    Hashes the texts that are going to be encoded.
+
+    Args:
+        texts (list[str]): Cleaned texts.
+
+    Returns:
+        str: Hex digest.
+    """
+    return hashlib.sha1("\n".join(texts).encode("utf-8")).hexdigest()
+
+
+def encode_texts(texts, workers=1):
+    """
+    Encodes texts in large batches, across several processes if asked to.
+
+    Args:
+        texts (list[str]): Cleaned texts.
+        workers (int): Number of worker processes.
+
+    Returns:
+        numpy.ndarray: Embeddings, one row per text.
+    """
+    model = get_model()
+    if workers <= 1:
+        return model.encode(texts, batch_size=BATCH_SIZE, convert_to_tensor=False, show_progress_bar=True)
+    pool = model.start_multi_process_pool(target_devices=["cpu"] * workers)
+    try:
+        return model.encode_multi_process(texts, pool, batch_size=BATCH_SIZE)
+    finally:
+        model.stop_multi_process_pool(pool)
+
+
+def corpus_videos():
+    """
+    Creates Video objects for every video of the corpus index.
+
+    Returns:
+        list: Video objects.
+    """
+    corpus = get_index()
+    videos = []
+    for playlist_entry in corpus["playlists"].values():
+        playlist = Playlist.from_index(playlist_entry)
+        for key in playlist_entry["videos"]:
+            videos.append(make_video(corpus["videos"][key], playlist))
+    return videos
+
+
+def encode_groups(groups, workers):
+    """
+    Encodes texts of several videos together and splits the embeddings back.
+
+    Args:
+        groups (list): (path, texts) pairs.
+        workers (int): Number of worker processes.
+
+    Returns:
+        list: (path, embeddings) pairs.
+    """
+    texts = [text for _, group_texts in groups for text in group_texts]
+    if not texts:
+        return []
+    embeddings = encode_texts(texts, workers)
+    result = []
+    first = 0
+    for path, group_texts in groups:
+        result.append((path, embeddings[first:first + len(group_texts)]))
+        first += len(group_texts)
+    return result
+
+
+def update_transcript_embeddings(videos, workers=1):
+    """
+    Encodes transcript passages whose cached embeddings are missing or outdated.
+
+    Args:
+        videos (list): Video objects.
+        workers (int): Number of worker processes.
+
+    Returns:
+        int: Number of encoded videos.
+    """
+    manifest = read_manifest()
+    groups = []
+    hashes = {}
+    for video in videos:
+        if video.transcript is None:
+            continue
+        texts = [clean_text(text) for text in passage_texts(video.transcript)]
+        hashes[video.id] = content_hash(texts)
+        path = os.path.join(CACHE_DIR, f"{video.id}_embeddings.npy")
+        if manifest.get(video.id) != hashes[video.id] or not os.path.exists(path):
+            groups.append((path, texts))
+            manifest.pop(video.id, None)
+
+    for path, embeddings in encode_groups(groups, workers):
+        save_embeddings(path, embeddings)
+    manifest.update(hashes)
+    write_manifest(manifest)
+    return len(groups)
+
+
+def update_timestamp_embeddings(videos, workers=1):
+    """
+    Encodes timestamps of videos whose description has no cached embeddings.
+
+    Args:
+        videos (list): Video objects.
+        workers (int): Number of worker processes.
+
+    Returns:
+        int: Number of encoded videos.
+    """
+    groups = []
+    for video in videos:
+        timestamps = valid_timestamps(video.timestamps)
+        if timestamps and not os.path.exists(timestamps_cache_path(video)):
+            groups.append((timestamps_cache_path(video), [clean_text(chunk[1]) for chunk in timestamps]))
+
+    for path, embeddings in encode_groups(groups, workers):
+        video_id = os.path.basename(path).split("_timestamps_")[0]
+        for filename in os.listdir(CACHE_DIR):
+            if filename.startswith(f"{video_id}_timestamps_"):
+                os.remove(os.path.join(CACHE_DIR, filename))
+        save_embeddings(path, embeddings)
+    return len(groups)
+
+
+def update_lemmas(videos, workers=1):
+    """
+    Lemmatizes transcripts whose cached lemmas are missing or outdated,
+    all of them in one pass of the pipeline.
+
+    Args:
+        videos (list): Video objects.
+        workers (int): Number of worker processes.
+
+    Returns:
+        int: Number of lemmatized videos.
+    """
+    groups = []
+    for video in videos:
+        if video.transcript is None:
+            continue
+        texts = [clean_text(chunk) for chunk in video.transcript.text]
+        text_hash = content_hash(texts)
+        if read_lemmas(video.id, text_hash) is None:
+            groups.append((video.id, text_hash, texts))
+    if not groups:
+        return 0
+
+    lemmas = lemmatize_many([text for _, _, texts in groups for text in texts], workers)
+    first = 0
+    for video_id, text_hash, texts in groups:
+        write_lemmas(video_id, text_hash, lemmas[first:first + len(texts)])
+        first += len(texts)
+    return len(groups)
+
+
+def build_indexes(workers=1):
+    """
+    Updates all indexes and caches of the corpus in the current directory.
+
+    Args:
+        workers (int): Number of worker processes encoding and lemmatizing.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    start_time = time.perf_counter()
+
+    corpus = update_index()
+    print(f"Corpus index version {corpus['version']}: {len(corpus['videos'])} videos")
+    videos = corpus_videos()
+    print(f"Encoded transcripts: {update_transcript_embeddings(videos, workers)}")
+    print(f"Encoded timestamps: {update_timestamp_embeddings(videos, workers)}")
+    meta = build_embedding_index()
+    print(f"Embedding index: {meta['rows']} passages of {len(meta['video_ids'])} videos in {len(meta['shards'])} shards")
+    meta = build_timestamp_embedding_index()
+    print(f"Timestamp embedding index: {meta['rows']} timestamps of {len(meta['video_ids'])} videos")
+    print(f"Lemmatized transcripts: {update_lemmas(videos, workers)}")
+    meta = build_transcript_index()
+    print(f"Lexical index of transcripts: {len(meta['terms'])} terms, {meta['postings']} postings")
+    meta = build_timestamp_index(videos)
+    print(f"Lexical index of timestamps: {meta['rows']} timestamps, {len(meta['terms'])} terms")
+    print(f"Vocabulary: {len(build_vocabulary())} words")
+    print(f"Finished in {time.perf_counter() - start_time:.1f} seconds")
+
+
+def main():
+    """Updates all indexes and caches."""
+    build_indexes(int(sys.argv[1]) if len(sys.argv) > 1 else 1)
+
+
+if __name__ == "__main__":
+    main()
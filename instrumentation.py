@@ -0,0 +1,226 @@
+"""
+This is the code for measuring how long the stages of a query take.
+
+A stage is measured for three independent consumers:
+    collect_timings() gathers the stage times of one query in the current thread;
+    the metrics registry keeps histograms of all stages and event counters,
+        exported as JSON or Prometheus text, once enable() has been called;
+    collect_trace() records nested spans of one query in the current thread.
+When none of them is active, a stage only checks two flags and runs the code.
+"""
+
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in seconds.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "exambot"
+
+
+class _Local(threading.local):
+    """Per-thread collectors; class defaults keep lookups cheap when nothing is collected."""
+    timings = None
+    trace = None
+
+
+_local = _Local()
+_state = {"enabled": False}
+_lock = threading.Lock()
+# Stage name to [count, sum of seconds, count per bucket].
+_timers = {}
+_counters = {}
+
+
+def enable():
+    """Starts collecting metrics of all threads."""
+    _state["enabled"] = True
+
+
+def disable():
+    """Stops collecting metrics; collected values are kept."""
+    _state["enabled"] = False
+
+
+def reset():
+    """Removes all collected metrics."""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collects stage timings of the current thread.
+
+    Yields:
+        dict: Stage name to elapsed seconds, filled in while the block runs.
+    """
+    timings = {}
+    previous = _local.timings
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def collect_trace():
+    """
+    Records the spans of the stages run by the current thread.
+
+    Yields:
+        list[dict]: Spans with "name", "depth", "start_ms" from the start of the
+            block and "duration_ms", in the order the stages started.
+    """
+    spans = []
+    previous = _local.trace
+    _local.trace = {"spans": spans, "depth": 0, "start": time.perf_counter()}
+    try:
+        yield spans
+    finally:
+        _local.trace = previous
+
+
+def record_time(name, seconds):
+    """
+    Adds a measurement to the histogram of a stage.
+
+    Args:
+        name (str): Stage name.
+        seconds (float): Elapsed time.
+    """
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [0, 0.0, [0] * len(BUCKETS)]
+        timer[0] += 1
+        timer[1] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                timer[2][i] += 1
+                break
+
+
+def count(name, value=1):
+    """
+    Increments an event counter. Does nothing while metrics are disabled.
+
+    Args:
+        name (str): Counter name.
+        value (int): Increment.
+    """
+    if not _state["enabled"]:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+class stage:
+    """
+    Measures a stage of a query. Does nothing unless timings, metrics or a trace are collected.
+
+    Args:
+        name (str): Stage name.
+    """
+    __slots__ = ("name", "start", "timings", "trace", "span")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _local.timings
+        self.trace = _local.trace
+        if self.timings is None and self.trace is None and not _state["enabled"]:
+            self.start = None
+            return self
+        self.start = time.perf_counter()
+        if self.trace is not None:
+            self.span = {"name": self.name, "depth": self.trace["depth"],
+                         "start_ms": round((self.start - self.trace["start"]) * 1000, 3)}
+            self.trace["spans"].append(self.span)
+            self.trace["depth"] += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is None:
+            return False
+        elapsed = time.perf_counter() - self.start
+        if self.timings is not None:
+            self.timings[self.name] = self.timings.get(self.name, 0.0) + elapsed
+        if self.trace is not None:
+            self.span["duration_ms"] = round(elapsed * 1000, 3)
+            self.trace["depth"] -= 1
+        if _state["enabled"]:
+            record_time(self.name, elapsed)
+        return False
+
+
+def timed(name):
+    """
+    Decorates a function so that every call is measured as a stage.
+
+    Args:
+        name (str): Stage name.
+
+    Returns:
+        callable: Decorator.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"] and _local.timings is None and _local.trace is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    Exports the collected metrics.
+
+    Returns:
+        dict: {"stages": {name: {"count", "sum_s", "mean_ms", "buckets"}}, "counters": {name: value}}
+    """
+    with _lock:
+        stages = {}
+        for name, (calls, total, buckets) in sorted(_timers.items()):
+            stages[name] = {
+                "count": calls,
+                "sum_s": round(total, 6),
+                "mean_ms": round(total / calls * 1000, 3),
+                "buckets": {str(bound): value for bound, value in zip(BUCKETS, buckets)},
+            }
+        return {"stages": stages, "counters": dict(sorted(_counters.items()))}
+
+
+def prometheus_text():
+    """
+    Exports the collected metrics in the Prometheus text format.
+
+    Returns:
+        str: Stage histograms and event counters.
+    """
+    data = snapshot()
+    lines = [
+        f"# HELP {METRIC_PREFIX}_stage_seconds Time spent in query pipeline stages.",
+        f"# TYPE {METRIC_PREFIX}_stage_seconds histogram",
+    ]
+    for name, timer in data["stages"].items():
+        cumulative = 0
+        for bound, value in timer["buckets"].items():
+            cumulative += value
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {timer["count"]}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{name}"}} {timer["sum_s"]}')
+        lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{name}"}} {timer["count"]}')
+    lines.append(f"# HELP {METRIC_PREFIX}_events_total Counted events.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_events_total counter")
+    for name, value in data["counters"].items():
+        lines.append(f'{METRIC_PREFIX}_events_total{{event="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,136 @@
+"""
+This is the code for lemmatizing queries and corpus text.
+
+Only lemmas are used, so the spaCy pipeline runs without the parser and the
+named entity recognizer. The lemmatizer component is not run either: the
+Russian lemmatizer looks every word up in pymorphy, and the lemma depends only
+on the word, its part of speech and its morphology, which the morphologizer
+has already set. So lemmas are memoized per (word, part of speech, morphology)
+and the lemmatizer rule is called only for combinations not seen before.
+
+Corpus text goes through nlp.pipe in batches, across several processes if
+asked to. Run `python lemmatizer.py [workers]` to measure the throughput on all
+transcripts.
+"""
+
+import sys
+import time
+
+SPACY_MODEL = "ru_core_news_md"
+# Components that lemmas do not depend on; the lemmatizer is applied through the memo.
+DISABLED_PIPES = ["parser", "ner", "lemmatizer"]
+PIPE_BATCH_SIZE = 256
+# The memo is cleared when it grows over this many entries.
+MEMO_SIZE = 500000
+
+_memo = {}
+_memo_stats = {"hits": 0, "misses": 0}
+
+
+def load_pipeline():
+    """
+    Loads the spaCy pipeline with the components lemmas do not need disabled.
+    Disabled components stay loaded, so the lemmatizer rule is still available.
+
+    Returns:
+        spacy.language.Language: Loaded pipeline.
+    """
+    import spacy
+
+    return spacy.load(SPACY_MODEL, disable=DISABLED_PIPES)
+
+
+def doc_lemmas(doc, lemmatizer):
+    """
+    Lemmatizes the tokens of a processed document with the memo.
+
+    Args:
+        doc (spacy.tokens.Doc): Document processed by the trimmed pipeline.
+        lemmatizer: Lemmatizer component of the pipeline.
+
+    Returns:
+        str: Lemmas separated by spaces.
+    """
+    lemmas = []
+    for token in doc:
+        # The attribute ruler sets lemmas of some tokens itself.
+        if token.lemma != 0:
+            lemmas.append(token.lemma_)
+            continue
+        key = (token.text, token.pos, token.morph.key)
+        lemma = _memo.get(key)
+        if lemma is None:
+            _memo_stats["misses"] += 1
+            lemma = lemmatizer.lemmatize(token)[0]
+            if len(_memo) >= MEMO_SIZE:
+                _memo.clear()
+            _memo[key] = lemma
+        else:
+            _memo_stats["hits"] += 1
+        lemmas.append(lemma)
+    return ' '.join(lemmas)
+
+
+def lemmatize_texts(nlp, texts, workers=1, batch_size=PIPE_BATCH_SIZE):
+    """
+    Lemmatizes texts with nlp.pipe.
+
+    Args:
+        nlp (spacy.language.Language): Pipeline loaded with load_pipeline.
+        texts (list[str]): Input texts.
+        workers (int): Number of processes running the pipeline.
+        batch_size (int): Number of texts sent to the pipeline at once.
+
+    Returns:
+        list[str]: Lemmatized texts.
+    """
+    lemmatizer = nlp.get_pipe("lemmatizer")
+    docs = nlp.pipe(texts, batch_size=batch_size, n_process=workers)
+    return [doc_lemmas(doc, lemmatizer) for doc in docs]
+
+
+def memo_stats():
+    """
+    Reports the lemma memo counters.
+
+    Returns:
+        dict: Size, hits, misses and hit rate.
+    """
+    lookups = _memo_stats["hits"] + _memo_stats["misses"]
+    return {
+        "size": len(_memo),
+        "maxsize": MEMO_SIZE,
+        "hits": _memo_stats["hits"],
+        "misses": _memo_stats["misses"],
+        "hit_rate": round(_memo_stats["hits"] / lookups, 4) if lookups else 0.0,
+    }
+
+
+def clear_memo():
+    """Removes all memoized lemmas, keeping the counters."""
+    _memo.clear()
+
+
+def main():
+    """Lemmatizes all transcripts of the corpus and prints the throughput."""
+    from corpus_index import get_index, read_transcript
+    from text_processor import clean_text, get_nlp
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    texts = []
+    for video in get_index()["videos"].values():
+        if video["transcript"] is not None:
+            texts.extend(clean_text(chunk["text"]) for chunk in read_transcript(video["transcript"]))
+
+    start_time = time.perf_counter()
+    nlp = get_nlp()
+    print(f"Pipeline {', '.join(nlp.pipe_names)} loaded in {time.perf_counter() - start_time:.1f} seconds")
+    start_time = time.perf_counter()
+    lemmatize_texts(nlp, texts, workers)
+    elapsed = time.perf_counter() - start_time
+    print(f"{len(texts)} chunks in {elapsed:.1f} seconds with {workers} processes, {len(texts) / elapsed:.0f} chunks/s")
+    print(f"Lemma memo: {memo_stats()}")
+
+
+if __name__ == "__main__":
+    main()
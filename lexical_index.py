@@ -0,0 +1,429 @@
+"""
+This is the code for the lexical (BM25) index over lemmatized transcript passages and timestamps.
+
+The sentence model barely tells exact technical terms apart ("DFS",
+"доминаторов"), while a term index finds them precisely and only touches the
+rows that share a lemma with the query. For every term the index keeps its
+rows and their BM25 term weights, sorted by row, like a CSR matrix.
+
+Rows are the rows of the transcript and timestamp embedding indexes, so
+lexical candidates are scored densely without any mapping. Both indexes are
+built offline by the indexer from lemmas of transcript chunks that are cached
+per video; queries never lemmatize corpus text.
+
+Run `python lexical_index.py` to compare hybrid and dense search on the queries
+of tests.make_tests.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from collections import Counter
+import numpy as np
+
+from corpus_index import INDEX_DIR, get_index, index_path, write_json_atomic
+from vector_index import rows_in_spans
+from video_cache import cache_path, valid_timestamps
+
+KINDS = ("transcripts", "timestamps")
+
+# BM25 term frequency saturation and length normalization.
+K1 = 1.2
+B = 0.75
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Kind to (LexicalIndex or None, mtime_ns of the metadata file it was loaded after).
+_loaded = {kind: (None, None) for kind in KINDS}
+_lock = threading.Lock()
+
+
+def tokenize(text):
+    """
+    Splits lemmatized text into terms.
+
+    Args:
+        text (str): Lemmatized text.
+
+    Returns:
+        list[str]: Lowercased words and numbers.
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def meta_path(kind):
+    """
+    Builds the path of the metadata of a lexical index.
+
+    Args:
+        kind (str): "transcripts" or "timestamps".
+
+    Returns:
+        str: Path to the metadata file.
+    """
+    return index_path(f"lexical_{kind}.json")
+
+
+def lemmas_path(video_id):
+    """
+    Builds the path of the cached transcript lemmas of a video.
+
+    Args:
+        video_id (str): Unique video id.
+
+    Returns:
+        str: Path to the cache file.
+    """
+    return cache_path(f"{video_id}_lemmas.json")
+
+
+def read_lemmas(video_id, text_hash):
+    """
+    Reads the cached lemmas of the transcript chunks of a video.
+
+    Args:
+        video_id (str): Unique video id.
+        text_hash (str): Hash of the cleaned chunk texts the lemmas must belong to,
+            or None to accept any cached lemmas.
+
+    Returns:
+        list[str] or None: Lemmatized chunks or None if they are missing or outdated.
+    """
+    path = lemmas_path(video_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        cached = json.load(file)
+    if text_hash is not None and cached["hash"] != text_hash:
+        return None
+    return cached["lemmas"]
+
+
+def write_lemmas(video_id, text_hash, lemmas):
+    """
+    Caches the lemmas of the transcript chunks of a video.
+
+    Args:
+        video_id (str): Unique video id.
+        text_hash (str): Hash of the cleaned chunk texts.
+        lemmas (list[str]): Lemmatized chunks.
+    """
+    write_json_atomic(lemmas_path(video_id), {"hash": text_hash, "lemmas": lemmas})
+
+
+def build_postings(documents):
+    """
+    Builds BM25 postings of tokenized rows.
+
+    Args:
+        documents (list[list[str]]): Terms of every row.
+
+    Returns:
+        tuple: (terms (list[str]), offsets, rows, weights, idf), see LexicalIndex.
+    """
+    term_ids = {}
+    posting_terms = []
+    posting_rows = []
+    posting_counts = []
+    lengths = np.zeros(len(documents), dtype=np.float64)
+    for row, tokens in enumerate(documents):
+        lengths[row] = len(tokens)
+        for term, tf in Counter(tokens).items():
+            posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+            posting_rows.append(row)
+            posting_counts.append(tf)
+
+    posting_terms = np.asarray(posting_terms, dtype=np.int64)
+    posting_rows = np.asarray(posting_rows, dtype=np.int64)
+    tf = np.asarray(posting_counts, dtype=np.float64)
+    avg_length = lengths.mean() if len(documents) and lengths.any() else 1.0
+    weights = tf * (K1 + 1) / (tf + K1 * (1 - B + B * lengths[posting_rows] / avg_length))
+
+    # Rows are appended in increasing order, so a stable sort by term keeps them sorted inside a term.
+    order = np.argsort(posting_terms, kind="stable")
+    df = np.bincount(posting_terms, minlength=len(term_ids))
+    offsets = np.concatenate([[0], np.cumsum(df)]).astype(np.int64)
+    idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+    return (list(term_ids), offsets, posting_rows[order].astype(np.int32),
+            weights[order].astype(np.float32), idf.astype(np.float32))
+
+
+def save_lexical_index(kind, documents, video_ids, video_rows, embedding_index):
+    """
+    Builds a lexical index and publishes it like embedding_index.write_embedding_index:
+    the postings of every build get a new name and the metadata file is replaced
+    last, so readers never see a partially written index.
+
+    Args:
+        kind (str): "transcripts" or "timestamps".
+        documents (list[list[str]]): Terms of every row.
+        video_ids (list): Video ids in the order of their rows.
+        video_rows (list): [first row, end row] of every video.
+        embedding_index (EmbeddingIndex): Embedding index whose rows are indexed.
+
+    Returns:
+        dict: Metadata of the built index.
+    """
+    version = get_index()["version"]
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    previous = read_meta(kind)
+    build = previous.get("build", 0) + 1 if previous else 1
+    postings_file = f"lexical_{kind}.{version}.{build}.npz"
+    terms, offsets, rows, weights, idf = build_postings(documents)
+    with open(index_path(f"{postings_file}.tmp"), "wb") as file:
+        np.savez(file, offsets=offsets, rows=rows, weights=weights, idf=idf)
+    os.replace(index_path(f"{postings_file}.tmp"), index_path(postings_file))
+    meta = {
+        "corpus_version": version,
+        "build": build,
+        "embedding_build": [embedding_index.version, embedding_index.build],
+        "kind": kind,
+        "rows": len(documents),
+        "postings": len(rows),
+        "postings_file": postings_file,
+        "terms": terms,
+        "video_ids": video_ids,
+        "video_rows": video_rows,
+    }
+    write_json_atomic(meta_path(kind), meta)
+
+    # Readers load the postings into memory, so older files can be removed at once.
+    for filename in os.listdir(INDEX_DIR):
+        if filename.startswith(f"lexical_{kind}.") and filename not in (postings_file, os.path.basename(meta_path(kind))):
+            os.remove(index_path(filename))
+    return meta
+
+
+def build_transcript_index():
+    """
+    Builds the lexical index of transcript passages with the rows of the
+    embedding index; a passage has the terms of all its chunks. Videos without
+    up-to-date cached lemmas get empty rows until the indexer lemmatizes them.
+
+    Returns:
+        dict: Metadata of the built index.
+    """
+    from embedding_index import get_embedding_index
+
+    embedding_index = get_embedding_index()
+    documents = [[] for _ in range(len(embedding_index.matrix))]
+    video_rows = []
+    for video_id in embedding_index.video_ids:
+        first_row, end_row = embedding_index.video_rows[video_id]
+        video_rows.append([first_row, end_row])
+        lemmas = read_lemmas(video_id, None)
+        passages = embedding_index.chunks[first_row:end_row]
+        if lemmas is None or end_row == first_row or len(lemmas) != passages["end"][-1]:
+            continue
+        chunk_terms = [tokenize(lemma) for lemma in lemmas]
+        for row, passage in enumerate(passages, first_row):
+            documents[row] = [term for terms in chunk_terms[passage["chunk"]:passage["end"]] for term in terms]
+    return save_lexical_index("transcripts", documents, list(embedding_index.video_ids), video_rows, embedding_index)
+
+
+def build_timestamp_index(videos):
+    """
+    Builds the lexical index of timestamps with the rows of the timestamp
+    embedding index, lemmatizing all descriptions in one pass of the pipeline.
+
+    Args:
+        videos (list): Video objects, including all videos of the timestamp embedding index.
+
+    Returns:
+        dict: Metadata of the built index.
+    """
+    from embedding_index import get_timestamp_index
+    from text_processor import clean_text, lemmatize_many
+
+    embedding_index = get_timestamp_index()
+    videos_by_id = {video.id: video for video in videos}
+    texts = []
+    for video_id in embedding_index.video_ids:
+        texts.extend(clean_text(chunk[1]) for chunk in valid_timestamps(videos_by_id[video_id].timestamps))
+    documents = [tokenize(lemma) for lemma in lemmatize_many(texts)]
+    video_rows = [embedding_index.video_rows[video_id] for video_id in embedding_index.video_ids]
+    return save_lexical_index("timestamps", documents, list(embedding_index.video_ids), video_rows, embedding_index)
+
+
+class LexicalIndex:
+    """
+    BM25 postings of one kind of chunks.
+
+    Attrs:
+        version (int): Corpus index version the index was built from
+        build (int): Build number of the index
+        embedding_build (tuple): (corpus version, build) of the embedding index whose rows are indexed
+        kind (str): "transcripts" or "timestamps"
+        rows_count (int): Number of indexed rows
+        terms (dict): Term to term number
+        offsets (numpy.ndarray): Start of the postings of each term, plus the end
+        rows (numpy.ndarray): Rows of all postings, sorted by term and row
+        weights (numpy.ndarray): BM25 term weight of every posting, without idf
+        idf (numpy.ndarray): Inverse document frequency of every term
+        video_ids (list): Video ids in the order of their rows
+        video_rows (dict): Video id to [first row, end row]
+    """
+
+    def __init__(self, meta):
+        """
+        Loads the index files described by the metadata.
+
+        Args:
+            meta (dict): Contents of the metadata file.
+        """
+        self.version = meta["corpus_version"]
+        self.build = meta["build"]
+        self.embedding_build = tuple(meta["embedding_build"])
+        self.kind = meta["kind"]
+        self.rows_count = meta["rows"]
+        self.terms = {term: i for i, term in enumerate(meta["terms"])}
+        self.video_ids = meta["video_ids"]
+        self.video_rows = dict(zip(meta["video_ids"], meta["video_rows"]))
+        data = np.load(index_path(meta["postings_file"]))
+        self.offsets = data["offsets"]
+        self.rows = data["rows"]
+        self.weights = data["weights"]
+        self.idf = data["idf"]
+
+    def scores(self, terms, spans=None):
+        """
+        Computes BM25 scores of the rows that contain any of the terms.
+
+        Args:
+            terms (list[str]): Query terms.
+            spans (list, optional): Sorted [first row, end row] spans to limit the rows to.
+
+        Returns:
+            tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) with rows in increasing order.
+        """
+        term_ids = sorted({self.terms[term] for term in terms if term in self.terms})
+        if not term_ids:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([self.rows[self.offsets[term]:self.offsets[term + 1]] for term in term_ids])
+        weights = np.concatenate([
+            self.weights[self.offsets[term]:self.offsets[term + 1]] * self.idf[term] for term in term_ids
+        ])
+        if spans is not None:
+            mask = rows_in_spans(rows, spans) if spans else np.zeros(len(rows), dtype=bool)
+            rows, weights = rows[mask], weights[mask]
+        rows, inverse = np.unique(rows, return_inverse=True)
+        return np.bincount(inverse, weights=weights, minlength=len(rows)).astype(np.float32), rows.astype(np.int64)
+
+    def top(self, terms, spans=None, limit=None):
+        """
+        Finds the rows with the best BM25 scores.
+
+        Args:
+            terms (list[str]): Query terms.
+            spans (list, optional): Sorted [first row, end row] spans to limit the rows to.
+            limit (int, optional): Maximum number of rows.
+
+        Returns:
+            tuple: (scores, rows) of the best rows, with rows in increasing order.
+        """
+        scores, rows = self.scores(terms, spans)
+        if limit is not None and len(rows) > limit:
+            kept = np.sort(np.argpartition(-scores, limit - 1)[:limit])
+            scores, rows = scores[kept], rows[kept]
+        return scores, rows
+
+
+def read_meta(kind):
+    """
+    Reads the metadata of a lexical index.
+
+    Args:
+        kind (str): "transcripts" or "timestamps".
+
+    Returns:
+        dict or None: Metadata or None if the index has not been built.
+    """
+    if not os.path.exists(meta_path(kind)):
+        return None
+    with open(meta_path(kind), "r") as file:
+        return json.load(file)
+
+
+def get_lexical_index(kind):
+    """
+    Gets the last published lexical index of a kind, like
+    embedding_index.load_published: the metadata file is read again only when
+    it has been replaced. The index is never built here, as that needs the
+    language pipeline; callers check embedding_build against their embedding index.
+
+    Args:
+        kind (str): "transcripts" or "timestamps".
+
+    Returns:
+        LexicalIndex or None: Current index or None if none has been published.
+    """
+    path = meta_path(kind)
+    with _lock:
+        index, mtime_ns = _loaded[kind]
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != mtime_ns:
+            mtime_ns = os.stat(path).st_mtime_ns
+            meta = read_meta(kind)
+            if meta is not None and "build" in meta and \
+                    (index is None or (meta["corpus_version"], meta["build"]) != (index.version, index.build)):
+                index = LexicalIndex(meta)
+            _loaded[kind] = (index, mtime_ns)
+        return index
+
+
+def hybrid_report(repeats=5):
+    """
+    Compares hybrid and dense search on the queries of tests.make_tests:
+    latency of the search after the query is encoded, the number of scored
+    chunks, and recall of the dense results among the hybrid ones.
+
+    Args:
+        repeats (int): Number of measured runs of every query.
+
+    Returns:
+        list[dict]: One report line per query and search kind.
+    """
+    from tests import make_tests
+    from embedding_index import get_embedding_index, get_timestamp_index
+    from spellcheck import correct_query
+    from text_processor import encode_query, index_search
+    from video_searcher import global_search
+
+    indexes = {"transcripts": get_embedding_index(), "timestamps": get_timestamp_index()}
+    report = []
+    for playlist_tags, query in make_tests():
+        videos = global_search(playlist_tags)
+        corrected = correct_query(query)
+        encode_query(corrected)
+        for kind, index in indexes.items():
+            line = {"query": query, "kind": kind}
+            found = {}
+            for retrieval in ("dense", "hybrid"):
+                start_time = time.perf_counter()
+                for _ in range(repeats):
+                    results = index_search(corrected, index, videos, retrieval=retrieval)
+                line[f"{retrieval}_ms"] = (time.perf_counter() - start_time) * 1000 / repeats
+                found[retrieval] = {(result["video_id"], result["start"]) for result in results or []}
+                line[f"{retrieval}_results"] = len(found[retrieval])
+            line["recall"] = len(found["dense"] & found["hybrid"]) / len(found["dense"]) if found["dense"] else 1.0
+            report.append(line)
+    return report
+
+
+def main():
+    """Prints the hybrid and dense search comparison on the current indexes."""
+    for kind in KINDS:
+        index = get_lexical_index(kind)
+        if index is None:
+            print(f"No lexical index of {kind}; run indexer.py first")
+            return
+        print(f"{kind}: {index.rows_count} rows, {len(index.terms)} terms, {len(index.rows)} postings")
+    for line in hybrid_report():
+        print(f"{line['kind']:<12} {line['query']:<30} dense {line['dense_ms']:7.2f} ms "
+              f"({line['dense_results']}), hybrid {line['hybrid_ms']:7.2f} ms ({line['hybrid_results']}), "
+              f"recall {line['recall']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
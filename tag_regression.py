@@ -0,0 +1,89 @@
+"""
+This is the code for the regression check of tag and timestamp extraction.
+
+The snapshot fixture holds the tags and timestamps of every playlist and video
+of database/ as they were extracted by the original parser. Run
+`python tag_regression.py` to compare the current parser with it (exits with
+code 1 on differences) or `python tag_regression.py --update` to rewrite it.
+"""
+
+import os
+import sys
+import json
+
+from corpus_index import DATABASE_DIR, text_hash
+from media import make_playlist_tags, make_video_tags
+
+SNAPSHOT_FILE = os.path.join("fixtures", "tag_snapshot.json")
+
+
+def extract_all():
+    """
+    Extracts tags of every playlist and video of the database.
+
+    Returns:
+        dict: {"playlists": {folder: {...}}, "videos": {folder/file: {...}}}
+    """
+    snapshot = {"playlists": {}, "videos": {}}
+    for folder in sorted(os.listdir(DATABASE_DIR)):
+        if not os.path.exists(os.path.join(DATABASE_DIR, folder, "desc.json")):
+            continue
+        with open(os.path.join(DATABASE_DIR, folder, "desc.json"), "r") as file:
+            title = json.load(file)["snippet"]["title"]
+        snapshot["playlists"][folder] = {"hash": text_hash(title), "tags": make_playlist_tags(title)}
+        for video_file in sorted(os.listdir(os.path.join(DATABASE_DIR, folder))):
+            if video_file == "desc.json":
+                continue
+            with open(os.path.join(DATABASE_DIR, folder, video_file), "r") as file:
+                desc = json.load(file)["snippet"]["description"]
+            tags, timestamps = make_video_tags(desc)
+            snapshot["videos"][f"{folder}/{video_file}"] = {
+                "hash": text_hash(desc), "tags": tags, "timestamps": timestamps,
+            }
+    return snapshot
+
+
+def compare(expected, actual):
+    """
+    Lists differences between two snapshots.
+
+    Args:
+        expected (dict): Stored snapshot.
+        actual (dict): Snapshot of the current parser.
+
+    Returns:
+        list[str]: Description of every difference.
+    """
+    differences = []
+    for kind in ("playlists", "videos"):
+        for key in sorted(set(expected[kind]) | set(actual[kind])):
+            if key not in expected[kind] or key not in actual[kind]:
+                differences.append(f"{kind} {key}: missing in {'snapshot' if key not in expected[kind] else 'database'}")
+            elif expected[kind][key]["hash"] != actual[kind][key]["hash"]:
+                differences.append(f"{kind} {key}: text has changed since the snapshot")
+            elif expected[kind][key] != actual[kind][key]:
+                differences.append(f"{kind} {key}: expected {expected[kind][key]}, got {actual[kind][key]}")
+    return differences
+
+
+def main():
+    """Compares the current parser with the snapshot or rewrites the snapshot."""
+    actual = extract_all()
+    if "--update" in sys.argv:
+        os.makedirs(os.path.dirname(SNAPSHOT_FILE), exist_ok=True)
+        with open(SNAPSHOT_FILE, "w") as file:
+            json.dump(actual, file, ensure_ascii=False, indent=1, sort_keys=True)
+        print(f"Snapshot of {len(actual['playlists'])} playlists and {len(actual['videos'])} videos written")
+        return
+
+    with open(SNAPSHOT_FILE, "r") as file:
+        expected = json.load(file)
+    differences = compare(expected, actual)
+    for difference in differences:
+        print(difference)
+    print(f"{len(actual['playlists'])} playlists, {len(actual['videos'])} videos, {len(differences)} differences")
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
 """
 This is a file with tests.
+
+make_tests gives the sample queries the reports and benchmarks run. The test_
+functions check behaviour that broke before; run them with `python -m pytest tests.py`.
 """
 
+import os
+import time
+import signal
+
 def make_tests():
     test_list = []
     test_list.append([
@@ -33,4 +40,221 @@ def make_tests():
         "Парокомпактности"
     ])
 
-    return test_list
\ No newline at end of file
+    return test_list
+
+
+def worker_pid(request):
+    """Handler of the worker pool tests: answers with the pid of the worker."""
+    time.sleep(request.get("sleep", 0))
+    return os.getpid()
+
+
+def test_idle_worker_restart(monkeypatch):
+    """A worker killed while idle is forked again and the next request is answered."""
+    import worker_pool
+
+    monkeypatch.setattr(worker_pool, "preload", lambda: None)
+    with worker_pool.WorkerPool({"pid": worker_pid}, workers=1) as pool:
+        first = pool.run("pid", {})
+        os.kill(first, signal.SIGKILL)
+        task = pool.submit("pid", {})
+        assert list(pool.results(task, timeout=5)) not in ([], [first])
+
+
+def test_busy_worker_death(monkeypatch):
+    """The request of a worker killed while busy fails at once and frees its slot."""
+    import pytest
+    import worker_pool
+
+    monkeypatch.setattr(worker_pool, "preload", lambda: None)
+    with worker_pool.WorkerPool({"pid": worker_pid}, workers=1, max_pending=1) as pool:
+        pid = pool.run("pid", {})
+        task = pool.submit("pid", {"sleep": 30})
+        time.sleep(0.2)
+        os.kill(pid, signal.SIGKILL)
+        with pytest.raises(worker_pool.WorkerError):
+            list(pool.results(task, timeout=5))
+        assert pool.run("pid", {}) != pid
+
+
+def small_corpus(tmp_path, monkeypatch, scale):
+    """
+    Indexes scale copies of one playlist of database/ in tmp_path and changes
+    into it. The copies reuse the caches of indexer.py and must not be encoded.
+    """
+    import shutil
+    import pytest
+    import benchmark
+    import corpus_index
+    import embedding_index
+    import indexer
+    import lexical_index
+
+    if not os.path.exists(os.path.join("cache", indexer.MANIFEST_FILE)):
+        pytest.skip("run indexer.py first")
+    folder = "PL4_hYwCyhAvYc_ayUOr5csVj-3eNXQwfj"
+    shutil.copytree(os.path.join("database", folder), tmp_path / "original" / folder)
+    benchmark.make_synthetic_corpus(scale, tmp_path / "corpus", database_dir=tmp_path / "original", cache_dir=os.path.abspath("cache"))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the synthetic corpus must not be encoded")
+
+    monkeypatch.chdir(tmp_path / "corpus")
+    # Indexes loaded from another directory may have the same versions and builds.
+    monkeypatch.setattr(corpus_index, "_loaded", {"mtime_ns": None, "index": None})
+    monkeypatch.setattr(embedding_index, "_loaded", {kind: (None, None) for kind in embedding_index._loaded})
+    monkeypatch.setattr(lexical_index, "_loaded", {kind: (None, None) for kind in lexical_index.KINDS})
+    monkeypatch.setattr(indexer, "encode_texts", fail)
+    monkeypatch.setattr(indexer, "lemmatize_many", fail)
+    indexer.build_indexes()
+
+
+def test_benchmark_scale(tmp_path, monkeypatch):
+    """A --scale corpus is indexed from the linked caches of the originals without encoding anything."""
+    from embedding_index import META_FILE, read_meta
+
+    small_corpus(tmp_path, monkeypatch, 2)
+    video_ids = read_meta(META_FILE)["video_ids"]
+    originals = [video_id for video_id in video_ids if not video_id.endswith("_1")]
+    assert originals and sorted(video_ids) == sorted(originals + [f"{video_id}_1" for video_id in originals])
+
+
+def test_lexical_index_rebuild(tmp_path, monkeypatch):
+    """A rebuilt lexical index is published under a new name and loaded by the next query."""
+    from embedding_index import build_embedding_index, get_embedding_index
+    from lexical_index import build_transcript_index, get_lexical_index
+
+    small_corpus(tmp_path, monkeypatch, 1)
+    first = get_lexical_index("transcripts")
+    assert first.embedding_build == (get_embedding_index().version, get_embedding_index().build)
+    build_embedding_index()
+    build_transcript_index()
+    second = get_lexical_index("transcripts")
+    assert second.build == first.build + 1
+    assert second.embedding_build == (get_embedding_index().version, get_embedding_index().build) != first.embedding_build
+    assert sorted(name for name in os.listdir("index") if name.startswith("lexical_transcripts.")) == [
+        f"lexical_transcripts.{second.version}.{second.build}.npz", "lexical_transcripts.json",
+    ]
+
+
+def test_stale_result_cache(tmp_path, monkeypatch):
+    """Cached results are dropped when an index is rebuilt without a new corpus version."""
+    import embedding_index
+    import query_cache
+    from lexical_index import build_transcript_index
+    from text_processor import results_version, transcript_search
+    from video_searcher import global_search
+
+    small_corpus(tmp_path, monkeypatch, 1)
+    query_cache.clear_caches()
+    videos = global_search({})
+    first = transcript_search("граф", videos, 0.3, verbose=False)
+    version = query_cache.results.version
+    assert version == results_version() and len(query_cache.results.entries) == 1
+
+    build_transcript_index()
+    assert results_version() != version
+    assert transcript_search("граф", videos, 0.3, verbose=False) == first
+    assert query_cache.results.version == results_version() != version
+
+    version = results_version()
+    monkeypatch.setattr(embedding_index, "VECTOR_BACKEND", "int8")
+    embedding_index.build_embedding_index()
+    assert results_version()[0] == version[0] and results_version()[-1] != version[-1]
+
+
+def test_vocabulary_only_loaded(tmp_path, monkeypatch):
+    """Queries load the vocabulary the indexer built, even a stale one, and never read transcripts."""
+    import spellcheck
+    from corpus_index import get_index, index_path, write_json_atomic
+
+    small_corpus(tmp_path, monkeypatch, 1)
+    words = spellcheck.load_vocabulary()
+    assert words
+
+    def fail(*args, **kwargs):
+        raise AssertionError("queries must not read transcripts")
+
+    monkeypatch.setattr(spellcheck, "read_transcript", fail)
+    write_json_atomic(index_path(spellcheck.VOCABULARY_FILE), {"corpus_version": get_index()["version"] - 1, "words": words})
+    assert spellcheck.load_vocabulary() == words
+    os.remove(index_path(spellcheck.VOCABULARY_FILE))
+    assert spellcheck.load_vocabulary() == {}
+
+
+def test_batch_matches_single_queries(tmp_path, monkeypatch):
+    """A batch of queries finds the same results as the queries one by one."""
+    import query_cache
+    from text_processor import timestamp_search, timestamp_search_batch, transcript_search, transcript_search_batch
+    from video_searcher import global_search
+
+    small_corpus(tmp_path, monkeypatch, 1)
+    query_cache.clear_caches()
+    videos = global_search({})
+    queries = [query for _, query in make_tests()]
+    assert transcript_search_batch(queries, videos, 0.3) == [
+        transcript_search(query, videos, 0.3, verbose=False) for query in queries
+    ]
+    assert timestamp_search_batch(queries, videos, 0.3) == [
+        timestamp_search(query, videos, 0.3, verbose=False) for query in queries
+    ]
+
+
+def test_quantized_recall(tmp_path):
+    """Quantized search re-scores every row an exact search selects within the score offset."""
+    import numpy as np
+    from vector_index import ExactBackend, load_quantized, save_quantized
+
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((3000, 64)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = rng.standard_normal((20, 64)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    spans = [[0, 1000], [1500, 3000]]
+    exact = ExactBackend(matrix)
+    for dtype_name in ("float16", "int8"):
+        save_quantized(str(tmp_path / f"{dtype_name}.npy"), matrix, dtype_name)
+        backend = load_quantized(str(tmp_path / f"{dtype_name}.npy"), matrix)
+        for score_offset in (0.2, 0.6):
+            exact_results = exact.search_many(queries, spans)
+            quantized_results = backend.search_many(queries, spans, score_offset)
+            for query, (scores, rows), (found_scores, found) in zip(queries, exact_results, quantized_results):
+                assert set(rows[scores >= scores.max() - score_offset].tolist()) <= set(found.tolist())
+                assert np.allclose(found_scores, matrix[found] @ query)
+
+
+def test_malformed_post_bodies():
+    """POST bodies that are not a JSON object or have malformed fields get 400, not 500."""
+    import json
+    import threading
+    import urllib.error
+    import urllib.request
+    from http.server import ThreadingHTTPServer
+    from search_server import SearchHandler
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SearchHandler)
+    server.pool = None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for path, body in (
+            ("/search", [1, 2]),
+            ("/search", "query"),
+            ("/search", {"query": ["a"]}),
+            ("/search", {"query": "граф", "precision": "x"}),
+            ("/search", {"query": "граф", "mode": "everything"}),
+            ("/search_batch", {"queries": "граф"}),
+            ("/search_stream", {"query": "граф", "playlist_tags": []}),
+        ):
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{server.server_port}{path}", data=json.dumps(body).encode("utf-8"), method="POST",
+            )
+            try:
+                urllib.request.urlopen(request, timeout=5)
+            except urllib.error.HTTPError as error:
+                assert error.code == 400, (path, body)
+                assert "error" in json.load(error)
+            else:
+                raise AssertionError(f"{path} {body} was accepted")
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -2,49 +2,141 @@
 This is the main code for processing texts using language processing and transformers.
 """
 
-import json
+import asyncio
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
-import spacy
-from spellchecker import SpellChecker
-import requests
 
 import os
 
+import query_cache
+from corpus_index import get_index
+from instrumentation import stage, timed
+from embedding_index import get_embedding_index, get_timestamp_index
+from encoder_batcher import EncoderBatcher
+from lemmatizer import doc_lemmas, lemmatize_texts, load_pipeline
+from lexical_index import get_lexical_index, tokenize
+from spellcheck import correct_query, yandex_spellcheck
+from video_cache import CACHE_DIR, valid_timestamps
+
+# "dense" scores every filtered chunk with the sentence model. "hybrid" also
+# uses the lexical index: only transcript passages that share lemmas with the query
+# are scored densely, and BM25 scores are fused into the similarities of both
+# transcripts and timestamps. Queries without lexical matches are searched densely.
+RETRIEVAL = "dense"
+# Number of transcript passages with the best BM25 scores that are scored densely.
+LEXICAL_CANDIDATES = 2000
+# Share of the distance to a full match that the best BM25 score adds to the similarity.
+LEXICAL_WEIGHT = 0.3
+
+# Whether concurrent query encodings share forward passes, see encoder_batcher.
+ENCODER_BATCHING = True
+
+_models = {}
+_models_lock = threading.Lock()
+
+def load_once(name, loader):
+    """
+    Loads a heavy resource on first use and keeps it for later calls.
+
+    Args:
+        name (str): Resource name.
+        loader (callable): Function that loads the resource.
+
+    Returns:
+        Loaded resource.
+    """
+
+    if name not in _models:
+        with _models_lock:
+            if name not in _models:
+                _models[name] = loader()
+    return _models[name]
 
-nlp = spacy.load('ru_core_news_md')
+def get_nlp():
+    """
+    Gets the spaCy pipeline for Russian, trimmed to what lemmas need.
+
+    Returns:
+        spacy.language.Language: Loaded pipeline, see lemmatizer.load_pipeline.
+    """
+
+    return load_once("nlp", load_pipeline)
+
+def get_spell():
+    """
+    Gets the Russian spellchecker extended with the transcript vocabulary.
 
-spell = SpellChecker(language='ru')
+    Returns:
+        spellchecker.SpellChecker: Loaded spellchecker.
+    """
+
+    def load():
+        from spellchecker import SpellChecker
+        from spellcheck import DOMAIN_WEIGHT, load_vocabulary
+        spell = SpellChecker(language='ru', distance=1)
+        vocabulary = load_vocabulary()
+        spell.word_frequency.load_json({word: count * DOMAIN_WEIGHT for word, count in vocabulary.items()})
+        return spell
+    return load_once("spell", load)
+
+def get_model():
+    """
+    Gets the sentence transformer used for embeddings.
+
+    Returns:
+        sentence_transformers.SentenceTransformer: Loaded model.
+    """
+
+    def load():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+    return load_once("model", load)
+
+def get_encoder():
+    """
+    Gets the scheduler that batches concurrent query encodings.
+
+    Returns:
+        EncoderBatcher: Batcher in front of the sentence transformer.
+    """
 
-model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+    return load_once("encoder", lambda: EncoderBatcher(
+        lambda texts: get_model().encode(texts, convert_to_tensor=False)
+    ))
 
-def yandex_spellcheck(text):
+def encode_texts(texts):
     """
-    Corrects spelling in Russian text using Yandex spellchecker.
+    Encodes query texts with the sentence transformer, through the batcher
+    if ENCODER_BATCHING is on.
 
     Args:
-        text (str): Input text to be spellchecked.
+        texts (list[str]): Normalized queries.
+
+    Returns:
+        numpy.ndarray: Embeddings, one row per text.
+    """
+
+    if ENCODER_BATCHING:
+        return get_encoder().encode_many(texts)
+    return get_model().encode(texts, convert_to_tensor=False)
+
+def encoder_stats():
+    """
+    Reports the batch sizes and the added latency of the query encoder batcher.
 
     Returns:
-        str: Corrected text.
-    """
-
-    url = "https://speller.yandex.net/services/spellservice.json/checkText"
-    params = {
-        "text": text,
-        "lang": "ru"
-    }
-    response = requests.get(url, params=params)
-    corrections = response.json()
-    corrected_text = text
-
-    for error in sorted(corrections, key=lambda x: x['pos'], reverse=True):
-        start = error['pos']
-        end = start + error['len']
-        if error['s']:
-            correction = error['s'][0]
-            corrected_text = corrected_text[:start] + correction + corrected_text[end:]
-    return corrected_text
+        dict or None: Statistics (see EncoderBatcher.stats) or None if no query was batched.
+    """
+
+    encoder = _models.get("encoder")
+    return encoder.stats() if encoder is not None else None
+
+def warmup():
+    """Loads all models in advance, so the first query does not wait for them."""
+
+    get_nlp()
+    get_spell()
+    get_model()
 
 def clean_text(text):
     """
@@ -59,6 +151,7 @@ def clean_text(text):
 
     return ' '.join(text.lower().split())
 
+@timed("lemmatize")
 def lemmatize(text):
     """
     Lemmatizes Russian text.
@@ -70,120 +163,224 @@ def lemmatize(text):
         str: Lemmatized text.
     """
 
-    doc = nlp(text)
-    return ' '.join([token.lemma_ for token in doc])
+    nlp = get_nlp()
+    return doc_lemmas(nlp(text), nlp.get_pipe("lemmatizer"))
 
-def cache_embeddings(video_id, chunks):
+@timed("lemmatize")
+def lemmatize_many(texts, workers=1):
     """
-    Caches embeddings for text chunks if not already cached.
+    Lemmatizes several Russian texts in one pass of the pipeline.
 
     Args:
-        video_id (str): Unique video id.
-        chunks (list): List of text chunks.
+        texts (list[str]): Input texts.
+        workers (int): Number of processes running the pipeline, for corpus text.
+
+    Returns:
+        list[str]: Lemmatized texts.
     """
 
-    if os.path.exists(f"cache/{video_id}_embeddings.npy"):
-        return
+    return lemmatize_texts(get_nlp(), texts, workers)
 
-    texts = [clean_text(chunk) for chunk in chunks]
-    embeddings = model.encode(texts, convert_to_tensor=False, show_progress_bar=True)
-    np.save(f"cache/{video_id}_embeddings.npy", embeddings)
+def normalize_query(query):
+    """
+    Lemmatizes and cleans a query. Results are cached.
+
+    Args:
+        query (str): User search query.
 
-def load_cache(video_id):
+    Returns:
+        str: Normalized query.
     """
-    Loads cached embeddings for a video.
+
+    normalized = query_cache.queries.get(query)
+    if normalized is None:
+        normalized = clean_text(lemmatize(query.lower()))
+        query_cache.queries.put(query, normalized)
+    return normalized
+
+def encode_query(query):
+    """
+    Lemmatizes a query and computes its normalized embedding.
+    Embeddings are cached by the normalized query and must not be modified.
 
     Args:
-        video_id (str): Unique video id.
+        query (str): User search query.
 
     Returns:
-        numpy.ndarray: Loaded embeddings array.
+        numpy.ndarray: Normalized query embedding.
+    """
+
+    query_clean = normalize_query(query)
+    query_emb_norm = query_cache.embeddings.get(query_clean)
+    if query_emb_norm is None:
+        with stage("encode"):
+            query_emb = encode_texts([query_clean])[0]
+        query_emb_norm = query_emb / np.linalg.norm(query_emb)
+        query_emb_norm.setflags(write=False)
+        query_cache.embeddings.put(query_clean, query_emb_norm)
+    return query_emb_norm
+
+def encode_queries(queries):
     """
+    Lemmatizes queries and computes their normalized embeddings,
+    handling all uncached queries in one batch.
 
-    embeddings = np.load(f"cache/{video_id}_embeddings.npy")
-    return embeddings
+    Args:
+        queries (list[str]): User search queries.
 
-def convert_time(time):
+    Returns:
+        numpy.ndarray: Normalized query embeddings, one row per query.
     """
-    Converts time string 'HH:MM:SS' to seconds format.
+
+    query_cleans = [query_cache.queries.get(query) for query in queries]
+    misses = [i for i, query_clean in enumerate(query_cleans) if query_clean is None]
+    for i, query_lemma in zip(misses, lemmatize_many([queries[i].lower() for i in misses])):
+        query_cleans[i] = clean_text(query_lemma)
+        query_cache.queries.put(queries[i], query_cleans[i])
+
+    query_embs_norm = [query_cache.embeddings.get(query_clean) for query_clean in query_cleans]
+    misses = [i for i, query_emb_norm in enumerate(query_embs_norm) if query_emb_norm is None]
+    if misses:
+        with stage("encode"):
+            query_embs = encode_texts([query_cleans[i] for i in misses])
+        query_embs = query_embs / np.linalg.norm(query_embs, axis=1, keepdims=True)
+        query_embs.setflags(write=False)
+        for i, query_emb_norm in zip(misses, query_embs):
+            query_embs_norm[i] = query_emb_norm
+            query_cache.embeddings.put(query_cleans[i], query_emb_norm)
+    return np.array(query_embs_norm)
+
+def query_terms(query):
+    """
+    Gets the lexical index terms of a query.
 
     Args:
-        time (str): Time string.
+        query (str): User search query.
 
     Returns:
-        int: Total seconds.
+        list[str]: Lemmatized query terms.
     """
 
-    hrs, mins, secs = map(int, time.split(':'))
-    return hrs * 3600 + mins * 60 + secs
+    return tokenize(normalize_query(query))
 
-def merge_timestamps(videos):
+def fuse_scores(scores, lexical_scores, weight=LEXICAL_WEIGHT):
     """
-    Merges embeddings and chunks from videos' timestamp data.
+    Raises the similarities of chunks that share terms with the query.
+    The best BM25 match gets the given share of its distance to 1 added,
+    so fused scores stay comparable with the thresholds.
 
     Args:
-        videos (list): List of videos with timestamps.
+        scores (numpy.ndarray): Dense similarity scores.
+        lexical_scores (numpy.ndarray): BM25 scores of the same chunks.
+        weight (float): Share added to the best BM25 match.
 
     Returns:
-        tuple: (embeddings (list of numpy arrays), chunks (list of dicts))
-    """
-
-    embeddings=[]
-    chunks = []
-    for video in videos:
-        if video.timestamps == []:
-            continue
-        
-        texts = [clean_text(chunk[1]) for chunk in video.timestamps]
-        current_embeddings = model.encode(texts, convert_to_tensor=False, show_progress_bar=True)
-
-        embeddings.extend(current_embeddings)
-        current_chunks = []
-        for i in range(len(video.timestamps)):
-            current_chunks.append(dict())
-            current_chunks[i]["video_id"] = video.id
-            current_chunks[i]["video_title"] = video.title
-            current_chunks[i]["video_year"] = int(video.tags['year'])
-            current_chunks[i]["text"] = video.timestamps[i][1]
-            current_chunks[i]["start"] = convert_time(video.timestamps[i][0])
-        chunks.extend(current_chunks)
-    return embeddings, chunks
-
-def merge_transcripts(videos):
-    """
-    Merges embeddings and chunks from videos' transcripts.
+        numpy.ndarray: Fused scores.
+    """
+
+    if len(lexical_scores) == 0 or lexical_scores.max() <= 0:
+        return scores
+    return scores + weight * (lexical_scores / lexical_scores.max()) * (1 - scores)
+
+def hybrid_scores(query, query_emb_norm, index, spans, score_offset=0.2):
+    """
+    Fuses dense and BM25 scores of the rows of the spans. Only the transcript
+    passages with the best BM25 scores are scored densely; timestamps are few,
+    so all of them are scored densely and the BM25 scores of the matching ones
+    are fused. Falls back to dense scores of all rows of the spans if there is
+    no lexical index of the embedding index build or no passage shares a term with the query.
 
     Args:
-        videos (list): List of videos with transcript attribute.
+        query (str): User search query.
+        query_emb_norm (numpy.ndarray): Normalized query embedding.
+        index (EmbeddingIndex): Transcript or timestamp embedding index.
+        spans (list): Row spans, see EmbeddingIndex.row_spans.
+        score_offset (float): Offset the matches will be selected with
 
     Returns:
-        tuple: (embeddings (list of numpy arrays), chunks (list of dicts))
+        tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) of the scored rows.
     """
 
-    embeddings=[]
-    chunks = []
-    for video in videos:
-        if video.transcript is None:
-            continue
-        
-        embeddings.extend(load_cache(video.id))
-        current_chunks = video.transcript.data
-        for i in range(len(current_chunks)):
-            current_chunks[i]["video_id"] = video.id
-            current_chunks[i]["video_title"] = video.title
-            current_chunks[i]["video_year"] = int(video.tags['year'])
-        chunks.extend(current_chunks)
-    return embeddings, chunks
+    lexical = get_lexical_index(index.kind)
+    if lexical is None or lexical.embedding_build != (index.version, index.build):
+        return index.scores(query_emb_norm, spans, score_offset)
+
+    if index.kind == "transcripts":
+        with stage("lexical"):
+            lexical_scores, rows = lexical.top(query_terms(query), spans, LEXICAL_CANDIDATES)
+        if len(rows) != 0:
+            return fuse_scores(index.matrix[rows] @ query_emb_norm, lexical_scores), rows
+        return index.scores(query_emb_norm, spans, score_offset)
+
+    scores, rows = index.scores(query_emb_norm, spans, score_offset)
+    with stage("lexical"):
+        found_scores, found = lexical.scores(query_terms(query), spans)
+        lexical_scores = np.zeros(len(rows), dtype=np.float32)
+        lexical_scores[np.searchsorted(rows, found)] = found_scores
+    return fuse_scores(scores, lexical_scores), rows
+
+def select_best(scores, threshold=0.5, score_offset=0.2):
+    """
+    Selects positions of the scores close enough to the best one.
 
+    Args:
+        scores (numpy.ndarray): Similarity scores.
+        threshold (float): Minimum similarity threshold
+        score_offset (float): Offset for selecting multiple top matches
 
-def semantic_search(query, embeddings, chunks, threshold=0.5, score_offset=0.2):
+    Returns:
+        numpy.ndarray or None: Positions of the best scores or None if no match.
     """
-    Performs semantic search over precomputed embeddings for a query.
+
+    if len(scores) == 0:
+        return None
+
+    best_score = np.max(scores)
+    if best_score < threshold:
+        return None
+
+    # Scores are compared in float64, as the scalar comparison did before.
+    scores = np.asarray(scores, dtype=np.float64)
+    mask = scores >= max(threshold, best_score - score_offset)
+    if np.count_nonzero(mask) > 10:
+        mask = scores >= max(threshold, best_score - score_offset / 2)
+    return np.flatnonzero(mask)
+
+def rank_candidates(scores, years, starts, limit=7):
+    """
+    Orders matches by year, score and earliest start and keeps the top ones.
 
     Args:
-        query (str): User search query.
-        embeddings (numpy.ndarray): Precomputed embeddings.
-        chunks (list[dict]): Data corresponding to each embedding.
+        scores (numpy.ndarray): Similarity scores of the matches.
+        years (numpy.ndarray): Video years of the matches.
+        starts (numpy.ndarray): Start times of the matches in seconds.
+        limit (int): Maximum number of matches to keep.
+
+    Returns:
+        tuple: (positions (numpy.ndarray), score percents (list)) of the kept matches, best first.
+    """
+
+    years = np.asarray(years)
+    positions = np.arange(len(scores))
+    if len(positions) > limit:
+        # Only the years of the top matches can make it into the result.
+        kth_year = np.partition(years, len(years) - limit)[len(years) - limit]
+        positions = positions[years >= kth_year]
+
+    percents = np.array([round(float(score)*100, 2) for score in np.asarray(scores)[positions]])
+    order = np.lexsort((np.trunc(np.asarray(starts)[positions]), -percents, -years[positions]))[:limit]
+    return positions[order], percents[order].tolist()
+
+def index_results(scores, rows, index, videos_by_id, threshold=0.5, score_offset=0.2):
+    """
+    Turns similarity scores of index rows into sorted transcript passage
+    or timestamp matches.
+
+    Args:
+        scores (numpy.ndarray): Similarity scores of the rows.
+        rows (numpy.ndarray): Scored rows of the index.
+        index (EmbeddingIndex): Transcript or timestamp embedding index.
+        videos_by_id (dict): Video id to video object.
         threshold (float): Minimum similarity threshold
         score_offset (float): Offset for selecting multiple top matches
 
@@ -191,29 +388,103 @@ def semantic_search(query, embeddings, chunks, threshold=0.5, score_offset=0.2):
         list[dict] or None: Sorted list of matching chunks with scores or None if no match.
     """
 
-    query_lemma = lemmatize(query.lower())
-    query_clean = clean_text(query_lemma)
+    best_idxs = select_best(scores, threshold, score_offset)
+    if best_idxs is None:
+        return None
 
-    query_emb = model.encode(query_clean, convert_to_tensor=False)
-    embeddings_norm = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
-    query_emb_norm = query_emb / np.linalg.norm(query_emb)
-    scores = embeddings_norm @ query_emb_norm
+    metas = index.chunks[rows[best_idxs]]
+    positions, percents = rank_candidates(scores[best_idxs], metas["year"], metas["start"])
+    results = []
+    for position, percent in zip(positions, percents):
+        meta = metas[position]
+        video = videos_by_id[index.video_ids[meta["video"]]]
+        # The video may have changed after the index was published; its rows are
+        # skipped when they no longer fit, until the indexer publishes the next one.
+        if index.kind == "timestamps":
+            timestamps = valid_timestamps(video.timestamps)
+            if meta["position"] >= len(timestamps):
+                continue
+            result = {
+                "video_id": video.id,
+                "video_title": video.title,
+                "video_year": int(meta["year"]),
+                "text": timestamps[meta["position"]][1],
+                "start": int(meta["start"]),
+            }
+        else:
+            if video.transcript is None or meta["end"] > video.transcript.chunks_count:
+                continue
+            result = video.transcript.passage(int(meta["chunk"]), int(meta["end"]))
+            result["video_id"] = video.id
+            result["video_title"] = video.title
+            result["video_year"] = int(meta["year"])
+        result['score_percent'] = percent
+        results.append(result)
+    return results
 
-    best_score = np.max(scores)
-    if best_score < threshold:
+@timed("index_search")
+def index_search(query, index, videos, threshold=0.5, score_offset=0.2, retrieval=None):
+    """
+    Performs semantic search over the consolidated transcript or timestamp
+    embeddings of the given videos.
+
+    Args:
+        query (str): User search query.
+        index (EmbeddingIndex): Transcript or timestamp embedding index.
+        videos (list): List of video objects to search in.
+        threshold (float): Minimum similarity threshold
+        score_offset (float): Offset for selecting multiple top matches
+        retrieval (str, optional): "dense" or "hybrid", RETRIEVAL by default.
+
+    Returns:
+        list[dict] or None: Sorted list of matching chunks with scores or None if no match.
+    """
+
+    videos_by_id = {video.id: video for video in videos}
+    spans = index.row_spans(videos_by_id)
+    if not spans:
         return None
 
-    best_idxs = [i for i in range(len(scores)) if scores[i] >= max(threshold, best_score - score_offset)]
-    if len(best_idxs) > 10:
-        best_idxs = [i for i in range(len(scores)) if scores[i] >= max(threshold, best_score - score_offset / 2)]
+    query_emb_norm = encode_query(query)
+    with stage("score"):
+        if (retrieval or RETRIEVAL) == "hybrid":
+            scores, rows = hybrid_scores(query, query_emb_norm, index, spans, score_offset)
+        else:
+            scores, rows = index.scores(query_emb_norm, spans, score_offset)
+    with stage("rank"):
+        return index_results(scores, rows, index, videos_by_id, threshold, score_offset)
 
-    results = [chunks[idx] for idx in best_idxs]
-    for i in range(len(results)):
-        results[i]['score_percent'] = round(float(scores[best_idxs[i]])*100, 2)
-    results.sort(key=lambda x: [int(x['video_year']), x['score_percent'], (-1) * int(x['start'])], reverse=True)
-    #results.sort(key=lambda x: x['video_year'], reverse=True)
+def index_search_batch(queries, index, videos, threshold=0.5, score_offset=0.2, retrieval=None):
+    """
+    Performs semantic search over the consolidated transcript or timestamp
+    embeddings of the given videos for several queries at once.
 
-    return results[:min(len(results), 7)]
+    Args:
+        queries (list[str]): User search queries.
+        index (EmbeddingIndex): Transcript or timestamp embedding index.
+        videos (list): List of video objects to search in.
+        threshold (float): Minimum similarity threshold
+        score_offset (float): Offset for selecting multiple top matches
+        retrieval (str, optional): "dense" or "hybrid", RETRIEVAL by default.
+
+    Returns:
+        list: Results of every query, see index_search.
+    """
+
+    videos_by_id = {video.id: video for video in videos}
+    spans = index.row_spans(videos_by_id)
+    if not spans:
+        return [None] * len(queries)
+
+    query_embs_norm = encode_queries(queries)
+    with stage("score"):
+        if (retrieval or RETRIEVAL) == "hybrid":
+            scored = [hybrid_scores(query, query_emb_norm, index, spans, score_offset)
+                      for query, query_emb_norm in zip(queries, query_embs_norm)]
+        else:
+            scored = index.scores_many(query_embs_norm, spans, score_offset)
+    with stage("rank"):
+        return [index_results(scores, rows, index, videos_by_id, threshold, score_offset) for scores, rows in scored]
 
 def make_youtube_url(video_id, timestamp):
     """
@@ -235,7 +506,132 @@ def make_youtube_url(video_id, timestamp):
         time = str(mins) + "m" + str(secs) + "s"
     return f"https://www.youtube.com/watch?v={video_id}&t={time}"
 
-def transcript_search(query, videos, precision=0.5):
+def format_result(number, result):
+    """
+    Formats a search result for the chat.
+
+    Args:
+        number (int): Result number in the list.
+        result (dict): Search result.
+
+    Returns:
+        str: Formatted result.
+    """
+
+    url = make_youtube_url(result['video_id'], result['start'])
+    return (
+        f"{number}\n"
+        f"Видео: {url}\n"
+        f"Название: {result['video_title']}\n"
+        f"Совпадение: {result['score_percent']}%\n"
+        f"Таймкод: {result['start']}\n"
+        f"Текст:\n{result['text']}\n"
+    )
+
+def print_results(results):
+    """
+    Prints search results.
+
+    Args:
+        results (list[dict] or None): Search results.
+    """
+
+    if results:
+        print(f"Найдено: {len(results)} видео\n")
+        for number, result in enumerate(results, 1):
+            print(format_result(number, result))
+    else:
+        print("Совпадений не найдено")
+
+def results_version():
+    """
+    Gets the version of the data search results depend on: the corpus index,
+    the builds of the published embedding and lexical indexes and the vector
+    backend the transcript index is searched with. The retrieval mode is part
+    of the result cache keys.
+
+    Returns:
+        tuple: (corpus index version, (corpus version, build) of the transcript and
+            timestamp embedding indexes and of the lexical indexes, backend name)
+    """
+
+    transcripts = get_embedding_index()
+    timestamps = get_timestamp_index()
+    lexical = [get_lexical_index(kind) for kind in ("transcripts", "timestamps")]
+    return (
+        get_index()["version"],
+        (transcripts.version, transcripts.build),
+        (timestamps.version, timestamps.build),
+        *((index.version, index.build) if index is not None else None for index in lexical),
+        type(transcripts.backend).__name__,
+    )
+
+def cached_results(kind, corrected, videos, precision, search):
+    """
+    Runs a search unless its results are cached. The videos stand for the
+    tag filter that selected them.
+
+    Args:
+        kind (str): Search kind.
+        corrected (str): Corrected query.
+        videos (list): List of video objects to search in.
+        precision (float): Similarity threshold for filtering.
+        search (callable): Runs the search and returns (available, results).
+
+    Returns:
+        tuple: (available (bool), results (list[dict] or None)); results are copies.
+    """
+
+    query_cache.results.check_version(results_version())
+    key = (kind, RETRIEVAL, normalize_query(corrected), tuple(video.id for video in videos), precision)
+    cached = query_cache.results.get(key)
+    if cached is None:
+        cached = search()
+        query_cache.results.put(key, cached)
+    available, results = cached
+    if results is not None:
+        results = [dict(result) for result in results]
+    return available, results
+
+def search_transcripts(corrected, videos, precision):
+    """
+    Searches in video transcripts with the result cache.
+
+    Args:
+        corrected (str): Corrected query.
+        videos (list): List of video objects with transcripts.
+        precision (float): Similarity threshold for filtering.
+
+    Returns:
+        list[dict] or None: Search results or None if no matches.
+    """
+
+    def search():
+        return True, index_search(corrected, get_embedding_index(), videos, threshold=precision)
+    return cached_results("transcripts", corrected, videos, precision, search)[1]
+
+def search_timestamps(corrected, videos, precision):
+    """
+    Searches in video timestamps with the result cache.
+
+    Args:
+        corrected (str): Corrected query.
+        videos (list): List of video objects with timestamps.
+        precision (float): Similarity threshold for filtering.
+
+    Returns:
+        tuple: (available (bool): whether any video has encoded timestamps,
+            results (list[dict] or None))
+    """
+
+    def search():
+        index = get_timestamp_index()
+        if not index.row_spans(video.id for video in videos):
+            return False, None
+        return True, index_search(corrected, index, videos, threshold=precision)
+    return cached_results("timestamps", corrected, videos, precision, search)
+
+def transcript_search(query, videos, precision=0.5, verbose=True):
     """
     Searches in video transcripts and outputs results.
 
@@ -243,40 +639,25 @@ def transcript_search(query, videos, precision=0.5):
         query (str): User search query.
         videos (list): List of video objects with transcripts.
         precision (float): Similarity threshold for filtering.
+        verbose (bool): Whether to print the results.
 
     Returns:
         list[dict] or None: Search results or None if no matches.
     """
 
-    for video in videos:
-        if video.transcript is not None:
-          cache_embeddings(video.id, video.transcript.text)
+    corrected = correct_query(query)
 
-    corrected = yandex_spellcheck(query)
-    print("Исправленный запрос:", corrected)
+    results = search_transcripts(corrected, videos, precision)
+    if not verbose:
+        return results
 
-    embeddings, chunks = merge_transcripts(videos)
-    results = semantic_search(corrected, embeddings, chunks, threshold=precision)
+    print("Исправленный запрос:", corrected)
     print("Поиск по субтитрам:\n")
-    if results:
-        print(f"Найдено: {len(results)} видео\n")
-        cnt = 1
-        for result in results:
-            print(cnt)
-            cnt += 1
-            url = make_youtube_url(result['video_id'], result['start'])
-            print(f"Видео: {url}")
-            print(f"Название: {result['video_title']}")
-            print(f"Совпадение: {result['score_percent']}%")
-            print(f"Таймкод: {result['start']}")
-            print(f"Текст:\n{result['text']}")
-            print()
-    else:
-        print("Совпадений не найдено")
+    print_results(results)
 
     return results
 
-def timestamp_search(query, videos, precision=0.5):
+def timestamp_search(query, videos, precision=0.5, verbose=True):
     """
     Searches in video timestamps and outputs results.
 
@@ -284,40 +665,168 @@ def timestamp_search(query, videos, precision=0.5):
         query (str): User search query.
         videos (list): List of video objects with timestamps
         precision (float): Similarity threshold for filtering
+        verbose (bool): Whether to print the results.
 
     Returns:
         list[dict] or None: Search results or None if no matches.
     """
 
-    corrected = yandex_spellcheck(query)
-    print("Исправленный запрос:", corrected)
+    corrected = correct_query(query)
+    if verbose:
+        print("Исправленный запрос:", corrected)
+        print("Поиск по таймкодам:\n")
 
-    print("Поиск по таймкодам:\n")
-    embeddings, chunks = merge_timestamps(videos)
-    if len(embeddings) == 0:
-        print("Таймкоды недоступны")
+    available, results = search_timestamps(corrected, videos, precision)
+    if not available:
+        if verbose:
+            print("Таймкоды недоступны")
         return
 
-    results = semantic_search(corrected, embeddings, chunks, threshold=precision)
-    if results:
-        cnt = 1
-        print(f"Найдено: {len(results)} видео\n")
-        for result in results:
-            print(cnt)
-            
-            cnt += 1
-            url = make_youtube_url(result['video_id'], result['start'])
-            print(f"Видео: {url}")
-            print(f"Название: {result['video_title']}")
-            print(f"Совпадение: {result['score_percent']}%")
-            print(f"Таймкод: {result['start']}")
-            print(f"Текст:\n{result['text']}")
-            print()
-    else:
-        print("Совпадений не найдено")
+    if not verbose:
+        return results
+
+    print_results(results)
 
     return results
 
+class SearchResult:
+    """
+    Search result delivered by search_stream.
+
+    Attrs:
+        source (str): "timestamps" or "transcripts"
+        rank (int): Position among the results of the source, from 1
+        query (str): Corrected query
+        video_id (str): Video id
+        video_title (str): Video title
+        video_year (int): Video year
+        start (float): Start of the match in seconds
+        text (str): Matched timestamp description or transcript passage
+        score_percent (float): Similarity in percent
+    """
+    __slots__ = ("source", "rank", "query", "video_id", "video_title", "video_year", "start", "text", "score_percent")
+
+    def __init__(self, source, rank, query, result):
+        self.source = source
+        self.rank = rank
+        self.query = query
+        self.video_id = result["video_id"]
+        self.video_title = result["video_title"]
+        self.video_year = result["video_year"]
+        self.start = result["start"]
+        self.text = result["text"]
+        self.score_percent = result["score_percent"]
+
+    @property
+    def url(self):
+        """str: YouTube URL at the start of the match."""
+        return make_youtube_url(self.video_id, self.start)
+
+    def to_dict(self):
+        """
+        Converts the result to a JSON serializable dict.
+
+        Returns:
+            dict: Result fields and the URL.
+        """
+        result = {name: getattr(self, name) for name in self.__slots__}
+        result["url"] = self.url
+        return result
+
+    def format(self):
+        """
+        Formats the result for the chat.
+
+        Returns:
+            str: Formatted result, see format_result.
+        """
+        return format_result(self.rank, self.to_dict())
+
+def search_stream(query, videos, precision=0.5, mode="all"):
+    """
+    Searches in timestamps and then in transcripts, yielding every result
+    as soon as its stage is done. The query is corrected once and its
+    embedding is shared by both stages through the cache.
+
+    Args:
+        query (str): User search query.
+        videos (list): List of video objects.
+        precision (float): Similarity threshold for filtering.
+        mode (str): "all", "timestamps" or "transcripts".
+
+    Yields:
+        SearchResult: Timestamp matches first, then transcript matches, best first within a source.
+    """
+
+    corrected = correct_query(query)
+
+    if mode in ("all", "timestamps"):
+        results = search_timestamps(corrected, videos, precision)[1]
+        for rank, result in enumerate(results or [], 1):
+            yield SearchResult("timestamps", rank, corrected, result)
+
+    if mode in ("all", "transcripts"):
+        results = search_transcripts(corrected, videos, precision)
+        for rank, result in enumerate(results or [], 1):
+            yield SearchResult("transcripts", rank, corrected, result)
+
+async def search_stream_async(query, videos, precision=0.5, mode="all"):
+    """
+    Asynchronous version of search_stream. The search runs in a worker
+    thread, so the event loop keeps serving other chats meanwhile.
+
+    Args:
+        query (str): User search query.
+        videos (list): List of video objects.
+        precision (float): Similarity threshold for filtering.
+        mode (str): "all", "timestamps" or "transcripts".
+
+    Yields:
+        SearchResult: Results in the order of search_stream.
+    """
+
+    stream = search_stream(query, videos, precision, mode)
+    done = object()
+    while True:
+        result = await asyncio.to_thread(next, stream, done)
+        if result is done:
+            return
+        yield result
+
+def transcript_search_batch(queries, videos, precision=0.5):
+    """
+    Searches in video transcripts for several queries sharing the same videos.
+
+    Args:
+        queries (list[str]): User search queries.
+        videos (list): List of video objects with transcripts.
+        precision (float): Similarity threshold for filtering.
+
+    Returns:
+        list: Search results of every query, each a list[dict] or None.
+    """
+
+    index = get_embedding_index()
+    corrected = [correct_query(query) for query in queries]
+    return index_search_batch(corrected, index, videos, threshold=precision)
+
+def timestamp_search_batch(queries, videos, precision=0.5):
+    """
+    Searches in video timestamps for several queries sharing the same videos.
+
+    Args:
+        queries (list[str]): User search queries.
+        videos (list): List of video objects with timestamps
+        precision (float): Similarity threshold for filtering
+
+    Returns:
+        list: Search results of every query, each a list[dict] or None.
+    """
+
+    index = get_timestamp_index()
+    corrected = [correct_query(query) for query in queries]
+    return index_search_batch(corrected, index, videos, threshold=precision)
+
 def clear_cache():
     """Deletes all cached embedding files in cache directory after user confirmation."""
 
@@ -325,7 +834,7 @@ def clear_cache():
     if response != "YES":
         return
     
-    filenames = os.listdir('/cache')
+    filenames = os.listdir(CACHE_DIR)
     for filename in filenames:
-        dir = f"cache/{filename}"
+        dir = f"{CACHE_DIR}/{filename}"
         os.remove(dir)
@@ -0,0 +1,184 @@
+"""
+This is the code for the columnar transcript store.
+
+Transcripts of one playlist are kept in a single binary file: start times,
+durations and text offsets are stored as arrays, followed by all chunk texts as
+one UTF-8 blob. The file is memory mapped, so reading one video's transcript
+touches only its slice of every column and never parses other videos.
+
+File layout (little-endian):
+    magic (8 bytes), chunk count N (uint64), text size B (uint64),
+    starts (float64[N]), durations (float64[N]), text offsets (uint64[N + 1]),
+    texts (B bytes).
+
+Store files are written only by corpus_index.update_index, which converts the
+playlists of the JSON database when the corpus index is updated. Run
+`python transcript_store.py` to convert an existing database/ tree into the
+stores of index/ without computing embeddings, or `python indexer.py` to also
+update everything else queries need.
+"""
+
+import os
+import numpy as np
+from array import array
+from functools import lru_cache
+
+MAGIC = b"TRSTORE1"
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("chunks", "<u8"), ("text_size", "<u8")])
+
+
+def write_store(path, transcripts):
+    """
+    Writes transcripts into a store file atomically.
+
+    Args:
+        path (str): Path to the store file.
+        transcripts (list): Transcripts, each a list of chunks with text, start and duration.
+
+    Returns:
+        list: [first chunk, end chunk] of every transcript in the file.
+    """
+    ranges = []
+    starts = []
+    durations = []
+    texts = []
+    for transcript in transcripts:
+        ranges.append([len(starts), len(starts) + len(transcript)])
+        for chunk in transcript:
+            starts.append(chunk["start"])
+            durations.append(chunk["duration"])
+            texts.append(chunk["text"].encode("utf-8"))
+
+    offsets = np.zeros(len(texts) + 1, dtype="<u8")
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    header = np.array([(MAGIC, len(texts), offsets[-1])], dtype=HEADER_DTYPE)
+
+    with open(f"{path}.tmp", "wb") as file:
+        file.write(header.tobytes())
+        file.write(np.asarray(starts, dtype="<f8").tobytes())
+        file.write(np.asarray(durations, dtype="<f8").tobytes())
+        file.write(offsets.tobytes())
+        file.write(b"".join(texts))
+    os.replace(f"{path}.tmp", path)
+    return ranges
+
+
+class TranscriptStore:
+    """
+    Memory-mapped store file.
+
+    Attrs:
+        starts (numpy.ndarray): Start time of every chunk
+        durations (numpy.ndarray): Duration of every chunk
+        offsets (numpy.ndarray): Byte offset of every chunk text in texts, plus the end
+        texts (numpy.ndarray): UTF-8 bytes of all chunk texts
+    """
+
+    def __init__(self, path):
+        """
+        Opens a store file.
+
+        Args:
+            path (str): Path to the store file.
+        """
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        header = data[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header["magic"] != MAGIC:
+            raise ValueError(f"{path} is not a transcript store")
+        chunks, text_size = int(header["chunks"]), int(header["text_size"])
+        first = HEADER_DTYPE.itemsize
+        self.starts = data[first:first + 8 * chunks].view("<f8")
+        first += 8 * chunks
+        self.durations = data[first:first + 8 * chunks].view("<f8")
+        first += 8 * chunks
+        self.offsets = data[first:first + 8 * (chunks + 1)].view("<u8")
+        first += 8 * (chunks + 1)
+        self.texts = data[first:first + text_size]
+
+    def columns(self, first, end):
+        """
+        Reads the columns of a chunk range.
+
+        Args:
+            first (int): First chunk.
+            end (int): End chunk.
+
+        Returns:
+            tuple: (texts (list[str]), starts (numpy.ndarray), durations (numpy.ndarray))
+        """
+        offsets = self.offsets[first:end + 1].astype(np.int64)
+        blob = self.texts[offsets[0]:offsets[-1]].tobytes()
+        offsets -= offsets[0]
+        texts = [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(end - first)]
+        return texts, np.array(self.starts[first:end]), np.array(self.durations[first:end])
+
+    def slices(self, first, end):
+        """
+        Copies a chunk range out of the mapping in the layout of media.Transcript.from_columns.
+
+        Args:
+            first (int): First chunk.
+            end (int): End chunk.
+
+        Returns:
+            tuple: (texts (bytes), offsets (array), starts (array), durations (array))
+        """
+        offsets = self.offsets[first:end + 1].astype(np.int64)
+        blob = self.texts[offsets[0]:offsets[-1]].tobytes()
+        offsets -= offsets[0]
+        return (
+            blob,
+            array("q", offsets.tobytes()),
+            array("d", self.starts[first:end].astype(np.float64).tobytes()),
+            array("d", self.durations[first:end].astype(np.float64).tobytes()),
+        )
+
+    def transcript(self, first, end):
+        """
+        Reads a chunk range in the layout of the YouTube transcript API.
+
+        Args:
+            first (int): First chunk.
+            end (int): End chunk.
+
+        Returns:
+            list: Chunks with text, start and duration.
+        """
+        texts, starts, durations = self.columns(first, end)
+        return [
+            {"text": text, "start": start, "duration": duration}
+            for text, start, duration in zip(texts, starts.tolist(), durations.tolist())
+        ]
+
+
+@lru_cache(maxsize=64)
+def open_store(path):
+    """
+    Opens a store file once and reuses the mapping. Store files are never
+    modified in place, so a cached mapping always stays valid.
+
+    Args:
+        path (str): Path to the store file.
+
+    Returns:
+        TranscriptStore: Opened store.
+    """
+    return TranscriptStore(path)
+
+
+def main():
+    """Converts the playlists of database/ into store files in index/ with corpus_index.update_index."""
+    from corpus_index import index_path, update_index
+
+    index = update_index()
+    for folder, playlist in sorted(index["playlists"].items()):
+        if playlist["store"] is None:
+            print(f"{folder}: no transcripts")
+            continue
+        path = index_path(playlist["store"])
+        print(f"{folder}: {len(open_store(path).starts)} chunks, {os.path.getsize(path)} bytes in {playlist['store']}")
+    print(f"Index version {index['version']}: {len(index['playlists'])} playlists, {len(index['videos'])} videos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+"""
+This is the code for the vector search backends of the transcript embedding index.
+
+ExactBackend scores every row of the filtered spans and is the reference.
+IVFBackend clusters rows with spherical k-means and scores only the rows of the
+clusters closest to the query; nprobe trades recall for latency.
+QuantizedBackend scores a float16 or int8 copy of the matrix, 2 or 4 times
+smaller, and re-scores exactly only the rows close to the best approximate
+score, which are the only rows the selection of matches looks at.
+"""
+
+import sys
+import time
+import numpy as np
+
+DEFAULT_NPROBE = 16
+
+# Filters with fewer rows than this are scored exactly, which is both exact and cheaper.
+EXACT_MAX_ROWS = 20000
+
+TRAIN_SAMPLE = 50000
+BATCH_ROWS = 65536
+
+QUANTIZED_DTYPES = {"float16": np.float16, "int8": np.int8}
+# Quantized rows are converted to float32 for the product in batches that stay in the CPU cache.
+QUANTIZED_BATCH_ROWS = 4096
+# Rows whose approximate score is within the score_offset of the search plus this
+# margin of the best one are re-scored exactly. The margin exceeds the quantization
+# error, so the selected matches are the same as with exact search.
+RERANK_MARGIN = 0.05
+# score_offset of the search when none is given, see text_processor.select_best.
+DEFAULT_SCORE_OFFSET = 0.2
+
+
+def span_rows(spans):
+    """
+    Lists all rows of the spans.
+
+    Args:
+        spans (list): Sorted [first row, end row] spans.
+
+    Returns:
+        numpy.ndarray: Row numbers.
+    """
+    if not spans:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(first, end) for first, end in spans])
+
+
+def rows_in_spans(rows, spans):
+    """
+    Checks which rows lie inside the spans.
+
+    Args:
+        rows (numpy.ndarray): Row numbers.
+        spans (list): Sorted, non-overlapping [first row, end row] spans.
+
+    Returns:
+        numpy.ndarray: Boolean mask over rows.
+    """
+    bounds = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    pos = np.searchsorted(bounds[:, 0], rows, side="right") - 1
+    return (pos >= 0) & (rows < bounds[np.maximum(pos, 0), 1])
+
+
+class ExactBackend:
+    """
+    Brute-force search over the rows of the filtered spans.
+
+    Attrs:
+        matrix (numpy.ndarray): Normalized embeddings
+    """
+    name = "exact"
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    def search(self, query_emb, spans, score_offset=None):
+        """
+        Scores rows of the given spans against a normalized query embedding.
+
+        Args:
+            query_emb (numpy.ndarray): Normalized query embedding.
+            spans (list): Sorted [first row, end row] spans.
+            score_offset (float, optional): Offset the matches will be selected with; unused.
+
+        Returns:
+            tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) for all rows of the spans.
+        """
+        if not spans:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        scores = np.concatenate([self.matrix[first:end] @ query_emb for first, end in spans])
+        return scores, span_rows(spans)
+
+    def search_many(self, query_embs, spans, score_offset=None):
+        """
+        Scores rows of the given spans against several queries with one
+        matrix-matrix product per span.
+
+        Args:
+            query_embs (numpy.ndarray): Normalized query embeddings, one row per query.
+            spans (list): Sorted [first row, end row] spans.
+            score_offset (float, optional): Offset the matches will be selected with; unused.
+
+        Returns:
+            list: (scores, rows) of every query, see search.
+        """
+        if not spans:
+            return [self.search(query_emb, spans) for query_emb in query_embs]
+        scores = np.concatenate([self.matrix[first:end] @ query_embs.T for first, end in spans])
+        rows = span_rows(spans)
+        return [(scores[:, i], rows) for i in range(len(query_embs))]
+
+
+class IVFBackend:
+    """
+    Inverted file index: rows are grouped by their nearest centroid and only
+    the nprobe closest groups are scored.
+
+    Attrs:
+        matrix (numpy.ndarray): Normalized embeddings
+        centroids (numpy.ndarray): Normalized cluster centroids
+        list_offsets (numpy.ndarray): Start of each cluster in list_rows, plus the end
+        list_rows (numpy.ndarray): Rows sorted by cluster and by row number inside a cluster
+        nprobe (int): Number of clusters scored per query
+    """
+    name = "ivf"
+
+    def __init__(self, matrix, centroids, list_offsets, list_rows, nprobe=DEFAULT_NPROBE):
+        self.matrix = matrix
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.nprobe = nprobe
+
+    def search(self, query_emb, spans, score_offset=None, nprobe=None):
+        """
+        Scores rows of the closest clusters that lie inside the given spans.
+
+        Args:
+            query_emb (numpy.ndarray): Normalized query embedding.
+            spans (list): Sorted [first row, end row] spans.
+            score_offset (float, optional): Offset the matches will be selected with; unused.
+            nprobe (int, optional): Overrides the number of scored clusters.
+
+        Returns:
+            tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) of the candidate rows.
+        """
+        if sum(end - first for first, end in spans) <= EXACT_MAX_ROWS:
+            return ExactBackend(self.matrix).search(query_emb, spans)
+
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query_emb
+        probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.sort(np.concatenate([
+            self.list_rows[self.list_offsets[cluster]:self.list_offsets[cluster + 1]] for cluster in probed
+        ]))
+        rows = rows[rows_in_spans(rows, spans)]
+        return self.matrix[rows] @ query_emb, rows
+
+    def search_many(self, query_embs, spans, score_offset=None):
+        """
+        Searches for several queries. Each query probes its own clusters,
+        so small filters share one exact product and large ones are searched one by one.
+
+        Args:
+            query_embs (numpy.ndarray): Normalized query embeddings, one row per query.
+            spans (list): Sorted [first row, end row] spans.
+            score_offset (float, optional): Offset the matches will be selected with; unused.
+
+        Returns:
+            list: (scores, rows) of every query, see search.
+        """
+        if sum(end - first for first, end in spans) <= EXACT_MAX_ROWS:
+            return ExactBackend(self.matrix).search_many(query_embs, spans)
+        return [self.search(query_emb, spans) for query_emb in query_embs]
+
+
+class QuantizedBackend:
+    """
+    Search over a quantized copy of the matrix with exact re-scoring of the best rows.
+
+    Attrs:
+        matrix (numpy.ndarray): Normalized embeddings, read only for re-scored rows
+        quantized (numpy.ndarray): float16 or int8 copy of the matrix
+        scale (numpy.ndarray): Scale of every dimension of the quantized values
+        margin (float): Distance of re-scored rows from the best approximate score
+            in addition to the score_offset of the search
+    """
+
+    def __init__(self, matrix, quantized, scale, margin=RERANK_MARGIN):
+        self.matrix = matrix
+        self.quantized = quantized
+        self.scale = scale
+        self.margin = margin
+
+    @property
+    def name(self):
+        """str: Quantized type name."""
+        return self.quantized.dtype.name
+
+    def approximate(self, query_embs, spans):
+        """
+        Scores rows of the spans on the quantized matrix.
+
+        Args:
+            query_embs (numpy.ndarray): Normalized query embeddings, one row per query.
+            spans (list): Sorted [first row, end row] spans.
+
+        Returns:
+            tuple: (scores (numpy.ndarray) with one column per query, rows (numpy.ndarray))
+        """
+        scaled = (query_embs * self.scale).T.astype(np.float32)
+        scores = []
+        for first, end in spans:
+            for batch_first in range(first, end, QUANTIZED_BATCH_ROWS):
+                batch = self.quantized[batch_first:min(end, batch_first + QUANTIZED_BATCH_ROWS)]
+                scores.append(batch.astype(np.float32) @ scaled)
+        if not scores:
+            return np.zeros((0, len(query_embs)), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        return np.concatenate(scores), span_rows(spans)
+
+    def rerank(self, query_emb, scores, rows, score_offset=None):
+        """
+        Re-scores exactly the rows close to the best approximate score.
+
+        Args:
+            query_emb (numpy.ndarray): Normalized query embedding.
+            scores (numpy.ndarray): Approximate scores.
+            rows (numpy.ndarray): Scored rows.
+            score_offset (float, optional): Offset the matches will be selected with,
+                DEFAULT_SCORE_OFFSET by default.
+
+        Returns:
+            tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) of the re-scored rows.
+        """
+        if len(rows) == 0:
+            return scores, rows
+        window = (DEFAULT_SCORE_OFFSET if score_offset is None else score_offset) + self.margin
+        rows = rows[scores >= scores.max() - window]
+        return self.matrix[rows] @ query_emb, rows
+
+    def search(self, query_emb, spans, score_offset=None):
+        """
+        Scores rows of the given spans, see QuantizedBackend.
+
+        Args:
+            query_emb (numpy.ndarray): Normalized query embedding.
+            spans (list): Sorted [first row, end row] spans.
+            score_offset (float, optional): Offset the matches will be selected with, see rerank.
+
+        Returns:
+            tuple: (scores (numpy.ndarray), rows (numpy.ndarray)) of the re-scored rows.
+        """
+        scores, rows = self.approximate(query_emb[None, :], spans)
+        return self.rerank(query_emb, scores[:, 0], rows, score_offset)
+
+    def search_many(self, query_embs, spans, score_offset=None):
+        """
+        Scores rows of the given spans against several queries with one
+        product per batch of the quantized matrix.
+
+        Args:
+            query_embs (numpy.ndarray): Normalized query embeddings, one row per query.
+            spans (list): Sorted [first row, end row] spans.
+            score_offset (float, optional): Offset the matches will be selected with, see rerank.
+
+        Returns:
+            list: (scores, rows) of every query, see search.
+        """
+        scores, rows = self.approximate(query_embs, spans)
+        return [self.rerank(query_emb, scores[:, i], rows, score_offset) for i, query_emb in enumerate(query_embs)]
+
+
+def save_quantized(path, matrix, dtype_name):
+    """
+    Quantizes a matrix in batches into a .npy file that can be memory-mapped.
+    int8 values are scaled per dimension so that the largest one is 127.
+
+    Args:
+        path (str): Path to the .npy file; the scale is saved next to it.
+        matrix (numpy.ndarray): Normalized embeddings.
+        dtype_name (str): "float16" or "int8".
+    """
+    dtype = QUANTIZED_DTYPES[dtype_name]
+    scale = np.ones(matrix.shape[1], dtype=np.float32)
+    if dtype == np.int8:
+        max_abs = np.zeros(matrix.shape[1], dtype=np.float32)
+        for first in range(0, len(matrix), BATCH_ROWS):
+            max_abs = np.maximum(max_abs, np.abs(matrix[first:first + BATCH_ROWS]).max(axis=0))
+        scale = np.maximum(max_abs, 1e-12) / 127
+
+    quantized = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=matrix.shape)
+    for first in range(0, len(matrix), BATCH_ROWS):
+        batch = np.asarray(matrix[first:first + BATCH_ROWS], dtype=np.float32) / scale
+        quantized[first:first + len(batch)] = np.rint(batch) if dtype == np.int8 else batch
+    quantized.flush()
+    del quantized
+    np.save(f"{path}.scale.npy", scale)
+
+
+def load_quantized(path, matrix):
+    """
+    Opens a quantized matrix saved with save_quantized.
+
+    Args:
+        path (str): Path to the .npy file.
+        matrix (numpy.ndarray): Normalized embeddings the matrix was quantized from.
+
+    Returns:
+        QuantizedBackend: Loaded backend.
+    """
+    return QuantizedBackend(matrix, np.load(path, mmap_mode="r"), np.load(f"{path}.scale.npy"))
+
+
+def assign_clusters(matrix, centroids):
+    """
+    Finds the closest centroid of every row, in batches to bound memory.
+
+    Args:
+        matrix (numpy.ndarray): Normalized embeddings.
+        centroids (numpy.ndarray): Normalized centroids.
+
+    Returns:
+        numpy.ndarray: Cluster number of every row.
+    """
+    labels = np.empty(len(matrix), dtype=np.int32)
+    for first in range(0, len(matrix), BATCH_ROWS):
+        batch = np.asarray(matrix[first:first + BATCH_ROWS], dtype=np.float32)
+        labels[first:first + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return labels
+
+
+def train_ivf(matrix, nlist=None, iterations=10, seed=0):
+    """
+    Clusters rows with spherical k-means and builds the inverted lists.
+
+    Args:
+        matrix (numpy.ndarray): Normalized embeddings.
+        nlist (int, optional): Number of clusters, 4 * sqrt(rows) by default.
+        iterations (int): Number of k-means iterations.
+        seed (int): Random seed.
+
+    Returns:
+        tuple: (centroids, list_offsets, list_rows), see IVFBackend.
+    """
+    rng = np.random.default_rng(seed)
+    rows = len(matrix)
+    if nlist is None:
+        nlist = int(4 * np.sqrt(rows))
+    nlist = max(1, min(nlist, rows))
+
+    sample_rows = np.sort(rng.choice(rows, size=min(rows, max(TRAIN_SAMPLE, nlist)), replace=False))
+    sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign_clusters(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        empty = np.bincount(labels, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+    labels = assign_clusters(matrix, centroids)
+    list_rows = np.argsort(labels, kind="stable").astype(np.int64)
+    list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))]).astype(np.int64)
+    return centroids.astype(np.float32), list_offsets, list_rows
+
+
+def save_ivf(path, centroids, list_offsets, list_rows):
+    """
+    Saves an IVF index.
+
+    Args:
+        path (str): Path to the .npz file.
+        centroids, list_offsets, list_rows: See IVFBackend.
+    """
+    with open(path, "wb") as file:
+        np.savez(file, centroids=centroids, list_offsets=list_offsets, list_rows=list_rows)
+
+
+def load_ivf(path, matrix, nprobe=DEFAULT_NPROBE):
+    """
+    Loads an IVF index saved with save_ivf.
+
+    Args:
+        path (str): Path to the .npz file.
+        matrix (numpy.ndarray): Normalized embeddings the index was built from.
+        nprobe (int): Number of clusters scored per query.
+
+    Returns:
+        IVFBackend: Loaded backend.
+    """
+    data = np.load(path)
+    return IVFBackend(matrix, data["centroids"], data["list_offsets"], data["list_rows"], nprobe)
+
+
+def recall_report(matrix, backend, nprobes=(1, 2, 4, 8, 16, 32, 64), queries=200, k=10, seed=0):
+    """
+    Measures recall@k and latency of an IVF backend against exact search.
+    Queries are random rows with noise added, so no model is needed.
+
+    Args:
+        matrix (numpy.ndarray): Normalized embeddings.
+        backend (IVFBackend): Backend to measure.
+        nprobes (tuple): nprobe values to try.
+        queries (int): Number of queries.
+        k (int): Number of top rows compared.
+        seed (int): Random seed.
+
+    Returns:
+        list[dict]: One report line per nprobe value.
+    """
+    rng = np.random.default_rng(seed)
+    spans = [[0, len(matrix)]]
+    query_embs = np.asarray(matrix[rng.choice(len(matrix), size=queries)], dtype=np.float32)
+    query_embs += rng.normal(scale=0.05, size=query_embs.shape).astype(np.float32)
+    query_embs /= np.linalg.norm(query_embs, axis=1, keepdims=True)
+
+    exact = ExactBackend(matrix)
+    truth = []
+    start_time = time.perf_counter()
+    for query_emb in query_embs:
+        scores, rows = exact.search(query_emb, spans)
+        truth.append(set(rows[np.argsort(-scores)[:k]]))
+    report = [{"backend": "exact", "recall": 1.0, "ms": (time.perf_counter() - start_time) * 1000 / queries}]
+
+    for nprobe in nprobes:
+        found = 0
+        start_time = time.perf_counter()
+        for query_emb, expected in zip(query_embs, truth):
+            scores, rows = backend.search(query_emb, spans, nprobe=nprobe)
+            found += len(expected & set(rows[np.argsort(-scores)[:k]]))
+        elapsed = (time.perf_counter() - start_time) * 1000 / queries
+        report.append({"backend": f"ivf nprobe={nprobe}", "recall": found / (k * queries), "ms": elapsed})
+    return report
+
+
+def quantization_report(index, dtype_names=("float16", "int8"), repeats=5, k=10, threshold=0.5):
+    """
+    Compares quantized backends with exact search on the queries of tests.make_tests:
+    recall@k of the best rows, whether the search results are identical,
+    latency and size of the scanned matrix.
+
+    Args:
+        index (EmbeddingIndex): Embedding index.
+        dtype_names (tuple): Quantized types to measure.
+        repeats (int): Number of measured runs of every query.
+        k (int): Number of top rows compared.
+        threshold (float): Similarity threshold of the compared search results.
+
+    Returns:
+        list[dict]: One report line per backend.
+    """
+    from tests import make_tests
+    from embedding_index import get_quantized_backend
+    from spellcheck import correct_query
+    from text_processor import encode_query, index_results
+    from video_searcher import global_search
+
+    tests = []
+    for playlist_tags, query in make_tests():
+        videos_by_id = {video.id: video for video in global_search(playlist_tags)}
+        spans = index.row_spans(videos_by_id)
+        if spans:
+            tests.append((videos_by_id, spans, encode_query(correct_query(query))))
+
+    backends = [ExactBackend(index.matrix)] + [get_quantized_backend(index, name) for name in dtype_names]
+    truth = []
+    report = []
+    for backend in backends:
+        found = 0
+        identical = 0
+        elapsed = 0.0
+        for i, (videos_by_id, spans, query_emb) in enumerate(tests):
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                scores, rows = backend.search(query_emb, spans)
+            elapsed += (time.perf_counter() - start_time) / repeats
+            top = rows[np.argsort(-scores, kind="stable")[:k]]
+            results = index_results(scores, rows, index, videos_by_id, threshold)
+            if backend.name == "exact":
+                truth.append((set(top), results))
+            found += len(truth[i][0] & set(top))
+            identical += results == truth[i][1]
+        matrix = backend.matrix if backend.name == "exact" else backend.quantized
+        report.append({
+            "backend": backend.name,
+            "recall": found / sum(len(expected) for expected, _ in truth) if truth else 1.0,
+            "identical": identical,
+            "queries": len(tests),
+            "ms": elapsed * 1000 / max(len(tests), 1),
+            "mb": matrix.nbytes / 2**20,
+        })
+    return report
+
+
+def main():
+    """
+    Prints the recall and latency of the IVF backend on the current embedding
+    index, or of the quantized backends with `python vector_index.py quantized`.
+    """
+    from embedding_index import get_embedding_index, get_ivf_backend
+
+    index = get_embedding_index()
+    if sys.argv[1:] == ["quantized"]:
+        print(f"{len(index.matrix)} rows")
+        for line in quantization_report(index):
+            print(f"{line['backend']}: recall@10 {line['recall']:.3f}, identical results "
+                  f"{line['identical']}/{line['queries']}, {line['ms']:.2f} ms per query, {line['mb']:.1f} MB")
+        return
+
+    backend = get_ivf_backend(index)
+    print(f"{len(index.matrix)} rows, {len(backend.centroids)} clusters")
+    for line in recall_report(index.matrix, backend):
+        print(f"{line['backend']}: recall@10 {line['recall']:.3f}, {line['ms']:.2f} ms per query")
+
+
+if __name__ == "__main__":
+    main()
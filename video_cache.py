@@ -0,0 +1,86 @@
+"""
+This is the code for the per-video caches that the indexer fills and the
+consolidated indexes are built from: transcript passage embeddings, timestamp
+embeddings and transcript lemmas, all kept in cache/ under the video id.
+
+It also has the timestamp helpers both sides need, so the indexes can read the
+caches without loading text_processor and its models.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+CACHE_DIR = "cache"
+
+
+def cache_path(filename):
+    """
+    Builds a path to a file inside the cache directory.
+
+    Args:
+        filename (str): File name.
+
+    Returns:
+        str: Path to the file.
+    """
+    return os.path.join(CACHE_DIR, filename)
+
+
+def load_cache(video_id):
+    """
+    Loads cached embeddings for a video.
+
+    Args:
+        video_id (str): Unique video id.
+
+    Returns:
+        numpy.ndarray: Loaded embeddings array.
+    """
+    return np.load(cache_path(f"{video_id}_embeddings.npy"))
+
+
+def valid_timestamps(timestamps):
+    """
+    Keeps the timestamps that have a parsable timecode and a description.
+
+    Args:
+        timestamps (list): List of [timecode, description] pairs.
+
+    Returns:
+        list: Valid pairs.
+    """
+    return [chunk for chunk in timestamps
+            if len(chunk) >= 2 and all(part.isdigit() for part in chunk[0].split(':'))]
+
+
+def timestamps_cache_path(video):
+    """
+    Builds the path of the timestamp embeddings cache of a video.
+    The path depends on the description, so editing it invalidates the cache,
+    and on the cache format: v2 caches have rows of valid timestamps only.
+
+    Args:
+        video (Video): Video object.
+
+    Returns:
+        str: Path to the cache file.
+    """
+    desc_hash = hashlib.sha1(video.desc.encode("utf-8")).hexdigest()[:16]
+    return cache_path(f"{video.id}_timestamps_v2_{desc_hash}.npy")
+
+
+def convert_time(time):
+    """
+    Converts time string 'HH:MM:SS' or 'MM:SS' to seconds format.
+
+    Args:
+        time (str): Time string.
+
+    Returns:
+        int: Total seconds.
+    """
+    seconds = 0
+    for part in time.split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
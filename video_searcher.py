@@ -2,10 +2,9 @@
 This is the code for searching over the database and finding videos.
 """
 
-import io
-import os
-import json
-from media import Video, Playlist
+from corpus_index import get_index, tags_match, make_video
+from instrumentation import timed
+from media import Playlist
 
 def matching_playlist_dirs(tags={}):
   """
@@ -18,19 +17,8 @@ def matching_playlist_dirs(tags={}):
       list: List of folder names in the "./database" directory whose playlists
             contain all provided tag keys with matching values.
   """
-  result = []
-  playlist_folders = os.listdir("./database")
-  for folder in playlist_folders:
-    desc_dir = f"database/{folder}/desc.json"
-
-    with open(desc_dir, "r") as file:
-      playlist = Playlist(json.load(file))
-    # if "tags" not in playlist:
-    #   continue
-    if all((key in playlist.tags and tags[key] == playlist.tags[key]) for key in tags):
-      result.append(folder)
-  
-  return result
+  playlists = get_index()["playlists"]
+  return [folder for folder in playlists if tags_match(playlists[folder]["tags"], tags)]
 
 def matching_videos(folder, tags={}):
   """
@@ -44,26 +32,19 @@ def matching_videos(folder, tags={}):
       list: List of Video objects within the specified playlist folder whose tags 
             contain all given keys with matching values.
   """
-  playlist_dir = f"database/{folder}/desc.json"
-  with open(playlist_dir, "r") as file:
-    playlist = Playlist(json.load(file))
+  index = get_index()
+  playlist_entry = index["playlists"][folder]
+  playlist = Playlist.from_index(playlist_entry)
 
   result = []
-
-  video_files = os.listdir(f"./database/{folder}")
-
-  video_files.remove("desc.json")
-  for video_file in video_files:
-    dir = f"database/{folder}/{video_file}"
-    with open(dir, "r") as file:
-      video = Video(json.load(file), playlist)
-    # if "tags" not in video:
-    #   continue
-    if all(key in video.tags and tags[key] == video.tags[key] for key in tags):
-      result.append(video)
+  for key in playlist_entry["videos"]:
+    video_entry = index["videos"][key]
+    if tags_match(video_entry["tags"], tags):
+      result.append(make_video(video_entry, playlist))
   
   return result
 
+@timed("tag_filter")
 def global_search(playlist_tags={}, video_tags={}):
   """
   Performs a global search across playlists and videos filtering by tags.
@@ -80,4 +61,4 @@ def global_search(playlist_tags={}, video_tags={}):
   for playlist_folder in matching_playlist_dirs(playlist_tags):
     result.extend(matching_videos(playlist_folder, video_tags))
 
-  return result
\ No newline at end of file
+  return result
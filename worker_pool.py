@@ -0,0 +1,607 @@
+"""
+This is the code for the pre-fork pool of query worker processes.
+
+Scoring and encoding hold the GIL, so one process serves one query at a time.
+The pool loads everything queries read in the parent process first: the corpus
+index with the tags, the embedding and lexical indexes and the models. Then it
+forks the workers, so they share all of it instead of loading copies:
+    the embedding matrices, row metadata and transcript stores are memory-mapped
+        files, so every worker maps the same pages of the page cache;
+    the tag index, the lexical postings and the model weights are inherited
+        copy-on-write and never written to. gc.freeze() keeps the garbage
+        collector from touching, and so copying, the inherited objects.
+The parent never runs the sentence model, so forking is safe for its thread pools.
+
+Every worker has its own pipe to the parent, which sends a request to an idle
+worker and keeps the others in a backlog; no lock is shared between processes,
+so a worker that dies at any moment cannot block the others. At most
+max_pending requests are in flight; submit() waits up to SUBMIT_TIMEOUT for a
+free slot and then raises PoolBusy, so an overloaded server rejects requests
+instead of queueing them without bound. Handlers that are generators stream
+their lines back as they are produced.
+
+The workers are forked by a supervisor process, itself forked right after
+loading, before the server starts any threads. It has no threads of its own,
+so a worker never inherits a lock held by a request thread. When a worker dies,
+busy or idle, the supervisor forks it again at once with a new pipe. A request
+it had not started yet goes back to the backlog; the one it was running fails
+with WorkerError instead of waiting out TASK_TIMEOUT.
+
+Forking needs a POSIX system. Run `python worker_pool.py [max workers] [requests]`
+to measure the query throughput with 1..N workers.
+"""
+
+import gc
+import os
+import sys
+import time
+import queue
+import signal
+import inspect
+import threading
+import itertools
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection, wait
+from multiprocessing.reduction import recv_handle, send_handle
+
+from instrumentation import count
+
+WORKERS = os.cpu_count() or 1
+# Requests in flight (queued or running) per worker before new ones wait.
+PENDING_PER_WORKER = 4
+# Seconds a request waits for a free slot before PoolBusy.
+SUBMIT_TIMEOUT = 0.5
+# Seconds a request may run before its caller gives up.
+TASK_TIMEOUT = 30.0
+# Intra-op threads of the sentence model in every worker; the pool parallelizes across requests.
+WORKER_THREADS = 1
+# Seconds between checks that the pool is still running.
+WATCH_INTERVAL = 1.0
+# Seconds workers get to finish their requests when the pool is closed.
+STOP_TIMEOUT = 5.0
+
+
+class PoolBusy(Exception):
+    """Raised when the pool already has the maximum number of requests in flight."""
+
+
+class WorkerError(Exception):
+    """Raised when a handler fails in a worker or the worker dies; the message describes the error."""
+
+
+def preload():
+    """
+    Loads everything queries read, so forked workers share it, and freezes
+    the loaded objects so that the garbage collector of a worker never writes to them.
+    """
+    from embedding_index import get_embedding_index, get_timestamp_index
+    from lexical_index import KINDS, get_lexical_index
+    from text_processor import warmup
+    from video_searcher import global_search
+
+    warmup()
+    global_search()
+    get_embedding_index()
+    get_timestamp_index()
+    for kind in KINDS:
+        get_lexical_index(kind)
+    gc.freeze()
+
+
+def worker_main(handlers, conn, threads):
+    """
+    Runs requests from the pipe to the parent until it gets None or the parent
+    closes the pipe.
+
+    Args:
+        handlers (dict): Handler name to function of the request; generator functions stream lines.
+        conn (multiprocessing.connection.Connection): Pipe that brings (task id, handler name,
+            request) tuples and takes (task id, "start", None), (task id, "line", line),
+            (task id, "done", None) and (task id, "error", message) tuples back.
+        threads (int): Intra-op threads of the sentence model.
+    """
+    # Interrupts are handled by the parent, which stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(threads)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        task_id, name, request = task
+        try:
+            conn.send((task_id, "start", None))
+            output = handlers[name](request)
+            if inspect.isgenerator(output):
+                for line in output:
+                    conn.send((task_id, "line", line))
+            else:
+                conn.send((task_id, "line", output))
+            conn.send((task_id, "done", None))
+        except Exception as error:
+            conn.send((task_id, "error", repr(error)))
+
+
+def fork_worker(handlers, threads, control):
+    """
+    Forks one worker with a new pipe to the parent.
+
+    Args:
+        handlers, threads: See worker_main.
+        control (multiprocessing.connection.Connection): Pipe of the supervisor
+            to the parent, closed in the worker.
+
+    Returns:
+        tuple: (pid, sentinel, parent end of the pipe), where the sentinel file
+            descriptor becomes readable when the worker exits.
+    """
+    parent_end, child_end = multiprocessing.Pipe()
+    sentinel, exit_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(sentinel)
+        parent_end.close()
+        control.close()
+        status = 1
+        try:
+            worker_main(handlers, child_end, threads)
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(exit_end)
+    child_end.close()
+    return pid, sentinel, parent_end
+
+
+def supervisor_main(handlers, threads, workers, control):
+    """
+    Forks the workers and forks every worker that dies again, until the pool is
+    closed or the parent process exits. Every fork is reported to the parent as
+    ("forked", slot, pid), followed by the handle of the pipe to the worker, and
+    every death as ("died", slot, pid).
+
+    Args:
+        handlers, threads: See worker_main.
+        workers (int): Number of workers.
+        control (multiprocessing.connection.Connection): Pipe to the parent, which
+            sends None to stop the supervisor after the workers.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+    running = {}
+
+    def start(slot):
+        pid, sentinel, conn = fork_worker(handlers, threads, control)
+        running[sentinel] = (slot, pid)
+        control.send(("forked", slot, pid))
+        send_handle(control, conn.fileno(), parent)
+        conn.close()
+
+    for slot in range(workers):
+        start(slot)
+    deadline = None
+    while running:
+        ready = wait(list(running) + ([control] if deadline is None else []), timeout=WATCH_INTERVAL)
+        if deadline is None and (control in ready or os.getppid() != parent):
+            deadline = time.monotonic() + STOP_TIMEOUT
+        for sentinel in ready:
+            if sentinel is control:
+                continue
+            slot, pid = running.pop(sentinel)
+            os.close(sentinel)
+            os.waitpid(pid, 0)
+            if deadline is None:
+                control.send(("died", slot, pid))
+                start(slot)
+        if deadline is not None and time.monotonic() > deadline:
+            for _, pid in running.values():
+                os.kill(pid, signal.SIGTERM)
+
+
+def memory_usage(pid):
+    """
+    Reads the memory of a process from /proc; Linux only.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        dict or None: "rss_mb" and "pss_mb", where shared pages are split
+            between the processes that map them, or None if unavailable.
+    """
+    path = f"/proc/{pid}/smaps_rollup"
+    if not os.path.exists(path):
+        return None
+    values = {}
+    with open(path, "r") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+            if name in ("Rss", "Pss"):
+                values[f"{name.lower()}_mb"] = round(int(value.split()[0]) / 1024, 1)
+    return values
+
+
+class WorkerPool:
+    """
+    Pool of forked worker processes running request handlers.
+
+    Attrs:
+        handlers (dict): Handler name to function, see worker_main
+        workers (int): Number of worker processes
+        max_pending (int): Maximum number of requests in flight
+        threads (int): Intra-op threads of the sentence model in every worker
+        pids (list): Process ids of the workers
+    """
+
+    def __init__(self, handlers, workers=WORKERS, max_pending=None, threads=WORKER_THREADS):
+        self.handlers = handlers
+        self.workers = workers
+        self.max_pending = max_pending or workers * PENDING_PER_WORKER
+        self.threads = threads
+        self.pids = [None] * workers
+        self._context = multiprocessing.get_context("fork")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        # All the state below is guarded by the pending lock.
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._conns = {}
+        self._busy = {}
+        self._started = set()
+        self._backlog = deque()
+        self._closing = False
+        self._ids = itertools.count()
+        self._control = None
+        self._supervisor = None
+        self._dispatcher = None
+        self._running = False
+
+    def start(self):
+        """
+        Preloads the shared data and forks the supervisor, which forks the workers.
+        Must be called before the process starts other threads.
+        """
+        preload()
+        self._running = True
+        self._control, supervisor_control = self._context.Pipe()
+        self._supervisor = self._context.Process(
+            target=supervisor_main, args=(self.handlers, self.threads, self.workers, supervisor_control), daemon=True,
+        )
+        self._supervisor.start()
+        supervisor_control.close()
+        self._dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def dispatch(self):
+        """Follows the supervisor and delivers worker output to the waiting requests."""
+        while self._running:
+            with self._pending_lock:
+                conns = list(self._conns.values())
+            for conn in wait(conns + [self._control], timeout=WATCH_INTERVAL):
+                if conn is self._control:
+                    self.follow()
+                    continue
+                with self._pending_lock:
+                    slot = next((slot for slot, known in self._conns.items() if known is conn), None)
+                try:
+                    task_id, status, payload = conn.recv()
+                except (EOFError, OSError):
+                    # The worker has died; its request fails without waiting for the supervisor.
+                    with self._pending_lock:
+                        self.drop_worker(slot, conn)
+                    continue
+                with self._pending_lock:
+                    output = self._pending.get(task_id)
+                    if status == "start":
+                        self._started.add(task_id)
+                        continue
+                    if status != "line":
+                        self._busy.pop(slot, None)
+                        self.finish(task_id)
+                        self.send_next(slot)
+                if output is not None:
+                    output.put((status, payload))
+
+    def follow(self):
+        """Handles an event of the supervisor, see supervisor_main."""
+        try:
+            event, slot, pid = self._control.recv()
+        except (EOFError, OSError):
+            self._running = False
+            return
+        if event == "forked":
+            conn = Connection(recv_handle(self._control))
+            with self._pending_lock:
+                self.pids[slot] = pid
+                self._conns[slot] = conn
+                self.send_next(slot)
+            return
+        count("worker_restarts")
+        with self._pending_lock:
+            self.drop_worker(slot, self._conns.get(slot))
+
+    def drop_worker(self, slot, conn):
+        """
+        Forgets a dead worker and fails its request; a request the worker has not
+        started yet goes back to the backlog. Must be called with the pending lock held.
+
+        Args:
+            slot (int): Number of the worker.
+            conn (multiprocessing.connection.Connection): Pipe to the dead worker.
+        """
+        if conn is None or self._conns.get(slot) is not conn:
+            return
+        del self._conns[slot]
+        conn.close()
+        task = self._busy.pop(slot, None)
+        if task is None:
+            return
+        if task[0] not in self._started:
+            self._backlog.appendleft(task)
+            for other in list(self._conns):
+                self.send_next(other)
+            return
+        output = self._pending.get(task[0])
+        self.finish(task[0])
+        if output is not None:
+            output.put(("error", f"worker {self.pids[slot]} died"))
+
+    def send_next(self, slot):
+        """
+        Sends the next request of the backlog to an idle worker, or None once the
+        backlog of a closing pool is empty; must be called with the pending lock held.
+
+        Args:
+            slot (int): Number of the worker.
+        """
+        while slot in self._conns and slot not in self._busy:
+            if self._backlog:
+                task = self._backlog.popleft()
+                if task[0] not in self._pending:
+                    continue
+                self._busy[slot] = task
+            elif self._closing:
+                task = None
+                self._busy[slot] = None
+            else:
+                return
+            try:
+                self._conns[slot].send(task)
+            except OSError:
+                # The worker has just died; the supervisor reports it.
+                pass
+
+    def finish(self, task_id):
+        """
+        Frees the slot of a request; must be called with the pending lock held.
+
+        Args:
+            task_id (int): Request id.
+        """
+        self._started.discard(task_id)
+        if self._pending.pop(task_id, None) is not None:
+            self._slots.release()
+
+    def submit(self, name, request, timeout=SUBMIT_TIMEOUT):
+        """
+        Queues a request for the workers.
+
+        Args:
+            name (str): Handler name.
+            request (dict): Request passed to the handler.
+            timeout (float): Seconds to wait for a free slot.
+
+        Returns:
+            tuple: (request id, queue of its output) for results().
+
+        Raises:
+            PoolBusy: If no slot is freed in time.
+        """
+        if not self._slots.acquire(timeout=timeout):
+            count("rejected")
+            raise PoolBusy(f"{self.max_pending} requests in flight")
+        task = (next(self._ids), queue.SimpleQueue())
+        with self._pending_lock:
+            self._pending[task[0]] = task[1]
+            self._backlog.append((task[0], name, request))
+            for slot in list(self._conns):
+                self.send_next(slot)
+        return task
+
+    def results(self, task, timeout=TASK_TIMEOUT):
+        """
+        Waits for the output of a request.
+
+        Args:
+            task (tuple): Request id and output queue, see submit.
+            timeout (float): Seconds to wait for every line.
+
+        Yields:
+            Lines of the handler; a handler that is not a generator gives one line.
+
+        Raises:
+            WorkerError: If the handler failed.
+            TimeoutError: If the worker did not answer in time.
+        """
+        task_id, output = task
+        while True:
+            try:
+                status, payload = output.get(timeout=timeout)
+            except queue.Empty:
+                with self._pending_lock:
+                    self.finish(task_id)
+                raise TimeoutError(f"no answer from the workers in {timeout} seconds")
+            if status == "done":
+                return
+            if status == "error":
+                raise WorkerError(payload)
+            yield payload
+
+    def stream(self, name, request):
+        """
+        Runs a request and streams its lines. The request is queued right away,
+        so PoolBusy is raised by this call and not by the first iteration.
+
+        Args:
+            name (str): Handler name.
+            request (dict): Request passed to the handler.
+
+        Returns:
+            generator: Lines of the handler, see results.
+        """
+        return self.results(self.submit(name, request))
+
+    def run(self, name, request):
+        """
+        Runs a request of a handler that returns one response.
+
+        Args:
+            name (str): Handler name.
+            request (dict): Request passed to the handler.
+
+        Returns:
+            Response of the handler.
+        """
+        lines = list(self.stream(name, request))
+        return lines[0]
+
+    def memory(self):
+        """
+        Reports the memory of every worker, see memory_usage.
+
+        Returns:
+            list: Memory of every worker or None where unavailable.
+        """
+        return [memory_usage(pid) if pid is not None else None for pid in self.pids]
+
+    def close(self):
+        """Stops the workers after the requests already queued."""
+        if self._supervisor is None:
+            return
+        with self._pending_lock:
+            self._closing = True
+            for slot in list(self._conns):
+                self.send_next(slot)
+        self._control.send(None)
+        self._supervisor.join(timeout=STOP_TIMEOUT + WATCH_INTERVAL)
+        if self._supervisor.is_alive():
+            self._supervisor.terminate()
+        self._running = False
+        self._dispatcher.join()
+        for conn in self._conns.values():
+            conn.close()
+        self._conns = {}
+        self._control.close()
+        self._supervisor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def benchmark_requests(total):
+    """
+    Makes distinct search requests from the queries of tests.make_tests, each
+    extended with a frequent transcript word, so that no request is answered
+    from the query caches.
+
+    Args:
+        total (int): Number of requests.
+
+    Returns:
+        list[dict]: Requests for search_server.run_query.
+    """
+    from tests import make_tests
+    from spellcheck import load_vocabulary
+
+    vocabulary = load_vocabulary()
+    words = sorted(vocabulary, key=vocabulary.get, reverse=True)
+    tests = make_tests()
+    return [
+        {"query": f"{tests[i % len(tests)][1]} {words[i // len(tests) % len(words)]}",
+         "playlist_tags": tests[i % len(tests)][0]}
+        for i in range(total)
+    ]
+
+
+def throughput_report(max_workers=WORKERS, total=200):
+    """
+    Measures the query throughput of pools of 1..max_workers workers, each
+    loaded by twice as many concurrent clients as it has workers.
+
+    Args:
+        max_workers (int): Largest number of workers.
+        total (int): Number of requests sent to every pool.
+
+    Returns:
+        list[dict]: Workers, queries per second, speedup over one worker,
+            latency percentiles in milliseconds, rejected requests and worker memory.
+    """
+    from search_server import run_query
+
+    requests = benchmark_requests(total)
+    report = []
+    for workers in range(1, max_workers + 1):
+        with WorkerPool({"/search": run_query}, workers) as pool:
+            # Every worker answers once before measuring, so fork and first-use costs are excluded.
+            for request in requests[:workers]:
+                pool.run("/search", request)
+            latencies = []
+            rejected = []
+
+            def send(request):
+                start_time = time.perf_counter()
+                while True:
+                    try:
+                        pool.run("/search", request)
+                        break
+                    except PoolBusy:
+                        rejected.append(request)
+                latencies.append(time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=2 * workers) as clients:
+                list(clients.map(send, requests))
+            elapsed = time.perf_counter() - start_time
+            memory = [usage for usage in pool.memory() if usage is not None]
+
+        latencies = np.asarray(latencies) * 1000
+        line = {
+            "workers": workers,
+            "qps": round(total / elapsed, 1),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+            "rejected": len(rejected),
+            "worker_rss_mb": round(np.mean([usage["rss_mb"] for usage in memory]), 1) if memory else None,
+            "worker_pss_mb": round(np.mean([usage["pss_mb"] for usage in memory]), 1) if memory else None,
+        }
+        line["speedup"] = round(line["qps"] / report[0]["qps"], 2) if report else 1.0
+        report.append(line)
+    return report
+
+
+def main():
+    """Prints the throughput of pools of 1..N workers."""
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print(f"{total} requests, {os.cpu_count()} CPUs")
+    for line in throughput_report(max_workers, total):
+        memory = f", worker RSS {line['worker_rss_mb']} MB, PSS {line['worker_pss_mb']} MB" \
+            if line["worker_pss_mb"] is not None else ""
+        print(f"{line['workers']:>3} workers: {line['qps']:>8.1f} queries/s ({line['speedup']:.2f}x), "
+              f"p50 {line['p50_ms']:.2f} ms, p99 {line['p99_ms']:.2f} ms, {line['rejected']} rejected{memory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,10 @@ This code extracts videos from Youtube and stores them in the database.
 import io
 import os
 import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import googleapiclient.discovery
 import google_auth_oauthlib.flow
@@ -12,12 +16,124 @@ import googleapiclient.errors
 
 from googleapiclient.http import MediaIoBaseDownload
 
-from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api import YouTubeTranscriptApi, NoTranscriptFound, TranscriptsDisabled, VideoUnavailable
 from youtube_transcript_api.proxies import WebshareProxyConfig
 
+from corpus_index import DATABASE_DIR, update_index
+
 
 scopes = ["https://www.googleapis.com/auth/youtube.force-ssl"]
 
+CHANNEL_ID = "UCdxesVp6Fs7wLpnp1XKkvZg"
+CHECKPOINT_FILE = "ingest_checkpoint.json"
+
+WORKERS = 8
+# Requests per second allowed for every host.
+HOST_RATES = {"youtube.googleapis.com": 5.0, "www.youtube.com": 2.0}
+RETRIES = 5
+BACKOFF_BASE = 1.0
+
+# Transcript errors that will not go away if the request is repeated.
+PERMANENT_TRANSCRIPT_ERRORS = (NoTranscriptFound, TranscriptsDisabled, VideoUnavailable)
+
+
+class RateLimiter:
+    """
+    Limits the request rate separately for every host.
+
+    Attrs:
+        rates (dict): Host to allowed requests per second
+    """
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.next_time = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        """
+        Blocks until a request to the host is allowed.
+
+        Args:
+            host (str): Host name.
+        """
+        rate = self.rates.get(host)
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time.get(host, now))
+            self.next_time[host] = slot + 1 / rate
+        time.sleep(slot - now)
+
+
+rate_limiter = RateLimiter(HOST_RATES)
+
+
+def is_permanent_http_error(error):
+    """
+    Checks whether a YouTube Data API error will not go away if the request is
+    repeated: client errors are permanent, except for rate limiting.
+
+    Args:
+        error (Exception): Raised error.
+
+    Returns:
+        bool: True for HttpError with a status below 500 other than 429.
+    """
+    if not isinstance(error, googleapiclient.errors.HttpError):
+        return False
+    status = int(error.resp.status)
+    return status < 500 and status != 429
+
+
+def with_retries(func, host, permanent_errors=()):
+    """
+    Calls a function, retrying with exponential backoff and jitter on errors.
+
+    Args:
+        func (callable): Function without arguments that makes one request.
+        host (str): Host the request goes to, used for rate limiting.
+        permanent_errors (tuple): Exception types that are raised without retrying,
+            in addition to permanent HTTP errors (see is_permanent_http_error).
+
+    Returns:
+        Result of the function.
+    """
+    for attempt in range(RETRIES):
+        rate_limiter.wait(host)
+        try:
+            return func()
+        except permanent_errors:
+            raise
+        except Exception as error:
+            if attempt == RETRIES - 1 or is_permanent_http_error(error):
+                raise
+            time.sleep(BACKOFF_BASE * 2 ** attempt * (0.5 + random.random()))
+
+
+def list_all(request_method, **params):
+    """
+    Fetches all pages of a YouTube Data API list request following nextPageToken.
+
+    Args:
+        request_method (callable): List method, for example youtube.playlists().list.
+        **params: Request parameters.
+
+    Returns:
+        list: Items of all pages.
+    """
+    items = []
+    page_token = None
+    while True:
+        if page_token:
+            params["pageToken"] = page_token
+        response = with_retries(request_method(**params).execute, "youtube.googleapis.com")
+        items.extend(response["items"])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return items
+
 def authentification():
     """
     Performs OAuth2 authentication and initializes YouTube and transcript API.
@@ -47,26 +163,26 @@ def authentification():
     )
     return youtube, ytt_api
 
-def get_playlists(youtube, channel_id, max_results):
+def get_playlists(youtube, channel_id, max_results=None):
     """
     Gets a list of playlists for a given YouTube channel.
     
     Args:
         youtube: YouTube API client.
         channel_id (str): YouTube channel ide.
-        max_results (int): Maximum number of playlists to get.
+        max_results (int, optional): Maximum number of playlists to get, all by default.
     
     Returns:
         list: List of playlist dicts.
     """
-    request = youtube.playlists().list(
+    playlists_list = list_all(
+        youtube.playlists().list,
         part="id,snippet",
         channelId=channel_id,
-        maxResults=max_results,
+        maxResults=50,
     )
-    playlists_list = request.execute()["items"]
 
-    return playlists_list
+    return playlists_list[:max_results]
 
 def get_one_playlist(youtube, playlist_id):
     """
@@ -98,12 +214,12 @@ def get_playlist_items(youtube, playlist_id):
     Returns:
         list: List of videos dicts.
     """
-    request = youtube.playlistItems().list(
+    videos_list = list_all(
+        youtube.playlistItems().list,
         part="contentDetails,snippet",
         playlistId=playlist_id,
         maxResults=50,
     )
-    videos_list = request.execute()["items"]
 
     return videos_list
 
@@ -137,7 +253,11 @@ def get_transcript(ytt_api, video_id):
         list or None: Transcript data list if it's possible to download subtitles, else None.
     """
     try:
-      fetched_transcript = ytt_api.fetch(video_id, languages=['ru'])
+      fetched_transcript = with_retries(
+        lambda: ytt_api.fetch(video_id, languages=['ru']),
+        "www.youtube.com",
+        PERMANENT_TRANSCRIPT_ERRORS,
+      )
     except Exception:
       print(f"https://www.youtube.com/watch?v={video_id}", " - transcript unavailable!")
       return None
@@ -160,11 +280,11 @@ def make_folder(playlist):
     Args:
         playlist (dict): Playlist dict from YouTube API.
     """
-    if os.path.exists(f"database/{playlist['id']}"):
+    if os.path.exists(f"{DATABASE_DIR}/{playlist['id']}"):
         return
     
-    os.mkdir(f"database/{playlist['id']}")
-    dir = f"database/{playlist['id']}/desc.json"
+    os.mkdir(f"{DATABASE_DIR}/{playlist['id']}")
+    dir = f"{DATABASE_DIR}/{playlist['id']}/desc.json"
     with open(dir, "w") as file:
         json.dump(playlist, file)
 
@@ -178,52 +298,111 @@ def add_to_folder(playlist_id, video):
     """
     video_id = video["contentDetails"]["videoId"]
     filename = f"{video_id}.json"
-    dir = f"database/{playlist_id}/{filename}"
+    dir = f"{DATABASE_DIR}/{playlist_id}/{filename}"
 
     if os.path.exists(dir):
         return
     
-    with open(dir, "w") as file:
+    with open(f"{dir}.tmp", "w") as file:
         json.dump(video, file)
+    os.replace(f"{dir}.tmp", dir)
 
-    
-   
-def update(youtube, ytt_api):
+def read_checkpoint():
+    """
+    Reads the checkpoint of an interrupted update.
+
+    Returns:
+        dict: {"done_playlists": ids of playlists finished in the interrupted update}
+    """
+    if not os.path.exists(CHECKPOINT_FILE):
+        return {"done_playlists": []}
+    with open(CHECKPOINT_FILE, "r") as file:
+        return json.load(file)
+
+def write_checkpoint(checkpoint):
+    """
+    Saves the update checkpoint atomically.
+
+    Args:
+        checkpoint (dict): Checkpoint, see read_checkpoint.
+    """
+    with open(f"{CHECKPOINT_FILE}.tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(f"{CHECKPOINT_FILE}.tmp", CHECKPOINT_FILE)
+
+def ingest_video(ytt_api, playlist_id, video):
+    """
+    Downloads the transcript of a video and stores the video in the database.
+
+    Args:
+        ytt_api: YouTubeTranscriptApi client.
+        playlist_id (str): Playlist id.
+        video (dict): Video dict from YouTube API.
+    """
+    video["snippet"]["transcript"] = get_transcript(ytt_api, video["contentDetails"]["videoId"])
+    add_to_folder(playlist_id, video)
+
+def update(youtube, ytt_api, channel_id=CHANNEL_ID, workers=WORKERS):
     """
     Fetches latest playlists and videos for the specified channel, storing them in the database directory.
     For each playlist, creates a folder and downloads data and transcripts for videos.
+    Transcripts are downloaded by a pool of workers; playlists that were finished
+    before an interruption are skipped when the update is started again.
     
     Args:
         youtube: YouTube API client.
         ytt_api: YouTubeTranscriptApi client.
+        channel_id (str): YouTube channel id.
+        workers (int): Number of concurrent transcript downloads.
     """
-    channel_id = "UCdxesVp6Fs7wLpnp1XKkvZg"
-    playlists = get_playlists(youtube, channel_id, 20)
+    checkpoint = read_checkpoint()
+    playlists = get_playlists(youtube, channel_id)
+
+    remaining = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      futures = {}
+      for playlist in playlists:
+        playlist_id = playlist["id"]
+        if playlist_id in checkpoint["done_playlists"]:
+          continue
+        print("Плейлист:", playlist["snippet"]["title"])
+        print("Плейлист:", playlist["snippet"]["description"])
+        print("-----------------------------------------------")
+
+        make_folder(playlist)
+
+        playlist_items = get_playlist_items(youtube, playlist_id)
 
-    for playlist in playlists:
-      playlist_id = playlist["id"]
-      print("Плейлист:", playlist["snippet"]["title"])
-      print("Плейлист:", playlist["snippet"]["description"])
-      print("-----------------------------------------------")
+        remaining[playlist_id] = 0
+        for video in playlist_items:
+            print(video["snippet"]["title"])
+            video_id = video["contentDetails"]["videoId"]
+            
+            check_dir = f"{DATABASE_DIR}/{playlist_id}/{video_id}.json"
+            if not os.path.exists(check_dir):
+                futures[executor.submit(ingest_video, ytt_api, playlist_id, video)] = playlist_id
+                remaining[playlist_id] += 1
+        print("================================")
 
-      make_folder(playlist)
+      for playlist_id in [playlist_id for playlist_id, count in remaining.items() if count == 0]:
+        checkpoint["done_playlists"].append(playlist_id)
+      write_checkpoint(checkpoint)
 
-      playlist_items = get_playlist_items(youtube, playlist_id)
+      for future in as_completed(futures):
+        future.result()
+        playlist_id = futures[future]
+        remaining[playlist_id] -= 1
+        if remaining[playlist_id] == 0:
+          checkpoint["done_playlists"].append(playlist_id)
+          write_checkpoint(checkpoint)
 
-      for video in playlist_items:
-          print(video["snippet"]["title"])
-          video_id = video["contentDetails"]["videoId"]
-          
-          check_dir = f"database/{playlist_id}/{video_id}.json"
-          if not os.path.exists(check_dir):
-              video["snippet"]["transcript"] = get_transcript(ytt_api, video_id)
-              add_to_folder(playlist_id, video)
-      print("================================")
+    os.remove(CHECKPOINT_FILE)
     
 def main():
     """Main function to authenticate and update the database."""
     youtube, ytt_api = authentification()
     update(youtube, ytt_api)
+    update_index()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file